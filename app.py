@@ -22,6 +22,14 @@ class ChainedOpenSSLContextFactory(ssl.DefaultOpenSSLContextFactory):
 def createHangupHandler(ircd):
     return lambda signal, stack: ircd.rehash()
 
+def createTimingDumpHandler(ircd):
+    def dumpTimingStats(signal, stack):
+        try:
+            log.msg("Wrote timing stats to {}".format(ircd.dump_timing_stats()))
+        except (IOError, OSError) as e:
+            log.msg("Could not write timing stats: {}".format(e))
+    return dumpTimingStats
+
 def addClientPortToIRCd(port, ircd, desc):
     ircd.saveClientPort(desc, port)
 
@@ -73,5 +81,7 @@ if __name__ == "__main__":
         listenDeferred.addErrback(logPortNotBound)
     # Bind SIGHUP to rehash
     signal.signal(signal.SIGHUP, createHangupHandler(ircd))
+    # Bind SIGUSR1 to writing out the timing stats
+    signal.signal(signal.SIGUSR1, createTimingDumpHandler(ircd))
     # And start up the reactor
     reactor.run()
\ No newline at end of file
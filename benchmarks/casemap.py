@@ -0,0 +1,117 @@
+"""
+Times IRC case mapping and the case-insensitive dictionaries that back the
+user, channel, and server tables.  Each lookup-heavy path is run against the
+current implementation and against the old chained str.replace mapping,
+which is kept here for comparison.
+
+Run from the repository root:
+    python benchmarks/casemap.py [--keys N] [--repeat N]
+"""
+
+import argparse, os, sys, timeit
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from collections import MutableMapping
+from txircd.utils import CaseInsensitiveDictionary, irc_lower
+
+def replace_irc_lower(str):
+    return str.lower().replace("[","{").replace("]","}").replace("/","|").replace("~","^")
+
+class ReplaceCaseInsensitiveDictionary(MutableMapping):
+    # The dictionary as it was before lookups bypassed MutableMapping
+    def __init__(self):
+        self._data = {}
+
+    def __delitem__(self, key):
+        try:
+            del self._data[replace_irc_lower(key)]
+        except KeyError:
+            raise KeyError(key)
+
+    def __getitem__(self, key):
+        try:
+            return self._data[replace_irc_lower(key)]
+        except KeyError:
+            raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __setitem__(self, key, value):
+        self._data[replace_irc_lower(key)] = value
+
+def make_keys(count):
+    return ["Nick[{}]~Away/Phone".format(i) for i in xrange(count)]
+
+def fill(dictType, keys):
+    table = dictType()
+    for key in keys:
+        table[key] = key
+    return table
+
+def lower_all(lower, keys):
+    for key in keys:
+        lower(key)
+
+def set_all(table, keys):
+    for key in keys:
+        table[key] = key
+
+def get_all(table, keys):
+    for key in keys:
+        table[key]
+
+def contains_all(table, keys):
+    for key in keys:
+        key in table
+
+def miss_all(table, keys):
+    for key in keys:
+        key in table
+        table.get(key)
+
+def iterate_values(table, keys):
+    for value in table.itervalues():
+        pass
+
+def iterate_items(table, keys):
+    for key, value in table.iteritems():
+        pass
+
+benchmarks = [
+    ("set", set_all),
+    ("get", get_all),
+    ("contains", contains_all),
+    ("miss (in + get)", miss_all),
+    ("itervalues", iterate_values),
+    ("iteritems", iterate_items)
+]
+
+def best_time(func, repeat):
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+def run(keyCount, repeat):
+    keys = make_keys(keyCount)
+    missingKeys = ["Missing{}".format(key) for key in keys]
+    for key in keys:
+        assert irc_lower(key) == replace_irc_lower(key)
+    print "{} keys, best of {} runs".format(keyCount, repeat)
+    print "{:<20}{:>12}{:>12}{:>10}".format("operation", "old (ms)", "new (ms)", "speedup")
+    def report(name, old, new):
+        print "{:<20}{:>12.2f}{:>12.2f}{:>9.1f}x".format(name, old * 1000, new * 1000, old / new if new else 0)
+    report("irc_lower", best_time(lambda: lower_all(replace_irc_lower, keys), repeat), best_time(lambda: lower_all(irc_lower, keys), repeat))
+    oldTable = fill(ReplaceCaseInsensitiveDictionary, keys)
+    newTable = fill(CaseInsensitiveDictionary, keys)
+    for name, func in benchmarks:
+        testKeys = missingKeys if func is miss_all else keys
+        report(name, best_time(lambda: func(oldTable, testKeys), repeat), best_time(lambda: func(newTable, testKeys), repeat))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--keys", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    run(args.keys, args.repeat)
@@ -0,0 +1,454 @@
+"""
+Load tests the IRCd with simulated clients.  The IRCd (or a pair of linked
+IRCds) runs in this process and listens on loopback, and the clients connect
+to it over TCP, register, join channels, and send traffic.  Each message
+carries the time it was sent, so delivery latency is measured as each client
+receives it.
+
+Scenarios:
+    connect   A connect storm; reports registrations per second and how long
+              registration takes.
+    traffic   Clients join channels and send PRIVMSG and NOTICE traffic at a
+              fixed total rate; reports delivery throughput and latency.
+    netsplit  Two linked servers with clients on each; times the link burst,
+              the split, and the relink, and measures latency across the link.
+    bids      An auction-style flood of BID commands through BidServ, with
+              every bid announced to the auction channel.  This loads the
+              db_services module without a database, so clients use guest
+              nicks (which NickServ doesn't look up) and the auction and
+              their accounts are set up in-process.
+    all       Runs each of the above in turn.
+
+CPU and memory figures are for the whole process, so they include the
+simulated clients as well as the IRCd; treat the per-client numbers as an
+upper bound.
+
+Run from the repository root:
+    python benchmarks/load.py traffic --clients 2000 --channels 50 --rate 500
+"""
+
+import argparse, os, resource, shutil, sys, tempfile, time
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from twisted.internet import defer, reactor, task
+from twisted.internet.endpoints import serverFromString
+from twisted.internet.protocol import ClientFactory
+from twisted.protocols.basic import LineReceiver
+from txircd.ircd import IRCD
+from txircd.server import ServerFactory
+
+base_modules = ["cmd_join", "cmd_nick", "cmd_part", "cmd_ping", "cmd_pong", "cmd_privmsg_notice", "cmd_quit", "cmd_user", "cmode_n", "cmode_o", "cmode_t", "cmode_v"]
+message_marker = "bench"
+
+class Stats(object):
+    def __init__(self):
+        self.sent = 0
+        self.received = 0
+        self.rejected = 0
+        self.latencies = []
+
+    def record(self, sentTime):
+        self.received += 1
+        self.latencies.append(time.time() - sentTime)
+
+    def percentile(self, percent):
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        index = min(len(ordered) - 1, int(len(ordered) * percent / 100.0))
+        return ordered[index]
+
+    def reset(self):
+        self.sent = 0
+        self.received = 0
+        self.rejected = 0
+        self.latencies = []
+
+class ResourceSnapshot(object):
+    def __init__(self):
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        self.time = time.time()
+        self.cpu = usage.ru_utime + usage.ru_stime
+        self.rss = current_rss(usage)
+
+def current_rss(usage):
+    try:
+        with open("/proc/self/statm", "r") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (IOError, IndexError, ValueError):
+        return usage.ru_maxrss * 1024 # Peak rather than current, but the best we can do without /proc
+
+class BenchClient(LineReceiver):
+    delimiter = "\r\n"
+    MAX_LENGTH = 65536
+
+    def connectionMade(self):
+        self.connectTime = time.time()
+        self.nickname = self.factory.nextNick()
+        self.sendLine("NICK {}".format(self.nickname))
+        self.sendLine("USER {} 0 * :Load test client".format(self.nickname))
+
+    def lineReceived(self, line):
+        if line.startswith("PING "):
+            self.sendLine("PONG {}".format(line[5:]))
+            return
+        if line[0] == ":":
+            parts = line[1:].split(" ", 2)
+        else:
+            parts = [""] + line.split(" ", 1)
+        if len(parts) < 2:
+            return
+        command = parts[1]
+        if command == "001":
+            self.factory.clientRegistered(self, time.time() - self.connectTime)
+        elif command == "PRIVMSG" or command == "NOTICE":
+            trailing = parts[2].split(" :", 1)[1] if len(parts) > 2 and " :" in parts[2] else ""
+            markerPos = trailing.find("{} ".format(message_marker))
+            if markerPos >= 0:
+                try:
+                    sentTime = float(trailing[markerPos + len(message_marker) + 1:].split(" ", 1)[0].rstrip("\x01"))
+                except ValueError:
+                    return
+                self.factory.stats.record(sentTime)
+            elif command == "NOTICE" and "high bid is already" in trailing:
+                self.factory.stats.rejected += 1
+
+    def connectionLost(self, reason):
+        self.factory.clientLost(self)
+
+class BenchClientFactory(ClientFactory):
+    protocol = BenchClient
+
+    def __init__(self, nickPrefix):
+        self.nickPrefix = nickPrefix
+        self.nickCount = 0
+        self.clients = []
+        self.registrationTimes = []
+        self.stats = Stats()
+        self.waitingFor = None
+        self.waitCount = 0
+
+    def nextNick(self):
+        self.nickCount += 1
+        return "{}{}".format(self.nickPrefix, self.nickCount)
+
+    def clientRegistered(self, client, registerTime):
+        self.clients.append(client)
+        self.registrationTimes.append(registerTime)
+        if self.waitingFor and len(self.clients) >= self.waitCount:
+            waiting, self.waitingFor = self.waitingFor, None
+            waiting.callback(self.clients)
+
+    def clientLost(self, client):
+        if client in self.clients:
+            self.clients.remove(client)
+
+    def clientConnectionFailed(self, connector, reason):
+        print "Client connection failed: {}".format(reason.getErrorMessage())
+
+    def whenRegistered(self, count):
+        self.waitCount = count
+        self.waitingFor = defer.Deferred()
+        if len(self.clients) >= count:
+            waiting, self.waitingFor = self.waitingFor, None
+            waiting.callback(self.clients)
+        return self.waitingFor
+
+class LoadHarness(object):
+    def __init__(self, args):
+        self.args = args
+        self.nextPort = args.port
+        self.ircds = []
+
+    def allocatePort(self):
+        port = self.nextPort
+        self.nextPort += 1
+        return port
+
+    def startServer(self, name, modules, links = {}, linkPort = None, extraOptions = {}):
+        options = {
+            "server_name": name,
+            "server_modules": modules,
+            "serverlinks": links,
+            "client_max_data": sys.maxint,
+            "client_peer_exempt": {"127.0.0.1": 0},
+            "client_ping_interval": 3600,
+            "client_timeout_delay": 3600,
+            "app_log_dir": "logs",
+            "app_log_categories": []
+        }
+        options.update(extraOptions)
+        ircd = IRCD("{}.yaml".format(name), options)
+        ServerFactory(ircd)
+        clientPort = self.allocatePort()
+        serverFromString(reactor, "tcp:{}:interface=127.0.0.1:backlog=1024".format(clientPort)).listen(ircd)
+        if linkPort:
+            serverFromString(reactor, "tcp:{}:interface=127.0.0.1".format(linkPort)).listen(ircd.server_factory)
+        self.ircds.append(ircd)
+        return ircd, clientPort
+
+    def connectClients(self, port, count, nickPrefix = "Guest"):
+        factory = BenchClientFactory(nickPrefix)
+        rate = self.args.connect_rate
+        if rate:
+            for i in xrange(count):
+                reactor.callLater(float(i) / rate, reactor.connectTCP, "127.0.0.1", port, factory)
+        else:
+            for i in xrange(count):
+                reactor.connectTCP("127.0.0.1", port, factory)
+        return factory, factory.whenRegistered(count)
+
+    def joinChannels(self, ircd, clients, channelCount, perClient):
+        expected = {}
+        for index, client in enumerate(clients):
+            for offset in xrange(min(perClient, channelCount)):
+                channel = "#load{}".format((index + offset) % channelCount)
+                client.sendLine("JOIN {}".format(channel))
+                client.channels = getattr(client, "channels", []) + [channel]
+                expected[channel] = expected.get(channel, 0) + 1
+        def joined():
+            for channel, members in expected.iteritems():
+                if channel not in ircd.channels or len(ircd.channels[channel].users) < members:
+                    return False
+            return True
+        return wait_for(joined, 60)
+
+    def sendTraffic(self, clients, factory, duration, rate, noticeRatio, lineFunc = None):
+        # Spread the total rate over ticks of a hundredth of a second, carrying the remainder between ticks
+        tick = 0.01
+        state = { "credit": 0.0, "next": 0, "noticeCredit": 0.0 }
+        def sendTick():
+            state["credit"] += rate * tick
+            while state["credit"] >= 1 and clients:
+                state["credit"] -= 1
+                client = clients[state["next"] % len(clients)]
+                state["next"] += 1
+                if lineFunc:
+                    client.sendLine(lineFunc(client))
+                else:
+                    state["noticeCredit"] += noticeRatio
+                    command = "PRIVMSG"
+                    if state["noticeCredit"] >= 1:
+                        state["noticeCredit"] -= 1
+                        command = "NOTICE"
+                    channel = client.channels[state["next"] % len(client.channels)]
+                    client.sendLine("{} {} :{} {:.6f}".format(command, channel, message_marker, time.time()))
+                factory.stats.sent += 1
+        sender = task.LoopingCall(sendTick)
+        sender.start(tick)
+        done = defer.Deferred()
+        def finish():
+            sender.stop()
+            reactor.callLater(self.args.drain, done.callback, None) # Let the last messages arrive before reporting
+        reactor.callLater(duration, finish)
+        return done
+
+def wait_for(condition, timeout, interval = 0.05):
+    done = defer.Deferred()
+    deadline = time.time() + timeout
+    def check():
+        if condition():
+            poller.stop()
+            done.callback(True)
+        elif time.time() > deadline:
+            poller.stop()
+            done.callback(False)
+    poller = task.LoopingCall(check)
+    poller.start(interval)
+    return done
+
+def report(title, rows):
+    print
+    print "== {} ==".format(title)
+    for label, value in rows:
+        print "  {:<34}{}".format(label, value)
+    sys.stdout.flush()
+
+def format_ms(seconds):
+    return "{:.2f} ms".format(seconds * 1000)
+
+def format_bytes(count):
+    return "{:.1f} KiB".format(count / 1024.0)
+
+def resource_rows(before, after, clientCount):
+    elapsed = after.time - before.time
+    cpu = after.cpu - before.cpu
+    return [
+        ("CPU time", "{:.2f}s ({:.0f}% of wall time)".format(cpu, cpu / elapsed * 100 if elapsed else 0)),
+        ("CPU per client", "{:.3f} ms".format(cpu / clientCount * 1000 if clientCount else 0)),
+        ("Memory growth per client", format_bytes(float(after.rss - before.rss) / clientCount if clientCount else 0)),
+        ("Process RSS", format_bytes(after.rss))
+    ]
+
+def traffic_rows(stats, duration):
+    return [
+        ("Messages sent", "{} ({:.0f}/s)".format(stats.sent, stats.sent / duration)),
+        ("Lines delivered", "{} ({:.0f}/s)".format(stats.received, stats.received / duration)),
+        ("Delivery latency p50", format_ms(stats.percentile(50))),
+        ("Delivery latency p99", format_ms(stats.percentile(99))),
+        ("Delivery latency max", format_ms(max(stats.latencies) if stats.latencies else 0))
+    ]
+
+@defer.inlineCallbacks
+def scenario_connect(harness):
+    args = harness.args
+    ircd, port = harness.startServer("connect.load", base_modules)
+    before = ResourceSnapshot()
+    factory, registered = harness.connectClients(port, args.clients)
+    yield registered
+    after = ResourceSnapshot()
+    elapsed = after.time - before.time
+    times = Stats()
+    times.latencies = factory.registrationTimes
+    rows = [
+        ("Clients registered", "{} in {:.2f}s ({:.0f}/s)".format(len(factory.clients), elapsed, len(factory.clients) / elapsed)),
+        ("Registration time p50", format_ms(times.percentile(50))),
+        ("Registration time p99", format_ms(times.percentile(99)))
+    ]
+    report("Connect storm: {} clients".format(args.clients), rows + resource_rows(before, after, args.clients))
+    for client in factory.clients[:]:
+        client.transport.loseConnection()
+
+@defer.inlineCallbacks
+def scenario_traffic(harness):
+    args = harness.args
+    ircd, port = harness.startServer("traffic.load", base_modules)
+    before = ResourceSnapshot()
+    factory, registered = harness.connectClients(port, args.clients)
+    clients = yield registered
+    yield harness.joinChannels(ircd, clients, args.channels, args.joins)
+    connected = ResourceSnapshot()
+    yield harness.sendTraffic(clients, factory, args.duration, args.rate, args.notice_ratio)
+    after = ResourceSnapshot()
+    rows = traffic_rows(factory.stats, args.duration)
+    rows.append(("Memory per connected client", format_bytes(float(connected.rss - before.rss) / len(clients))))
+    report("Channel traffic: {} clients, {} channels, {} joins each, {} msg/s".format(args.clients, args.channels, args.joins, args.rate), rows + resource_rows(connected, after, len(clients)))
+    for client in clients[:]:
+        client.transport.loseConnection()
+
+@defer.inlineCallbacks
+def scenario_netsplit(harness):
+    args = harness.args
+    linkPort = harness.allocatePort()
+    linkConfig = lambda other, port: { other: { "ip": "127.0.0.1", "connect": "tcp:127.0.0.1:{}".format(port), "incoming_password": "load", "outgoing_password": "load" } }
+    hub, hubPort = harness.startServer("hub.load", base_modules, linkConfig("leaf.load", linkPort), linkPort)
+    leaf, leafPort = harness.startServer("leaf.load", base_modules, linkConfig("hub.load", linkPort))
+    half = args.clients / 2
+    hubFactory, hubRegistered = harness.connectClients(hubPort, half, "Hub")
+    leafFactory, leafRegistered = harness.connectClients(leafPort, args.clients - half, "Leaf")
+    hubClients = yield hubRegistered
+    leafClients = yield leafRegistered
+    yield harness.joinChannels(hub, hubClients, args.channels, args.joins)
+    yield harness.joinChannels(leaf, leafClients, args.channels, args.joins)
+    hubLocal = len(hub.users)
+    leafLocal = len(leaf.users)
+    total = hubLocal + leafLocal
+    rows = []
+    for round in xrange(args.rounds):
+        before = ResourceSnapshot()
+        leaf.connect_server("hub.load")
+        linked = yield wait_for(lambda: len(hub.users) == total and len(leaf.users) == total, 120)
+        after = ResourceSnapshot()
+        rows.append(("Link burst, round {}".format(round + 1), "{:.2f}s{} ({:.2f}s CPU)".format(after.time - before.time, "" if linked else " (timed out)", after.cpu - before.cpu)))
+        if round == 0:
+            hubFactory.stats.reset()
+            leafFactory.stats.reset()
+            yield harness.sendTraffic(hubClients, leafFactory, args.duration, args.rate, args.notice_ratio)
+            rows.extend([("Cross-link " + label.lower(), value) for label, value in traffic_rows(leafFactory.stats, args.duration)])
+        before = ResourceSnapshot()
+        for server in hub.linked_servers:
+            server.transport.loseConnection()
+        split = yield wait_for(lambda: len(hub.users) == hubLocal and len(leaf.users) == leafLocal, 120)
+        after = ResourceSnapshot()
+        rows.append(("Netsplit, round {}".format(round + 1), "{:.2f}s{} ({:.2f}s CPU)".format(after.time - before.time, "" if split else " (timed out)", after.cpu - before.cpu)))
+    report("Netsplit and relink: {} clients, {} channels, {} rounds".format(args.clients, args.channels, args.rounds), rows)
+    for client in hubClients[:] + leafClients[:]:
+        client.transport.loseConnection()
+
+@defer.inlineCallbacks
+def scenario_bids(harness):
+    args = harness.args
+    ircd, port = harness.startServer("auction.load", base_modules + ["db_services"], extraOptions={ "services_bidserv_limit": sys.maxint })
+    if "db_services" not in ircd.modules:
+        report("Bid flood: {} bidders, {} bids/s".format(args.clients, args.rate), [("Skipped", "the db_services module couldn't be loaded (are its dependencies installed?)")])
+        return
+    factory, registered = harness.connectClients(port, args.clients)
+    clients = yield registered
+    yield harness.joinChannels(ircd, clients, 1, 1)
+    bidserv = ircd.users[ircd.servconfig["services_bidserv_nick"]]
+    bidserv.cache["auction"] = {
+        "item": 1,
+        "name": "Load test lot",
+        "highbid": 0.0,
+        "highbidder": "Nobody",
+        "highbidderid": None,
+        "startbid": 0.0,
+        "bids": [],
+        "called": 0
+    }
+    for index, client in enumerate(clients):
+        ircd.users[client.nickname].cache["accountid"] = index + 1
+    bidState = { "amount": 0 }
+    def bidLine(client):
+        bidState["amount"] += 1
+        return "BID {}.00 {} {:.6f}".format(bidState["amount"], message_marker, time.time())
+    before = ResourceSnapshot()
+    yield harness.sendTraffic(clients, factory, args.duration, args.rate, 0, bidLine)
+    after = ResourceSnapshot()
+    stats = factory.stats
+    accepted = len(bidserv.cache["auction"]["bids"])
+    rows = [
+        ("Bids sent", "{} ({:.0f}/s)".format(stats.sent, stats.sent / args.duration)),
+        ("Bids accepted", "{} ({:.0f}/s)".format(accepted, accepted / args.duration)),
+        ("Bids rejected as too low", str(stats.rejected)),
+        ("Announcements delivered", "{} ({:.0f}/s)".format(stats.received, stats.received / args.duration)),
+        ("Announcement latency p50", format_ms(stats.percentile(50))),
+        ("Announcement latency p99", format_ms(stats.percentile(99)))
+    ]
+    report("Bid flood: {} bidders, {} bids/s".format(args.clients, args.rate), rows + resource_rows(before, after, len(clients)))
+    for client in clients[:]:
+        client.transport.loseConnection()
+
+scenarios = {
+    "connect": scenario_connect,
+    "traffic": scenario_traffic,
+    "netsplit": scenario_netsplit,
+    "bids": scenario_bids
+}
+scenario_order = ["connect", "traffic", "netsplit", "bids"]
+
+@defer.inlineCallbacks
+def run(args):
+    try:
+        for name in (scenario_order if args.scenario == "all" else [args.scenario]):
+            harness = LoadHarness(args)
+            yield scenarios[name](harness)
+            args.port = harness.nextPort # Don't reuse ports still in TIME_WAIT or held by the last scenario's IRCds
+            yield wait_for(lambda: True, 0) # Let the disconnections go through before the next scenario
+    except Exception:
+        import traceback
+        traceback.print_exc()
+    reactor.stop()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load tests txircd with simulated clients.")
+    parser.add_argument("scenario", choices=scenario_order + ["all"])
+    parser.add_argument("--clients", type=int, default=1000, help="number of simulated clients (default 1000)")
+    parser.add_argument("--channels", type=int, default=20, help="number of channels (default 20)")
+    parser.add_argument("--joins", type=int, default=3, help="channels each client joins (default 3)")
+    parser.add_argument("--rate", type=float, default=200, help="messages (or bids) sent per second across all clients (default 200)")
+    parser.add_argument("--notice-ratio", type=float, default=0.1, help="fraction of messages sent as NOTICE (default 0.1)")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to send traffic for (default 10)")
+    parser.add_argument("--drain", type=float, default=2, help="seconds to wait for messages after sending stops (default 2)")
+    parser.add_argument("--connect-rate", type=float, default=0, help="connections per second; 0 connects everyone at once (default 0)")
+    parser.add_argument("--rounds", type=int, default=2, help="split and relink rounds for the netsplit scenario (default 2)")
+    parser.add_argument("--port", type=int, default=16667, help="first loopback port to listen on (default 16667)")
+    args = parser.parse_args()
+    # The IRCds write their data and logs to the working directory, so keep those out of the repository
+    workDir = tempfile.mkdtemp()
+    os.chdir(workDir)
+    reactor.callWhenRunning(run, args)
+    reactor.run()
+    shutil.rmtree(workDir)
+    sys.stdout.flush()
+    os._exit(0) # Don't wait on the IRCds' timers and threads
@@ -0,0 +1,87 @@
+"""
+Measures the cost of building user prefixes (nick!ident@host) during a large
+channel broadcast.  Every recipient is sent a line carrying the sender's
+prefix, the way modules send a message per user, once with the prefix
+rebuilt for every call (as it was before prefixes were cached) and once with
+the cached prefix.
+
+Run from the repository root:
+    python benchmarks/prefix.py [--users N] [--messages N]
+"""
+
+import argparse, os, shutil, sys, tempfile, time
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from twisted.internet import address, reactor
+from twisted.test.proto_helpers import StringTransport
+from txircd.ircd import IRCD
+
+def make_ircd():
+    options = {
+        "server_name": "bench.server",
+        "server_modules": ["cmd_join", "cmd_nick", "cmd_user"],
+        "client_peer_exempt": {"127.0.0.1": 0},
+        "client_dns_timeout": 1,
+        "app_log_dir": "logs"
+    }
+    return IRCD("benchmark.yaml", options)
+
+def connect_users(ircd, count):
+    users = []
+    for i in xrange(count):
+        peer = address.IPv4Address("TCP", "127.0.0.1", 10000 + i)
+        protocol = ircd.buildProtocol(peer)
+        protocol.makeConnection(StringTransport(peerAddress=peer))
+        protocol.dataReceived("NICK bench{0}\r\nUSER bench{0} 0 * :Benchmark user\r\n".format(i))
+        users.append(protocol)
+    # Registration waits on the hostname lookup, so run the reactor until everyone is in
+    deadline = time.time() + 30
+    while len(ircd.users) < count and time.time() < deadline:
+        reactor.iterate(0.01)
+    return [ircd.users["bench{}".format(i)] for i in xrange(count) if "bench{}".format(i) in ircd.users]
+
+def broadcast(sender, recipients, messages, rebuild):
+    start = time.time()
+    for i in xrange(messages):
+        for recipient in recipients:
+            if rebuild:
+                sender.prefixString = None
+            recipient.sendMessage("PRIVMSG", ":benchmark message", to="#bench", prefix=sender.prefix())
+        for recipient in recipients:
+            recipient.socket.transport.clear()
+    return time.time() - start
+
+def run(userCount, messageCount):
+    ircd = make_ircd()
+    reactor.startRunning()
+    users = connect_users(ircd, userCount)
+    if len(users) < userCount:
+        print "Only {} of {} users registered; results are for the smaller channel".format(len(users), userCount)
+    for user in users:
+        user.socket.dataReceived("JOIN #bench\r\n")
+        user.socket.transport.clear()
+    sender = users[0]
+    recipients = ircd.channels["#bench"].users.keys()
+    broadcast(sender, recipients, 1, False) # Warm up
+    rebuilt = broadcast(sender, recipients, messageCount, True)
+    cached = broadcast(sender, recipients, messageCount, False)
+    lines = len(recipients) * messageCount
+    print "{} recipients, {} messages ({} lines)".format(len(recipients), messageCount, lines)
+    print "prefix rebuilt per line: {:.3f}s ({:.2f}us/line)".format(rebuilt, rebuilt / lines * 1000000)
+    print "cached prefix:           {:.3f}s ({:.2f}us/line)".format(cached, cached / lines * 1000000)
+    print "saving:                  {:.1f}%".format((rebuilt - cached) / rebuilt * 100 if rebuilt else 0)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--messages", type=int, default=50)
+    args = parser.parse_args()
+    # The IRCd writes its data and logs to the working directory, so keep those out of the repository
+    workDir = tempfile.mkdtemp()
+    os.chdir(workDir)
+    try:
+        run(args.users, args.messages)
+    finally:
+        shutil.rmtree(workDir)
+    sys.stdout.flush()
+    os._exit(0) # Don't wait on the IRCd's timers and threads
@@ -0,0 +1,84 @@
+"""
+Measures how long the IRCd takes to start (reading its saved data and
+loading its modules) and to reload its modules on rehash.  Each run builds a
+new IRCd the way a restart does, and the modules that took longest to load
+across the runs are listed.  Rehash is timed both reloading every module (as
+when the config has changed) and reloading only modules whose source changed.
+
+Run from the repository root:
+    python benchmarks/startup.py [--runs N] [--spec rfc1459|ircv3] [--modules ...]
+"""
+
+import argparse, os, shutil, sys, tempfile, time
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from txircd.ircd import IRCD
+
+# Modules that need extra dependencies or bind ports of their own are left out of the default set
+skipped_modules = ["db_services", "db_services_leaf", "manhole", "metrics"]
+
+def optional_modules():
+    moduleDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "txircd", "modules")
+    return sorted([fileName[:-3] for fileName in os.listdir(moduleDir) if fileName.endswith(".py") and fileName[:-3] not in skipped_modules])
+
+def make_ircd(spec, modules):
+    options = {
+        "server_name": "bench.server",
+        "server_modules": modules,
+        "app_irc_spec": spec,
+        "app_log_dir": "logs",
+        "app_log_categories": [],
+        "app_data_save_interval": 0
+    }
+    return IRCD("benchmark.yaml", options)
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) / 2]
+
+def run(runs, spec, modules):
+    startTimes = []
+    moduleTimes = {}
+    ircd = None
+    for i in xrange(runs):
+        start = time.time()
+        ircd = make_ircd(spec, modules)
+        startTimes.append(time.time() - start)
+        for name, loadTime in ircd.module_load_times.iteritems():
+            if name not in moduleTimes:
+                moduleTimes[name] = []
+            moduleTimes[name].append(loadTime)
+    print "{} modules loaded, {} runs".format(len(ircd.modules), runs)
+    print "startup: best {:.1f}ms, median {:.1f}ms".format(min(startTimes) * 1000, median(startTimes) * 1000)
+    print "slowest modules (median):"
+    slowest = sorted([(median(times), name) for name, times in moduleTimes.iteritems()], reverse=True)[:10]
+    for loadTime, name in slowest:
+        print "  {:<24}{:>8.2f}ms".format(name, loadTime * 1000)
+    fullReloads = []
+    changedReloads = []
+    for i in xrange(runs):
+        start = time.time()
+        ircd.all_module_load()
+        fullReloads.append(time.time() - start)
+        start = time.time()
+        ircd.all_module_load(True)
+        changedReloads.append(time.time() - start)
+    print "rehash reloading every module:      median {:.1f}ms".format(median(fullReloads) * 1000)
+    print "rehash reloading changed modules:   median {:.1f}ms".format(median(changedReloads) * 1000)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--spec", choices=["rfc1459", "ircv3"], default="ircv3")
+    parser.add_argument("--modules", nargs="*", help="Optional modules to load (default: all that don't need extra setup)")
+    args = parser.parse_args()
+    modules = args.modules if args.modules is not None else optional_modules()
+    # The IRCd writes its data and logs to the working directory, so keep those out of the repository
+    workDir = tempfile.mkdtemp()
+    os.chdir(workDir)
+    try:
+        run(args.runs, args.spec, modules)
+    finally:
+        shutil.rmtree(workDir)
+    sys.stdout.flush()
+    os._exit(0) # Don't wait on the IRCd's timers and threads
@@ -45,9 +45,7 @@ class IRCChannel(object):
             skip = kw["skip"]
         else:
             skip = []
-        for u in self.users.iterkeys():
-            if u.server == self.ircd.name and u not in skip:
-                u.sendMessage(type, *args, prefix=prefix, to=to)
+        self.ircd.broadcast([u for u in self.users.iterkeys() if u.server == self.ircd.name and u not in skip], type, *args, prefix=prefix, to=to)
         from txircd.server import ChannelMessage
         if prefix is None:
             prefix = ""
@@ -56,8 +54,8 @@ class IRCChannel(object):
         servskip = []
         for u in skip:
             servskip.append(u.uuid)
-        for server in self.ircd.servers.itervalues():
-            if server.nearHop == self.ircd.name and server.name != sourceServer:
+        for server in self.ircd.linked_servers:
+            if server.name != sourceServer:
                 server.callRemote(ChannelMessage, channel=self.name, type=type, args=args, prefix=prefix, to=to, skip=servskip)
     
     def setMode(self, user, modes, params, displayPrefix = None):
@@ -187,22 +185,16 @@ class IRCChannel(object):
                     showParams.append(mode[2])
             modeLine = "{} {}".format("".join(modestring), " ".join(showParams)) if showParams else "".join(modestring)
             if user:
-                for u in self.users.iterkeys():
-                    u.sendMessage("MODE", modeLine, to=self.name, prefix=user.prefix())
                 lineSource = user.prefix()
             elif displayPrefix:
-                for u in self.users.iterkeys():
-                    u.sendMessage("MODE", modeLine, to=self.name, prefix=displayPrefix)
                 lineSource = displayPrefix
             else:
-                for u in self.users.iterkeys():
-                    u.sendMessage("MODE", modeLine, to=self.name)
                 lineSource = self.ircd.name
+            self.ircd.broadcast(self.users.iterkeys(), "MODE", modeLine, to=self.name, prefix=lineSource)
             
             from txircd.server import SetMode
-            for server in self.ircd.servers.itervalues():
-                if server.nearHop == self.ircd.name:
-                    server.callRemote(SetMode, target=self.name, targetts=epoch(self.created), source=lineSource, modestring="".join(modestring), params=showParams)
+            for server in self.ircd.linked_servers:
+                server.callRemote(SetMode, target=self.name, targetts=epoch(self.created), source=lineSource, modestring="".join(modestring), params=showParams)
             for action in self.ircd.actions["mode"]:
                 action(self, lineSource, modeLine, modeDisplay)
             return modeLine
@@ -226,9 +218,8 @@ class IRCChannel(object):
         self.topicSetter = str(setter)
         self.topicTime = now()
         from txircd.server import SetTopic
-        for server in self.ircd.servers.itervalues():
-            if server.nearHop == self.ircd.name:
-                server.callRemote(SetTopic, channel=self.name, chants=epoch(self.created), topic=topic, topicsetter=setter, topicts=epoch(self.topicTime))
+        for server in self.ircd.linked_servers:
+            server.callRemote(SetTopic, channel=self.name, chants=epoch(self.created), topic=topic, topicsetter=setter, topicts=epoch(self.topicTime))
     
     def setMetadata(self, namespace, key, value, sourceServer = None):
         key = str(key)
@@ -241,8 +232,8 @@ class IRCChannel(object):
         for modfunc in self.ircd.actions["metadataupdate"]:
             modfunc(self, namespace, key, oldValue, value)
         from txircd.server import SetMetadata # This import is moved to here to alleviate issues with circular dependencies
-        for server in self.ircd.servers.itervalues():
-            if server.nearHop == self.ircd.name and server.name != sourceServer:
+        for server in self.ircd.linked_servers:
+            if server.name != sourceServer:
                 server.callRemote(SetMetadata, target=self.name, targetts=epoch(self.created), namespace=namespace, key=key, value=value)
     
     def delMetadata(self, namespace, key, sourceServer = None):
@@ -252,6 +243,6 @@ class IRCChannel(object):
         for modfunc in self.ircd.actions["metadataupdate"]:
             modfunc(self, namespace, key, oldValue, "")
         from txircd.server import SetMetadata
-        for server in self.ircd.servers.itervalues():
-            if server.nearHop == self.ircd.name and server.name != sourceServer:
+        for server in self.ircd.linked_servers:
+            if server.name != sourceServer:
                 server.callRemote(SetMetadata, target=self.name, targetts=epoch(self.created), namespace=namespace, key=key, value="")
\ No newline at end of file
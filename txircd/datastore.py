@@ -0,0 +1,121 @@
+from hashlib import sha1
+import cPickle, os, sqlite3, yaml
+
+whole_value_key = "" # The key used for module data that isn't a dictionary; no pickled key is empty
+removed_value = object() # Stands in for the value of a key that was removed in the changes passed to keyChanges
+
+class ModuleDataStore(object):
+    """
+    Keeps the data modules save across sessions in an SQLite database, with one
+    row for each top-level key of each module's data.  The store remembers a
+    hash of every row it has written, so each save only writes the rows that
+    changed and removes the ones that are gone rather than rewriting it all.
+    """
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.rowHashes = {}
+    
+    def connect(self):
+        connection = sqlite3.connect(self.fileName)
+        connection.execute("CREATE TABLE IF NOT EXISTS module_data (module TEXT NOT NULL, key BLOB NOT NULL, value BLOB NOT NULL, PRIMARY KEY (module, key))")
+        return connection
+    
+    def load(self, oldFileName = None):
+        """
+        Returns the saved data for all modules.  If there's no database yet,
+        the data is read from the old YAML data file instead (if given) and
+        moved into a new database straight away.
+        """
+        if not os.path.exists(self.fileName):
+            if oldFileName is None:
+                return {}
+            try:
+                with open(oldFileName, "r") as dataFile:
+                    data = yaml.safe_load(dataFile)
+            except IOError:
+                return {}
+            if data is None:
+                return {}
+            # Later saves only write what modules report changing, so everything has to be in the database from the start
+            self.write(self.changes(data))
+            return data
+        data = {}
+        connection = self.connect()
+        try:
+            for module, key, value in connection.execute("SELECT module, key, value FROM module_data"):
+                module = str(module)
+                key = str(key)
+                value = str(value)
+                self.rowHashes[(module, key)] = sha1(value).digest()
+                if key == whole_value_key:
+                    data[module] = cPickle.loads(value)
+                else:
+                    if module not in data:
+                        data[module] = {}
+                    data[module][cPickle.loads(key)] = cPickle.loads(value)
+        finally:
+            connection.close()
+        return data
+    
+    def changes(self, data):
+        """
+        Works out which rows need to be written or removed to bring the
+        database up to date with data.  The data is pickled here, so this
+        should be called where nothing else is changing the data.
+        """
+        rows = {}
+        for module, moduleData in data.iteritems():
+            if isinstance(moduleData, dict):
+                for key, value in moduleData.iteritems():
+                    rows[(module, cPickle.dumps(key, cPickle.HIGHEST_PROTOCOL))] = cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+            else:
+                rows[(module, whole_value_key)] = cPickle.dumps(moduleData, cPickle.HIGHEST_PROTOCOL)
+        updates = []
+        for row, value in rows.iteritems():
+            valueHash = sha1(value).digest()
+            if self.rowHashes.get(row) != valueHash:
+                updates.append((row, value, valueHash))
+        removals = [row for row in self.rowHashes if row not in rows]
+        return updates, removals
+    
+    def keyChanges(self, changedKeys):
+        """
+        Works out the rows to write or remove for just the keys modules have
+        reported changing, given as a dictionary mapping (module, key) to the
+        key's new value (or removed_value).  Only those values are pickled, so
+        this stays cheap however much data the modules keep.
+        """
+        updates = []
+        removals = []
+        for (module, key), value in changedKeys.iteritems():
+            row = (module, cPickle.dumps(key, cPickle.HIGHEST_PROTOCOL))
+            if value is removed_value:
+                if row in self.rowHashes:
+                    removals.append(row)
+                continue
+            value = cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+            valueHash = sha1(value).digest()
+            if self.rowHashes.get(row) != valueHash:
+                updates.append((row, value, valueHash))
+        return updates, removals
+    
+    def write(self, changes):
+        """
+        Writes the changes worked out by changes or keyChanges in a single
+        transaction.  This doesn't touch the module data, so it's safe to run
+        in a thread.
+        """
+        updates, removals = changes
+        if not updates and not removals:
+            return
+        connection = self.connect()
+        try:
+            with connection:
+                connection.executemany("INSERT OR REPLACE INTO module_data (module, key, value) VALUES (?, ?, ?)", [(module, sqlite3.Binary(key), sqlite3.Binary(value)) for (module, key), value, valueHash in updates])
+                connection.executemany("DELETE FROM module_data WHERE module = ? AND key = ?", [(module, sqlite3.Binary(key)) for module, key in removals])
+        finally:
+            connection.close()
+        for row, value, valueHash in updates:
+            self.rowHashes[row] = valueHash
+        for row in removals:
+            self.rowHashes.pop(row, None)
@@ -7,10 +7,14 @@ from twisted.internet.threads import deferToThread
 from twisted.internet.interfaces import ISSLTransport
 from twisted.python import log
 from twisted.words.protocols import irc
+from txircd.logger import logger
+from txircd.datastore import ModuleDataStore, removed_value
+from txircd.modbase import Mode
 from txircd.server import ConnectUser, IntroduceServer, ServerProtocol, protocol_version
-from txircd.utils import CaseInsensitiveDictionary, epoch, now, resolveEndpointDescription
+from txircd.utils import CaseInsensitiveDictionary, LRUCache, TimingStats, UserDictionary, chunk_message, crypt_pool, epoch, function_name, now, resolveEndpointDescription
 from txircd.user import IRCUser
 from txircd import __version__
+from time import time
 import imp, json, os, socket, yaml
 
 # Add additional numerics to complement the ones in the RFC
@@ -26,6 +30,13 @@ default_options = {
     "app_ssl_pem": "test.pem",
     "app_irc_spec": "rfc1459",
     "app_log_dir": "logs",
+    "app_crypt_threads": 2,
+    "app_log_level": "info",
+    "app_log_categories": ["link", "module", "security"],
+    "app_log_traffic_sample": 1,
+    "app_timing_stats": False,
+    "app_data_file": "data.db",
+    "app_data_save_interval": 60,
     # Server details
     "server_name": socket.getfqdn(),
     "server_description": "A txircd server",
@@ -47,6 +58,9 @@ default_options = {
     "client_ping_interval": 60,
     "client_timeout_delay": 120,
     "client_ban_msg": "You're banned! Email abuse@xyz.com for help.",
+    "client_dns_timeout": 5,
+    "client_dns_cache_size": 4096,
+    "client_dns_cache_expire": 3600,
     # Oper details
     "oper_ips": ["127.0.0.1"],
     "oper_logins": {},
@@ -91,12 +105,12 @@ class IRCProtocol(irc.IRC):
                     self.type = None
                     break
         if self.type:
+            self.type.resolveHostname()
             self.secure = ISSLTransport(self.transport, None) is not None
             self.data_checker.start(5)
             self.pinger.start(self.factory.servconfig["client_ping_interval"], now=False)
-            for server in self.factory.servers.itervalues():
-                if server.nearHop == self.factory.name:
-                    server.callRemote(ConnectUser, uuid=self.type.uuid, ip=self.type.ip, server=self.factory.name, secure=self.secure, signon=epoch(self.type.signon))
+            for server in self.factory.linked_servers:
+                server.callRemote(ConnectUser, uuid=self.type.uuid, ip=self.type.ip, server=self.factory.name, secure=self.secure, signon=epoch(self.type.signon))
 
     def dataReceived(self, data):
         if self.dead:
@@ -113,6 +127,7 @@ class IRCProtocol(irc.IRC):
         for modfunc in self.factory.actions["recvdata"]:
             modfunc(self.type, data)
         self.data += len(data)
+        self.factory.traffic_stats["bytes_in"] += len(data)
         if self.pinger.running:
             self.pinger.reset()
         irc.IRC.dataReceived(self, data)
@@ -134,7 +149,11 @@ class IRCProtocol(irc.IRC):
             self.sendMessage("PING",":{}".format(self.factory.name))
     
     def handleCommand(self, command, prefix, params):
-        log.msg("handleCommand: {!r} {!r} {!r}".format(command, prefix, params))
+        logger.traffic("handleCommand: {!r} {!r} {!r}", command, prefix, params)
+        counts = self.factory.command_counts
+        countedCommand = command if command in self.factory.commands else "(unknown)" # Don't keep a count for every made-up command clients send
+        counts[countedCommand] = counts.get(countedCommand, 0) + 1
+        self.factory.traffic_stats["lines_in"] += 1
         return self.type.handleCommand(command, prefix, params)
     
     def sendLine(self, line):
@@ -142,7 +161,9 @@ class IRCProtocol(irc.IRC):
             return
         for modfunc in self.factory.actions["senddata"]:
             modfunc(self.type, line)
-        log.msg("sendLine: {!r}".format(line))
+        logger.traffic("sendLine: {!r}", line)
+        self.factory.traffic_stats["lines_out"] += 1
+        self.factory.traffic_stats["bytes_out"] += len(line) + 2
         return irc.IRC.sendLine(self, line)
         
     def connectionLost(self, reason):
@@ -168,10 +189,21 @@ class IRCD(Factory):
         self.version = "txircd-{}".format(__version__)
         self.created = now()
         self.servers = CaseInsensitiveDictionary()
-        self.users = CaseInsensitiveDictionary()
+        self.linked_servers = []
+        self.server_routes = CaseInsensitiveDictionary()
+        self.users = UserDictionary()
         self.userid = {}
         self.channels = CaseInsensitiveDictionary()
         self.peerConnections = {}
+        self.client_connections = 0
+        # Running totals for monitoring, kept up to date as things happen so that nothing needs to be counted when they're read
+        self.traffic_stats = {
+            "bytes_in": 0,
+            "bytes_out": 0,
+            "lines_in": 0,
+            "lines_out": 0
+        }
+        self.command_counts = {}
         self.ssl_cert = sslCert
         self.client_ports = {}
         self.server_ports = {}
@@ -208,17 +240,15 @@ class IRCD(Factory):
         self.prefix_symbols = {}
         self.prefix_order = []
         self.server_commands = {}
+        self.permission_hooks = {}
+        self.permission_dispatch = { None: [] }
+        self.welcome_burst = None
+        self.module_mtimes = {}
+        self.module_load_times = {}
+        self.timing = TimingStats()
         self.module_data_cache = {}
         self.server_factory = None
         self.common_modules = set()
-        log.msg("Loading module data...")
-        try:
-            with open("data.yaml", "r") as dataFile:
-                self.serialized_data = yaml.safe_load(dataFile)
-                if self.serialized_data is None:
-                    self.serialized_data = {}
-        except IOError:
-            self.serialized_data = {}
         self.isupport = {}
         self.usercount = {
             "localmax": 0,
@@ -226,15 +256,28 @@ class IRCD(Factory):
         }
         log.msg("Loading configuration...")
         self.servconfig = {}
+        self.config_options = set()
         if not options:
             options = {}
         self.load_options(options)
+        logger.configure(self.servconfig)
+        self.timing.enabled = self.servconfig["app_timing_stats"]
         self.name = self.servconfig["server_name"]
+        self.users.localServer = self.name
+        self.dns_cache = LRUCache(self.servconfig["client_dns_cache_size"])
+        crypt_pool.adjustPoolsize(maxthreads=self.servconfig["app_crypt_threads"])
+        log.msg("Loading module data...")
+        self.data_store = ModuleDataStore(self.servconfig["app_data_file"])
+        self.serialized_data = self.data_store.load("data.yaml")
+        self.changed_data = {}
         log.msg("Loading modules...")
         self.all_module_load()
         self.save_serialized_deferred = None
         self.autoconnect_servers = LoopingCall(self.server_autoconnect)
         self.autoconnect_servers.start(60, now=False) # The server factory isn't added to here yet
+        self.autosave_data = LoopingCall(self.autosave_module_data)
+        if self.servconfig["app_data_save_interval"]:
+            self.autosave_data.start(self.servconfig["app_data_save_interval"], now=False)
         # Fill in the default ISUPPORT dictionary once config and modules are loaded, since some values depend on those
         self.isupport["CASEMAPPING"] = "rfc1459"
         self.isupport["CHANMODES"] = ",".join(["".join(modedict.keys()) for modedict in self.channel_modes])
@@ -247,8 +290,9 @@ class IRCD(Factory):
         self.isupport["STATUSMSG"] = "".join([self.prefixes[mode][0] for mode in self.prefix_order])
         self.isupport["TOPICLEN"] = "316"
         self.isupport["USERMODES"] = ",".join(["".join(modedict.keys()) for modedict in self.user_modes])
+        self.welcome_burst = None
     
-    def all_module_load(self):
+    def all_module_load(self, changedOnly = False):
         # load RFC-required modules
         rfc_spec = [
                     # commands
@@ -276,35 +320,68 @@ class IRCD(Factory):
                     "ircv3_account-notify", "ircv3_away-notify", "ircv3_extended-join", "ircv3_tls", # IRC 3.1 optional extensions
                     "ircv3_monitor", "ircv3_metadata" # IRC 3.2 base extensions
                     ]
+        self.module_load_times = {}
+        loadStart = time()
         for module in rfc_spec:
-            check = self.load_module(module)
+            check = self.load_module(module, changedOnly)
             if not check:
-                log.msg("An RFC-required capability could not be loaded!")
+                logger.msg("module", "error", "An RFC-required capability could not be loaded!")
                 raise RuntimeError("A module required for RFC compatibility could not be loaded.")
                 return
         if self.servconfig["app_irc_spec"] == "ircv3":
             for module in ircv3_spec:
-                check = self.load_module(module)
+                check = self.load_module(module, changedOnly)
                 if not check:
-                    log.msg("IRCv3 compatibility was specified, but a required IRCv3 module could not be loaded!")
+                    logger.msg("module", "error", "IRCv3 compatibility was specified, but a required IRCv3 module could not be loaded!")
                     raise RuntimeError("A module required for IRCv3 compatibility could not be loaded.")
                     return
         for module in self.servconfig["server_modules"]:
-            self.load_module(module)
+            self.load_module(module, changedOnly)
+        slowest = sorted(self.module_load_times.iteritems(), key=lambda entry: entry[1], reverse=True)[:5]
+        logger.msg("module", "info", "Loaded {} modules ({} unchanged) in {:.3f}s; slowest: {}", len(self.module_load_times), len(self.modules) - len(self.module_load_times), time() - loadStart, ", ".join(["{} {:.1f}ms".format(name, loadTime * 1000) for name, loadTime in slowest]))
     
     def rehash(self):
         log.msg("Rehashing config file and reloading modules")
         try:
             with open(self.config) as f:
-                self.load_options(yaml.safe_load(f))
-            self.all_module_load()
+                options = yaml.safe_load(f)
+            # Modules may have read their config when they were spawned, so they all need reloading if any of it changed
+            oldConfig = dict(self.servconfig)
+            self.load_options(options)
+            configChanged = self.servconfig != oldConfig
+            self.welcome_burst = None
+            logger.configure(self.servconfig)
+            self.timing.enabled = self.servconfig["app_timing_stats"]
+            self.dns_cache.resize(self.servconfig["client_dns_cache_size"])
+            crypt_pool.adjustPoolsize(maxthreads=self.servconfig["app_crypt_threads"])
+            self.all_module_load(not configChanged)
+            # Reloaded modules had their data serialized as they were unloaded, but the rest haven't yet
+            for name, spawner in self.modules.iteritems():
+                if name in self.module_load_times:
+                    continue
+                try:
+                    data_to_save, free_data = spawner.data_serialize()
+                except AttributeError:
+                    continue
+                if data_to_save:
+                    self.serialized_data[name] = data_to_save
+                elif name in self.serialized_data:
+                    del self.serialized_data[name]
             self.save_module_data()
+            if self.autosave_data.running:
+                self.autosave_data.stop()
+            if self.servconfig["app_data_save_interval"]:
+                self.autosave_data.start(self.servconfig["app_data_save_interval"], now=False)
             self.rebind_ports()
         except:
             return False
         return True
     
     def load_options(self, options):
+        # Options taken out of the config since it was last loaded go back to their defaults
+        for var in self.config_options.difference(options):
+            del self.servconfig[var]
+        self.config_options = set(options)
         for var, value in options.iteritems():
             self.servconfig[var] = value
         for var, value in default_options.iteritems():
@@ -315,16 +392,17 @@ class IRCD(Factory):
         # Track the disconnections so we know they get done
         deferreds = []
         log.msg("Disconnecting servers...")
-        for server in self.servers.values():
-            if server.nearHop == self.name:
-                server.transport.loseConnection()
-                deferreds.append(server.disconnected)
+        for server in self.linked_servers:
+            server.transport.loseConnection()
+            deferreds.append(server.disconnected)
         # Cleanly disconnect all clients
         log.msg("Disconnecting clients...")
         for u in self.users.values():
             u.sendMessage("ERROR", ":Closing Link: {} [Server shutting down]".format(u.hostname), to=None, prefix=None)
             u.socket.transport.loseConnection()
             deferreds.append(u.disconnected)
+        if self.autosave_data.running:
+            self.autosave_data.stop()
         log.msg("Unloading modules...")
         for name, spawner in self.modules.iteritems():
             try:
@@ -346,6 +424,40 @@ class IRCD(Factory):
         self.dead = True
         return DeferredList(deferreds)
     
+    def broadcast(self, users, command, *parameter_list, **kw):
+        """
+        Sends the same message to each of the given users.  The line is only
+        formatted once and written as-is to every local client; other users
+        (remote users and services) get it through their own sendMessage.
+        The prefix and to keyword arguments are the same as for sendMessage,
+        except that to is never filled in with each user's nickname.
+        """
+        prefix = kw["prefix"] if "prefix" in kw else self.name
+        to = kw["to"] if "to" in kw else None
+        arglist = [command, to] + list(parameter_list) if to else [command] + list(parameter_list)
+        line = ":{} {}".format(prefix, " ".join(arglist)) if prefix else " ".join(arglist)
+        for user in users:
+            if isinstance(user, IRCUser):
+                user.socket.sendLine(line)
+            else:
+                user.sendMessage(command, *parameter_list, prefix=prefix, to=to)
+    
+    def rebuild_server_routes(self):
+        # Only called when servers join or leave the network, so that sending to a server or to all links doesn't
+        # have to walk the server list every time
+        linked = []
+        routes = CaseInsensitiveDictionary()
+        for server in self.servers.itervalues():
+            if server.nearHop == self.name:
+                linked.append(server)
+            link = server
+            while link.nearHop != self.name and link.nearHop in self.servers:
+                link = self.servers[link.nearHop]
+            if link.nearHop == self.name:
+                routes[server.name] = link
+        self.linked_servers = linked
+        self.server_routes = routes
+    
     def connect_server(self, servername):
         def sendServerHandshake(protocol, password):
             protocol.callRemote(IntroduceServer, name=self.name, password=password, description=self.servconfig["server_description"], version=protocol_version, commonmodules=self.common_modules)
@@ -372,44 +484,49 @@ class IRCD(Factory):
     def server_autoconnect(self):
         for server in self.servconfig["serverlink_autoconnect"]:
             if server not in self.servers and server in self.servconfig["serverlinks"]:
-                log.msg("Initiating autoconnect to server {}".format(server))
+                logger.msg("link", "info", "Initiating autoconnect to server {}", server)
                 try:
                     self.connect_server(server)
                 except RuntimeError as ex:
-                    log.msg("Connection to server failed: {}".format(ex))
+                    logger.msg("link", "warning", "Connection to server failed: {}", ex)
     
-    def load_module(self, name):
-        saved_data = {}
-        if name in self.modules:
-            saved_data = self.unload_module_data(name)
+    def load_module(self, name, changedOnly = False):
+        loadStart = time()
         try:
             mod_find = imp.find_module("txircd/modules/{}".format(name))
         except ImportError as e:
-            log.msg("Module not found: {} {}".format(name, e))
+            logger.msg("module", "warning", "Module not found: {} {}", name, e)
             return False
+        modTime = os.path.getmtime(mod_find[1])
+        if changedOnly and name in self.modules and self.module_mtimes.get(name) == modTime:
+            mod_find[0].close()
+            return True # Keep the module that's already loaded, since its source hasn't changed
+        saved_data = {}
+        if name in self.modules:
+            saved_data = self.unload_module_data(name)
         try:
             mod_load = imp.load_module(name, mod_find[0], mod_find[1], mod_find[2])
         except ImportError as e:
-            log.msg("Could not load module: {} ({})".format(name, e))
+            logger.msg("module", "warning", "Could not load module: {} ({})", name, e)
             mod_find[0].close()
             return False
         mod_find[0].close()
         try:
             mod_spawner = mod_load.Spawner(self)
         except Exception as e:
-            log.msg("Module is not a valid txircd module: {} ({})".format(name, e))
+            logger.msg("module", "warning", "Module is not a valid txircd module: {} ({})", name, e)
             return False
         try:
             mod_contains = mod_spawner.spawn()
         except Exception as e:
-            log.msg("Module is not a valid txircd module: {} ({})".format(name, e))
+            logger.msg("module", "warning", "Module is not a valid txircd module: {} ({})", name, e)
             return False
         self.modules[name] = mod_spawner
         self.module_abilities[name] = mod_contains
         if "commands" in mod_contains:
             for command, implementation in mod_contains["commands"].iteritems():
                 if command in self.commands:
-                    log.msg("Module {} tries to reimplement command {}".format(name, command))
+                    logger.msg("module", "warning", "Module {} tries to reimplement command {}", name, command)
                     continue
                 self.commands[command] = implementation.hook(self)
         if "modes" in mod_contains:
@@ -427,29 +544,29 @@ class IRCD(Factory):
                 elif mode[1] == "s":
                     modetype = -1
                 else:
-                    log.msg("Module {} registers a mode of an invalid type".format(name))
+                    logger.msg("module", "warning", "Module {} registers a mode of an invalid type", name)
                     continue
                 if mode[0] == "c":
                     if mode[2] in self.channel_mode_type:
-                        log.msg("Module {} tries to reimplement channel mode {}".format(name, mode))
+                        logger.msg("module", "warning", "Module {} tries to reimplement channel mode {}", name, mode)
                         continue
                     if modetype >= 0:
                         self.channel_modes[modetype][mode[2]] = implementation.hook(self)
                     else:
                         if len(mode) < 5:
-                            log.msg("Module {} tries to register a prefix without a symbol or level".format(name))
+                            logger.msg("module", "warning", "Module {} tries to register a prefix without a symbol or level", name)
                             continue
                         try:
                             level = int(mode[4:])
                         except:
-                            log.msg("Module {} tries to register a prefix without a numeric level".format(name))
+                            logger.msg("module", "warning", "Module {} tries to register a prefix without a numeric level", name)
                             continue
                         closestLevel = 0
                         closestModeChar = None
                         orderFail = False
                         for levelMode, levelData in self.prefixes.iteritems():
                             if level == levelData[1]:
-                                log.msg("Module {} tries to register a prefix with the same rank level as an existing prefix")
+                                logger.msg("module", "warning", "Module {} tries to register a prefix with the same rank level as an existing prefix", name)
                                 orderFail = True
                                 break
                             if levelData[1] < level and levelData[1] > closestLevel:
@@ -468,10 +585,10 @@ class IRCD(Factory):
                     self.isupport["STATUSMSG"] = "".join([self.prefixes[mode][0] for mode in self.prefix_order])
                 elif mode[0] == "u":
                     if modetype == -1:
-                        log.msg("Module {} registers a mode of an invalid type".format(name))
+                        logger.msg("module", "warning", "Module {} registers a mode of an invalid type", name)
                         continue
                     if mode[2] in self.user_mode_type:
-                        log.msg("Module {} tries to reimplement user mode {}".format(name, mode))
+                        logger.msg("module", "warning", "Module {} tries to reimplement user mode {}", name, mode)
                         continue
                     self.user_modes[modetype][mode[2]] = implementation.hook(self)
                     self.user_mode_type[mode[2]] = modetype
@@ -479,12 +596,23 @@ class IRCD(Factory):
             for actiontype, actionfunc in mod_contains["actions"].iteritems():
                 if actiontype not in self.actions:
                     self.actions[actiontype] = []
+                if self.timing.enabled:
+                    actionfunc = self.timing.wrap("hook", "{} {}".format(actiontype, function_name(actionfunc)), actionfunc)
                 self.actions[actiontype].append(actionfunc)
         if "server" in mod_contains:
             for commandtype, commandfunc in mod_contains["server"].iteritems():
                 if commandtype not in self.server_commands:
                     self.server_commands[commandtype] = []
                 self.server_commands[commandtype].append(commandfunc)
+        if "permissions" in mod_contains:
+            for command, permfunc in mod_contains["permissions"].iteritems():
+                if command not in self.permission_hooks:
+                    self.permission_hooks[command] = []
+                if self.timing.enabled:
+                    permfunc = self.timing.wrap("hook", "permission {}".format(function_name(permfunc)), permfunc)
+                self.permission_hooks[command].append(permfunc)
+        self.rebuild_permission_dispatch()
+        self.welcome_burst = None
         if "common" in mod_contains and mod_contains["common"]:
             self.common_modules.add(name)
         if not saved_data and name in self.serialized_data:
@@ -494,6 +622,9 @@ class IRCD(Factory):
                 mod_spawner.data_unserialize(saved_data)
             except AttributeError:
                 pass
+        self.module_mtimes[name] = modTime
+        self.module_load_times[name] = time() - loadStart
+        logger.msg("module", "debug", "Loaded module {} in {:.1f}ms", name, self.module_load_times[name] * 1000)
         return True
     
     def unload_module_data(self, name):
@@ -518,6 +649,7 @@ class IRCD(Factory):
         abilities = self.module_abilities[name]
         del self.module_abilities[name]
         del self.modules[name]
+        del self.module_mtimes[name]
         if "commands" in abilities:
             for command, implementation in abilities["commands"].iteritems():
                 if self.commands[command] == implementation:
@@ -559,11 +691,98 @@ class IRCD(Factory):
             for command, function in abilities["server"].iteritems():
                 if command in self.server_commands and function in self.server_commands[command]:
                     self.server_commands[command].remove(function)
+        if "permissions" in abilities:
+            for command, function in abilities["permissions"].iteritems():
+                if command in self.permission_hooks and function in self.permission_hooks[command]:
+                    self.permission_hooks[command].remove(function)
+        self.rebuild_permission_dispatch()
+        self.welcome_burst = None
         return all_data
     
+    def rebuild_permission_dispatch(self):
+        # Work out once, rather than on every command, which permission checks apply to each command.  Checks for
+        # every command are under None; commands with checks of their own get a list of their own.
+        everyCommand = list(self.actions["commandpermission"])
+        commandChecks = {}
+        for command, functions in self.permission_hooks.iteritems():
+            commandChecks[command] = list(functions)
+        modeChecks = []
+        for modeset in self.channel_modes + self.user_modes:
+            for implementation in modeset.itervalues():
+                if implementation.checkPermission.im_func is Mode.checkPermission.im_func:
+                    continue # The default implementation doesn't do anything
+                modeChecks.append(implementation)
+        for implementation in modeChecks:
+            if implementation.affectedCommands is None:
+                continue
+            for command in implementation.affectedCommands:
+                if command not in commandChecks:
+                    commandChecks[command] = []
+        dispatch = {}
+        for command in [None] + commandChecks.keys():
+            checks = everyCommand + commandChecks.get(command, [])
+            for implementation in modeChecks:
+                if implementation.affectedCommands is None or command in implementation.affectedCommands:
+                    checks.append(implementation.checkPermission)
+            dispatch[command] = checks
+        self.permission_dispatch = dispatch
+    
+    def get_welcome_burst(self):
+        # The parts of the welcome burst that are the same for every client are built once and kept until the
+        # config is reloaded or a module is loaded or unloaded.  Modules change ISUPPORT tokens and modes only
+        # while loading or unloading; anything else that changes them should set welcome_burst to None.
+        if self.welcome_burst is not None:
+            return self.welcome_burst
+        chanmodelist = "".join(["".join(modedict.keys()) for modedict in self.channel_modes]) + "".join(self.prefixes.keys())
+        usermodelist = "".join(["".join(modedict.keys()) for modedict in self.user_modes])
+        info = [
+            (irc.RPL_YOURHOST, ":Your host is {}, running version {}".format(self.servconfig["server_network_name"], self.version)),
+            (irc.RPL_CREATED, ":This server was created {}".format(self.created)),
+            (irc.RPL_MYINFO, self.servconfig["server_network_name"], self.version, usermodelist, chanmodelist) # usermodes & channel modes
+        ]
+        tokens = []
+        for key, value in self.isupport.iteritems():
+            if value is None:
+                tokens.append(key)
+            else:
+                tokens.append("{}={}".format(key, value))
+        # Leave room for the longest nickname so the same lines fit for every client
+        prevar_len = len(" ".join([self.name, irc.RPL_ISUPPORT, "x" * 32])) + 31 # including ":are supported by this server"
+        isupport = []
+        thisline = []
+        lineLength = 0
+        for token in tokens:
+            if thisline and lineLength + len(token) + prevar_len > 509:
+                isupport.append((irc.RPL_ISUPPORT, " ".join(thisline), ":are supported by this server"))
+                thisline = []
+                lineLength = 0
+            elif thisline:
+                lineLength += 1
+            thisline.append(token)
+            lineLength += len(token)
+        if thisline:
+            isupport.append((irc.RPL_ISUPPORT, " ".join(thisline), ":are supported by this server"))
+        if "server_motd" in self.servconfig and self.servconfig["server_motd"]:
+            lineFormat = ":- {{:{!s}}} -".format(self.servconfig["server_motd_line_length"]) # Dynamically inject the line length as a width argument for the line
+            motd = [(irc.RPL_MOTDSTART, ":- {} Message of the day - ".format(self.servconfig["server_network_name"]))]
+            for chunk in chunk_message(self.servconfig["server_motd"], self.servconfig["server_motd_line_length"]):
+                motd.append((irc.RPL_MOTD, lineFormat.format(chunk)))
+            motd.append((irc.RPL_ENDOFMOTD, ":End of MOTD command"))
+        else:
+            motd = [(irc.ERR_NOMOTD, ":MOTD File is missing")]
+        self.welcome_burst = {
+            "info": info,
+            "isupport": isupport,
+            "motd": motd
+        }
+        return self.welcome_burst
+    
     def save_module_data(self):
         if self.save_serialized_deferred is None or self.save_serialized_deferred.called:
-            self.save_serialized_deferred = deferToThread(self.save_serialized)
+            # Work out what changed here, since modules may change their data while the thread is writing
+            self.save_serialized_deferred = deferToThread(self.data_store.write, self.data_store.changes(self.serialized_data))
+            self.save_serialized_deferred.addErrback(self.data_save_failed, self.changed_data)
+            self.changed_data = {} # Everything the modules reported changing is covered by this save
             return True
         # Otherwise, there's a save currently happening.  This likely means that
         #  1. We don't need to save now; not THAT much has changed
@@ -577,8 +796,50 @@ class IRCD(Factory):
         return False
     
     def save_serialized(self, _ = None):
-        with open("data.yaml", "w") as dataFile:
-            yaml.safe_dump(self.serialized_data, dataFile, default_flow_style=False)
+        self.data_store.write(self.data_store.changes(self.serialized_data))
+    
+    def data_changed(self, module, key, value):
+        """
+        Records that a key of a module's saved data has been set to value, so
+        that it's written at the next autosave without the rest of the
+        module's data being looked at.
+        """
+        self.changed_data[(module, key)] = value
+    
+    def data_removed(self, module, key):
+        """
+        Records that a key has been removed from a module's saved data, so
+        that it's removed from the data file at the next autosave.
+        """
+        self.changed_data[(module, key)] = removed_value
+    
+    def autosave_module_data(self):
+        # Writes only the keys modules have reported changing since the last save
+        if not self.changed_data:
+            return
+        if self.save_serialized_deferred is not None and not self.save_serialized_deferred.called:
+            return # The changes are kept for the next autosave
+        changes = self.data_store.keyChanges(self.changed_data)
+        self.save_serialized_deferred = deferToThread(self.data_store.write, changes)
+        self.save_serialized_deferred.addErrback(self.data_save_failed, self.changed_data)
+        self.changed_data = {}
+    
+    def data_save_failed(self, err, changedKeys):
+        logger.msg("module", "error", "Could not save module data: {}", err.getErrorMessage())
+        # Put the keys back so they're tried again at the next autosave, unless they've been changed again since
+        for key, value in changedKeys.iteritems():
+            if key not in self.changed_data:
+                self.changed_data[key] = value
+    
+    def dump_timing_stats(self):
+        # Writes the command, hook, and responder timings out for other tools to read
+        logDir = self.servconfig["app_log_dir"]
+        if not os.path.isdir(logDir):
+            os.makedirs(logDir)
+        dumpFileName = os.path.join(logDir, "timing.json")
+        with open(dumpFileName, "w") as dumpFile:
+            json.dump(self.timing.dump(), dumpFile, indent=2, sort_keys=True)
+        return dumpFileName
     
     def saveClientPort(self, desc, port):
         if desc in self.client_ports:
@@ -643,12 +904,14 @@ class IRCD(Factory):
         connections = self.peerConnections.get(ip, 0)
         maxConnections = self.servconfig["client_peer_exempt"][ip] if ip in self.servconfig["client_peer_exempt"] else self.servconfig["client_peer_connections"]
         if maxConnections and connections >= maxConnections:
-            log.msg("A client at IP address {} has exceeded the session limit".format(ip))
+            logger.msg("security", "info", "A client at IP address {} has exceeded the session limit", ip)
             return None
         self.peerConnections[ip] = connections + 1
+        self.client_connections += 1
         newProtocol = IRCProtocol(ip)
         newProtocol.factory = self
         return newProtocol
 
     def unregisterProtocol(self, p):
         self.peerConnections[p.ip] -= 1
+        self.client_connections -= 1
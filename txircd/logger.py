@@ -0,0 +1,54 @@
+from twisted.python import log
+
+log_levels = {
+    "debug": 10,
+    "info": 20,
+    "warning": 30,
+    "error": 40
+}
+
+class CategoryLogger(object):
+    """
+    Sits in front of twisted's log so that messages are only formatted and
+    passed on when their category is turned on and they're at or above the
+    configured level.  Message formatting is done with str.format using the
+    extra arguments, so pass those instead of formatting the message first.
+    """
+    def __init__(self):
+        self.level = log_levels["info"]
+        self.categories = set()
+        self.logTraffic = False
+        self.trafficSample = 1
+        self.trafficCount = 0
+    
+    def configure(self, config):
+        self.level = log_levels.get(str(config["app_log_level"]).lower(), log_levels["info"])
+        self.categories = set(config["app_log_categories"])
+        self.logTraffic = "traffic" in self.categories
+        try:
+            self.trafficSample = max(1, int(config["app_log_traffic_sample"]))
+        except (TypeError, ValueError):
+            self.trafficSample = 1
+        self.trafficCount = 0
+    
+    def enabled(self, category, level = "info"):
+        return category in self.categories and log_levels[level] >= self.level
+    
+    def msg(self, category, level, message, *args, **kw):
+        if category not in self.categories or log_levels[level] < self.level:
+            return
+        if args or kw:
+            message = message.format(*args, **kw)
+        log.msg(message, system=category)
+    
+    def traffic(self, message, *args):
+        # This is called for every line to and from every client, so it needs to bail out as quickly as possible
+        if not self.logTraffic:
+            return
+        self.trafficCount += 1
+        if self.trafficCount < self.trafficSample:
+            return
+        self.trafficCount = 0
+        self.msg("traffic", "info", message, *args)
+
+logger = CategoryLogger()
@@ -11,6 +11,7 @@ class Module(object):
         return self
 
 class Mode(object):
+    affectedCommands = None # The commands checkPermission should be called for; None means every command
     def hook(self, base):
         self.ircd = base
         return self
@@ -11,13 +11,15 @@ class BadwordCommand(Command):
         self.badwords = {}
     
     def onUse(self, user, data):
+        badword = data["badword"]
         if "replacement" in data:
-            badword = data["badword"]
             replacement = data["replacement"]
             self.badwords[badword] = replacement
+            self.ircd.data_changed("badword", badword, replacement)
             user.sendMessage(irc.RPL_BADWORDADDED, badword, ":{}".format(replacement))
         else:
             del self.badwords[badword]
+            self.ircd.data_removed("badword", badword)
             user.sendMessage(irc.RPL_BADWORDREMOVED, badword, ":Badword removed")
     
     def processParams(self, user, params):
@@ -30,7 +32,7 @@ class BadwordCommand(Command):
         if not params:
             user.sendMessage(irc.ERR_NEEDMOREPARAMS, "BADWORD", ":Not enough parameters")
             return {}
-        if param[0][0] == "-":
+        if params[0][0] == "-":
             badword = params[0][1:]
             if badword not in self.badwords:
                 user.sendMessage(irc.ERR_NOSUCHBADWORD, badword, ":No such badword")
@@ -73,8 +75,10 @@ class Spawner(object):
             "commands": {
                 "BADWORD": self.badwordCmd,
             },
-            "actions": {
-                "commandpermission": self.badwordCmd.censor
+            "permissions": {
+                "PRIVMSG": self.badwordCmd.censor,
+                "NOTICE": self.badwordCmd.censor,
+                "TOPIC": self.badwordCmd.censor
             }
         }
     
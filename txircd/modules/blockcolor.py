@@ -1,6 +1,8 @@
 from txircd.modbase import Mode
 
 class BlockColor(Mode):
+    affectedCommands = ["PRIVMSG", "NOTICE"]
+    
     def checkPermission(self, user, cmd, data):
         if cmd not in ["PRIVMSG", "NOTICE"]:
             return data
@@ -1,6 +1,8 @@
 from txircd.modbase import Mode
 
 class BlockCTCP(Mode):
+    affectedCommands = ["PRIVMSG", "NOTICE"]
+    
     def has_CTCP(self, msg):
         if chr(1) not in msg:
             return False
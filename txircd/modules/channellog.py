@@ -1,23 +1,340 @@
-from twisted.python.logfile import DailyLogFile
-from txircd.modbase import Module
-from txircd.utils import CaseInsensitiveDictionary, now
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+from twisted.internet.threads import deferToThread, deferToThreadPool
+from twisted.python.logfile import BaseLogFile, DailyLogFile
+from twisted.python.threadpool import ThreadPool
+from twisted.words.protocols import irc
+from txircd.logger import logger
+from txircd.modbase import Command, Module
+from txircd.utils import CaseInsensitiveDictionary, LRUCache, irc_lower, now
+from datetime import date, timedelta
+from threading import Lock
+from time import gmtime
+import json, os, re, zlib
+
+archive_block_size = 65536 # How much log text goes into each compressed block of an archive
+
+def archive_log(path):
+    """
+    Compresses a rotated day's log file into an archive, path.zlog, made up of
+    separately compressed blocks of lines, and writes an index of each block's
+    offset, length, and earliest and latest line times to path.zidx.  The
+    original file is removed once the archive is complete.
+    """
+    if os.path.exists("{}.zlog".format(path)):
+        return # Don't replace an archive that's already there
+    blocks = []
+    with open(path, "r") as logFile, open("{}.zlog.tmp".format(path), "wb") as archiveFile:
+        blockLines = []
+        blockSize = 0
+        for line in logFile:
+            blockLines.append(line)
+            blockSize += len(line)
+            if blockSize >= archive_block_size:
+                blocks.append(write_archive_block(archiveFile, blockLines))
+                blockLines = []
+                blockSize = 0
+        if blockLines:
+            blocks.append(write_archive_block(archiveFile, blockLines))
+    with open("{}.zidx.tmp".format(path), "w") as indexFile:
+        json.dump({ "blocks": blocks }, indexFile)
+    # The index goes in place first so that the archive is never there without it
+    os.rename("{}.zidx.tmp".format(path), "{}.zidx".format(path))
+    os.rename("{}.zlog.tmp".format(path), "{}.zlog".format(path))
+    os.remove(path)
+
+def write_archive_block(archiveFile, lines):
+    offset = archiveFile.tell()
+    archiveFile.write(zlib.compress("".join(lines)))
+    # Line times don't always increase through a file (lines logged just before midnight can be written after it), so the index can't just use the first and last
+    lineTimes = [line_time(line) for line in lines]
+    return [min(lineTimes), max(lineTimes), offset, archiveFile.tell() - offset]
+
+def line_time(line):
+    # Log lines start with the time they were logged, e.g. [12:34:56]
+    return line[1:9]
+
+def read_archive(path, startTime, endTime):
+    """
+    Yields the lines of an archive made by archive_log, decompressing only the
+    blocks that have lines between startTime and endTime (as HH:MM:SS strings)
+    one at a time.
+    """
+    with open("{}.zidx".format(path), "r") as indexFile:
+        blocks = json.load(indexFile)["blocks"]
+    with open("{}.zlog".format(path), "rb") as archiveFile:
+        for firstTime, lastTime, offset, length in blocks:
+            # Older indexes hold each block's first and last line times instead, so a block that wraps past midnight has to be read
+            if firstTime <= lastTime and (lastTime < startTime or firstTime > endTime):
+                continue
+            archiveFile.seek(offset)
+            for line in zlib.decompress(archiveFile.read(length)).splitlines():
+                yield line
+
+def read_log(path):
+    with open(path, "r") as logFile:
+        for line in logFile:
+            yield line.rstrip("\n")
+
+def log_path(logDir, channel):
+    """
+    Returns the path of a channel's log file, or None if the name isn't one
+    that could have a log file of its own in logDir.
+    """
+    if not channel or channel[0] != "#" or "/" in channel or "\\" in channel or "\0" in channel or ".." in channel:
+        return None
+    logDir = os.path.realpath(logDir)
+    path = os.path.realpath(os.path.join(logDir, channel))
+    if os.path.dirname(path) != logDir:
+        return None
+    return path
+
+class ChannelLogFile(DailyLogFile):
+    """
+    A channel's daily log file.  Its days follow the UTC times the lines are
+    stamped with, and the writer moves it on to a new day by the date of the
+    lines it's writing rather than by the clock, so lines that are written
+    out just after midnight still go in the day they were logged.
+    """
+    def toDate(self, *args):
+        return gmtime(*args)[:3]
+    
+    def shouldRotate(self):
+        return False # The writer rotates the file when it gets to lines from a later day
+    
+    def write(self, data):
+        BaseLogFile.write(self, data) # Unlike DailyLogFile, leave lastDate to the writer
+
+class LogSearchCommand(Command):
+    def __init__(self):
+        self.searching = set()
+        self.stopped = False
+    
+    def onUse(self, user, data):
+        self.searching.add(user.uuid)
+        user.sendMessage("NOTICE", ":Searching the logs for {} from {} to {}...".format(data["channel"], data["startDate"].isoformat(), data["endDate"].isoformat()))
+        searchDeferred = deferToThread(self.search, user.uuid, data)
+        searchDeferred.addCallback(self.searchFinished, user.uuid)
+        searchDeferred.addErrback(self.searchFailed, user.uuid)
+    
+    def processParams(self, user, params):
+        if user.registered > 0:
+            user.sendMessage(irc.ERR_NOTREGISTERED, "LOGSEARCH", ":You have not registered")
+            return {}
+        if "o" not in user.mode:
+            user.sendMessage(irc.ERR_NOPRIVILEGES, ":Permission denied - You do not have the correct operator privileges")
+            return {}
+        if len(params) < 3:
+            user.sendMessage(irc.ERR_NEEDMOREPARAMS, "LOGSEARCH", ":Not enough parameters")
+            return {}
+        if user.uuid in self.searching:
+            user.sendMessage("NOTICE", ":You already have a log search running.")
+            return {}
+        try:
+            dates = [date(*[int(part) for part in day.split("-")]) for day in params[1].split("..", 1)]
+        except (TypeError, ValueError):
+            user.sendMessage("NOTICE", ":Usage: LOGSEARCH <channel> <YYYY-MM-DD>[..<YYYY-MM-DD>] [HH:MM-HH:MM] <text>")
+            return {}
+        startDate = dates[0]
+        endDate = dates[-1]
+        if endDate < startDate or (endDate - startDate).days >= self.ircd.servconfig["channellog_search_max_days"]:
+            user.sendMessage("NOTICE", ":Log searches can cover at most {} days.".format(self.ircd.servconfig["channellog_search_max_days"]))
+            return {}
+        startTime = "00:00:00"
+        endTime = "23:59:59"
+        text = params[2:]
+        timeMatch = re.match(r"(\d\d:\d\d)-(\d\d:\d\d)$", params[2])
+        if timeMatch and len(params) > 3:
+            startTime = "{}:00".format(timeMatch.group(1))
+            endTime = "{}:59".format(timeMatch.group(2))
+            text = params[3:]
+        channel = self.ircd.channels[params[0]].name if params[0] in self.ircd.channels else params[0]
+        if not log_path(self.ircd.servconfig["app_log_dir"], channel):
+            user.sendMessage(irc.ERR_BADCHANMASK, channel, ":Bad Channel Mask")
+            return {}
+        return {
+            "user": user,
+            "channel": channel,
+            "startDate": startDate,
+            "endDate": endDate,
+            "startTime": startTime,
+            "endTime": endTime,
+            "text": " ".join(text).lower()
+        }
+    
+    def search(self, uuid, data):
+        # This runs in a thread, so it works through one day and one archive block at a time and passes each match back to the reactor as it's found
+        logPath = log_path(self.ircd.servconfig["app_log_dir"], data["channel"])
+        maxResults = self.ircd.servconfig["channellog_search_max_results"]
+        today = gmtime()[:3] # The live log file's days follow the lines' UTC timestamps
+        results = 0
+        day = data["startDate"]
+        while day <= data["endDate"]:
+            dayPath = "{}.{}".format(logPath, "_".join([str(day.year), str(day.month), str(day.day)]))
+            if os.path.exists("{}.zlog".format(dayPath)):
+                lines = read_archive(dayPath, data["startTime"], data["endTime"])
+            elif os.path.exists(dayPath):
+                lines = read_log(dayPath)
+            elif (day.year, day.month, day.day) == today and os.path.exists(logPath):
+                lines = read_log(logPath)
+            else:
+                lines = []
+            try:
+                for line in lines:
+                    if self.stopped:
+                        return results
+                    lineTime = line_time(line)
+                    if lineTime < data["startTime"] or lineTime > data["endTime"] or data["text"] not in line.lower():
+                        continue
+                    reactor.callFromThread(self.sendResult, uuid, "[{} {}".format(day.isoformat(), line[1:]))
+                    results += 1
+                    if results >= maxResults:
+                        return results
+            except (IOError, OSError):
+                pass # The file was rotated or archived while we were looking for it
+            day += timedelta(days=1)
+        return results
+    
+    def sendResult(self, uuid, line):
+        if uuid in self.ircd.userid:
+            self.ircd.userid[uuid].sendMessage("NOTICE", ":{}".format(line))
+    
+    def searchFinished(self, results, uuid):
+        self.searching.discard(uuid)
+        if uuid not in self.ircd.userid:
+            return
+        if results >= self.ircd.servconfig["channellog_search_max_results"]:
+            self.ircd.userid[uuid].sendMessage("NOTICE", ":Search stopped after {} matches.".format(results))
+        else:
+            self.ircd.userid[uuid].sendMessage("NOTICE", ":Search finished: {} matches.".format(results))
+    
+    def searchFailed(self, err, uuid):
+        self.searching.discard(uuid)
+        logger.msg("module", "error", "channellog log search failed: {}", err.getErrorMessage())
+        if uuid in self.ircd.userid:
+            self.ircd.userid[uuid].sendMessage("NOTICE", ":The search failed: {}".format(err.getErrorMessage()))
 
 class Logger(Module):
-    # This is to help save from excessive disk I/O by holding the log files instead of constantly opening/flushing/closing them
-    logfiles = CaseInsensitiveDictionary()
+    def __init__(self, maxOpenFiles):
+        # This is to help save from excessive disk I/O by holding the log files instead of constantly opening/flushing/closing them
+        # Only the most recently written ones are held so that quiet channels don't use up file descriptors; the rest are reopened when needed
+        # The log files are only touched by whatever's holding writeLock, which is usually the writer thread
+        self.logfiles = LRUCache(maxOpenFiles, self.closeEvicted)
+        self.fileHits = 0
+        self.fileOpens = 0
+        self.fileEvictions = 0
+        self.writeLock = Lock()
+        self.pending = []
+        self.closing = set()
+        self.writing = None
+        self.closed = False
+        # The writer has its own thread so that slow disks don't hold up DNS lookups, searches, and data saves in the reactor's thread pool
+        self.writerPool = ThreadPool(1, 1, "channellog")
+        self.flusher = LoopingCall(self.flush)
+        self.linesWritten = 0
+        self.linesDropped = 0
+        self.droppedReported = 0
+        self.batchesWritten = 0
     
-    def timePrefix(self):
-        nowtime = now()
-        return "[{:02d}:{:02d}:{:02d}]".format(nowtime.hour, nowtime.minute, nowtime.second)
+    def startFlushing(self):
+        self.writerPool.start()
+        self.flusher.start(self.ircd.servconfig["channellog_flush_interval"], now=False)
     
     def writeLog(self, chan, line):
-        line = "{} {}\n".format(self.timePrefix(), line)
-        if chan.name not in self.logfiles:
-            self.logfiles[chan.name] = DailyLogFile(chan.name, self.ircd.servconfig["app_log_dir"])
-        logFile = self.logfiles[chan.name]
-        if logFile.shouldRotate():
-            logFile.rotate()
-        logFile.write(line)
+        # Lines are queued here and written out by the writer thread in batches, so the disk never holds up the reactor
+        if len(self.pending) >= self.ircd.servconfig["channellog_queue_size"]:
+            self.linesDropped += 1
+            return
+        self.pending.append((chan.name, now(), line))
+    
+    def flush(self):
+        if self.writing is not None:
+            return # The last batch is still being written; these lines will go out with the next one
+        if not self.pending and not self.closing:
+            return
+        batch = self.pending
+        closing = self.closing
+        self.pending = []
+        self.closing = set()
+        self.writing = deferToThreadPool(reactor, self.writerPool, self.writeBatch, batch, closing)
+        self.writing.addCallback(self.batchWritten)
+        self.writing.addErrback(self.batchFailed)
+    
+    def batchWritten(self, lineCount):
+        self.writing = None
+        self.linesWritten += lineCount
+        self.batchesWritten += 1
+        if self.linesDropped > self.droppedReported:
+            logger.msg("module", "warning", "channellog dropped {} lines because the write queue was full", self.linesDropped - self.droppedReported)
+            self.droppedReported = self.linesDropped
+    
+    def batchFailed(self, err):
+        self.writing = None
+        logger.msg("module", "error", "channellog could not write a batch of channel logs: {}", err.getErrorMessage())
+    
+    def writeBatch(self, batch, closing):
+        # Group the batch by channel, and each channel's lines by the day they were logged, so that each log file gets one write per day in the batch
+        channelLines = CaseInsensitiveDictionary()
+        channelOrder = []
+        for channel, lineTime, line in batch:
+            if channel not in channelLines:
+                channelLines[channel] = []
+                channelOrder.append(channel)
+            days = channelLines[channel]
+            lineDay = (lineTime.year, lineTime.month, lineTime.day)
+            if not days or days[-1][0] != lineDay:
+                days.append((lineDay, []))
+            days[-1][1].append("[{:02d}:{:02d}:{:02d}] {}\n".format(lineTime.hour, lineTime.minute, lineTime.second, line))
+        rotated = []
+        with self.writeLock:
+            for channel in channelOrder:
+                fileKey = irc_lower(channel)
+                days = channelLines[channel]
+                logFile = self.logfiles.get(fileKey)
+                if logFile is None:
+                    logFile = ChannelLogFile(channel, self.ircd.servconfig["app_log_dir"])
+                    if not os.path.getsize(logFile.path):
+                        logFile.lastDate = days[0][0] # A new file starts on the day of its first line, not the day it was made
+                    self.logfiles[fileKey] = logFile
+                    self.fileOpens += 1
+                else:
+                    self.fileHits += 1
+                for lineDay, lines in days:
+                    if lineDay > logFile.lastDate:
+                        rotatedPath = "{}.{}".format(logFile.path, logFile.suffix(logFile.lastDate))
+                        logFile.rotate()
+                        if os.path.exists(rotatedPath):
+                            rotated.append(rotatedPath)
+                        logFile.lastDate = lineDay
+                    logFile.write("".join(lines))
+                logFile.flush()
+            for channel in closing:
+                fileKey = irc_lower(channel)
+                if fileKey in self.logfiles:
+                    self.logfiles[fileKey].close()
+                    del self.logfiles[fileKey]
+            if self.closed:
+                # The module was unloaded while this batch was waiting for the writer thread, so nothing can be left open
+                for logFile in self.logfiles.itervalues():
+                    logFile.close()
+                self.logfiles.clear()
+        if self.ircd.servconfig["channellog_archive"]:
+            for rotatedPath in rotated:
+                try:
+                    archive_log(rotatedPath)
+                except (IOError, OSError, zlib.error) as e:
+                    logger.msg("module", "error", "channellog could not archive {}: {}", rotatedPath, e)
+        return len(batch)
+    
+    def closeEvicted(self, fileKey, logFile):
+        logFile.close()
+        self.fileEvictions += 1
+    
+    def statsList(self, user, statsType):
+        if statsType != "C":
+            return
+        user.sendMessage(irc.RPL_STATS, "C", ":Open log files: {}/{} Reused: {} Opened: {} Closed for space: {}".format(len(self.logfiles), self.logfiles.maxsize, self.fileHits, self.fileOpens, self.fileEvictions))
+        user.sendMessage(irc.RPL_STATS, "C", ":Queued lines: {}/{} Written: {} in {} batches Dropped: {}".format(len(self.pending), self.ircd.servconfig["channellog_queue_size"], self.linesWritten, self.batchesWritten, self.linesDropped))
     
     def logMsg(self, cmd, data):
         if cmd in ["PRIVMSG", "NOTICE"]:
@@ -64,14 +381,12 @@ class Logger(Module):
         self.writeLog(channel, "> {} has joined the channel".format(user.nickname))
     
     def logNick(self, user, oldNick):
-        for cdata in self.ircd.channels.itervalues():
-            if user in cdata.users:
-                self.writeLog(cdata, "! {} is now known as {}".format(oldNick, user.nickname))
+        for cdata in user.channels:
+            self.writeLog(cdata, "! {} is now known as {}".format(oldNick, user.nickname))
     
     def logQuit(self, user, reason):
-        for cdata in self.ircd.channels.itervalues():
-            if user in cdata.users:
-                self.writeLog(cdata, "< {} has quit: {}".format(user.nickname, reason))
+        for cdata in user.channels:
+            self.writeLog(cdata, "< {} has quit: {}".format(user.nickname, reason))
     
     def logTopic(self, channel, topic, setter):
         self.writeLog(channel, "! {} has set the channel topic: {}".format(setter, topic))
@@ -85,23 +400,52 @@ class Logger(Module):
         self.writeLog(channel, "! {} has set modes {}".format(source, modeLine))
     
     def onDestroy(self, channel):
-        if channel.name in self.logfiles:
-            self.logfiles[channel.name].close()
-            del self.logfiles[channel.name]
+        # The writer thread may be using the file, so it's closed after the next batch is written
+        self.closing.add(channel.name)
     
     def closeAllFiles(self):
-        for logFile in self.logfiles.itervalues():
-            logFile.close()
-        self.logfiles.clear()
+        if self.flusher.running:
+            self.flusher.stop()
+        # A batch already handed to the writer thread may not have started yet, so it has to know not to keep files open when it does
+        self.closed = True
+        # Waits for any batch the writer thread is still working on before writing out what's left
+        try:
+            self.writeBatch(self.pending, set())
+        except (IOError, OSError) as e:
+            logger.msg("module", "error", "channellog could not write a batch of channel logs: {}", e)
+        self.pending = []
+        with self.writeLock:
+            for logFile in self.logfiles.itervalues():
+                logFile.close()
+            self.logfiles.clear()
+        self.writerPool.stop()
 
 class Spawner(object):
     def __init__(self, ircd):
         self.ircd = ircd
         self.logger = None
+        self.logSearchCmd = None
     
     def spawn(self):
-        self.logger = Logger().hook(self.ircd)
+        if "channellog_flush_interval" not in self.ircd.servconfig:
+            self.ircd.servconfig["channellog_flush_interval"] = 1
+        if "channellog_queue_size" not in self.ircd.servconfig:
+            self.ircd.servconfig["channellog_queue_size"] = 50000
+        if "channellog_max_open_files" not in self.ircd.servconfig:
+            self.ircd.servconfig["channellog_max_open_files"] = 500
+        if "channellog_archive" not in self.ircd.servconfig:
+            self.ircd.servconfig["channellog_archive"] = False
+        if "channellog_search_max_days" not in self.ircd.servconfig:
+            self.ircd.servconfig["channellog_search_max_days"] = 31
+        if "channellog_search_max_results" not in self.ircd.servconfig:
+            self.ircd.servconfig["channellog_search_max_results"] = 200
+        self.logger = Logger(max(1, self.ircd.servconfig["channellog_max_open_files"])).hook(self.ircd)
+        self.logger.startFlushing()
+        self.logSearchCmd = LogSearchCommand()
         return {
+            "commands": {
+                "LOGSEARCH": self.logSearchCmd
+            },
             "actions": {
                 "join": self.logger.logJoin,
                 "nick": self.logger.logNick,
@@ -109,9 +453,11 @@ class Spawner(object):
                 "topic": self.logger.logTopic,
                 "mode": self.logger.logMode,
                 "commandextra": self.logger.logMsg,
-                "chandestroy": self.logger.onDestroy
+                "chandestroy": self.logger.onDestroy,
+                "statsoutput": self.logger.statsList
             }
         }
     
     def cleanup(self):
-        self.logger.closeAllFiles()
\ No newline at end of file
+        self.logSearchCmd.stopped = True
+        self.logger.closeAllFiles()
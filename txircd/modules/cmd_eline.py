@@ -1,13 +1,13 @@
 from twisted.words.protocols import irc
 from txircd.modbase import Command
-from txircd.utils import epoch, now, irc_lower, parse_duration, CaseInsensitiveDictionary
-from fnmatch import fnmatch
+from txircd.utils import epoch, irc_lower, now, parse_duration, MaskDictionary, ExpiryQueue
 
 irc.RPL_STATSELINE = "223"
 
 class ElineCommand(Command):
     def __init__(self):
-        self.exceptList = CaseInsensitiveDictionary()
+        self.exceptList = MaskDictionary()
+        self.expiry = ExpiryQueue(self.exceptList, self.lineExpired)
     
     def onUse(self, user, data):
         if "reason" in data:
@@ -17,10 +17,13 @@ class ElineCommand(Command):
                 "duration": data["duration"],
                 "reason": data["reason"]
             }
+            self.expiry.add(data["mask"])
+            self.ircd.data_changed("cmd_eline", irc_lower(data["mask"]), self.exceptList[data["mask"]])
             user.sendMessage("NOTICE", ":*** E:Line set on {}, to expire in {} seconds".format(data["mask"], data["duration"]))
         else:
             mask = data["mask"]
             del self.exceptList[mask]
+            self.ircd.data_removed("cmd_eline", irc_lower(mask))
             user.sendMessage("NOTICE", ":*** E:Line removed on {}".format(mask))
             for u in self.ircd.users.itervalues():
                 if self.match_eline(u):
@@ -37,6 +40,9 @@ class ElineCommand(Command):
                 udata.sendMessage("NOTICE", ":{}".format(self.ircd.servconfig["client_ban_msg"]))
                 udata.disconnect("Banned: Exception Removed ({})".format(reason))
     
+    def lineExpired(self, mask):
+        self.ircd.data_removed("cmd_eline", irc_lower(mask))
+    
     def processParams(self, user, params):
         if user.registered > 0:
             user.sendMessage(irc.ERR_NOTREGISTERED, "ELINE", ":You have not registered")
@@ -53,7 +59,6 @@ class ElineCommand(Command):
             banmask = "{}@{}".format(udata.username, udata.hostname)
         elif "@" not in banmask:
             banmask = "*@{}".format(banmask)
-        self.expire_elines()
         if banmask[0] == "-":
             banmask = banmask[1:]
             if not banmask:
@@ -87,7 +92,6 @@ class ElineCommand(Command):
     def statsList(self, user, statsType):
         if statsType != "E":
             return
-        self.expire_elines()
         for mask, linedata in self.exceptList.iteritems():
             user.sendMessage(irc.RPL_STATSELINES, "{} {} {} {} :{}".format(mask, linedata["created"], linedata["duration"], linedata["setter"], linedata["reason"]))
     
@@ -97,28 +101,13 @@ class ElineCommand(Command):
         return True
     
     def match_eline(self, user):
-        self.expire_elines()
-        matchMask = irc_lower("{}@{}".format(user.username, user.hostname))
-        for mask, linedata in self.exceptList.iteritems():
-            if fnmatch(matchMask, mask):
-                user.cache["except_line"] = True
-                return linedata["reason"]
-        matchMask = irc_lower("{}@{}".format(user.username, user.ip))
-        for mask, linedata in self.exceptList.iteritems():
-            if fnmatch(matchMask, mask):
-                user.cache["except_line"] = True
-                return linedata["reason"]
+        mask = self.exceptList.match("{}@{}".format(user.username, user.hostname), "{}@{}".format(user.username, user.ip))
+        if mask:
+            user.cache["except_line"] = True
+            return self.exceptList[mask]["reason"]
         user.cache["except_line"] = False
         return None
     
-    def expire_elines(self):
-        current_time = epoch(now())
-        expired = []
-        for mask, linedata in self.exceptList.iteritems():
-            if linedata["duration"] and current_time > linedata["created"] + linedata["duration"]:
-                expired.append(mask)
-        for mask in expired:
-            del self.exceptList[mask]
 
 class Spawner(object):
     def __init__(self, ircd):
@@ -142,4 +131,8 @@ class Spawner(object):
     
     def data_unserialize(self, data):
         for mask, linedata in data.iteritems():
-            self.elineCmd.exceptList[mask] = linedata
\ No newline at end of file
+            self.elineCmd.exceptList[mask] = linedata
+            self.elineCmd.expiry.add(mask)
+    
+    def cleanup(self):
+        self.elineCmd.expiry.stop()
\ No newline at end of file
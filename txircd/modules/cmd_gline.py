@@ -1,13 +1,13 @@
 from twisted.words.protocols import irc
 from txircd.modbase import Command
-from txircd.utils import epoch, now, irc_lower, parse_duration, CaseInsensitiveDictionary
-from fnmatch import fnmatch
+from txircd.utils import epoch, irc_lower, now, parse_duration, MaskDictionary, ExpiryQueue
 
 irc.RPL_STATSGLINE = "223"
 
 class GlineCommand(Command):
     def __init__(self):
-        self.banList = CaseInsensitiveDictionary()
+        self.banList = MaskDictionary()
+        self.expiry = ExpiryQueue(self.banList, self.lineExpired)
     
     def onUse(self, user, data):
         if "reason" in data:
@@ -17,20 +17,28 @@ class GlineCommand(Command):
                 "duration": data["duration"],
                 "reason": data["reason"]
             }
+            self.expiry.add(data["mask"])
+            self.ircd.data_changed("cmd_gline", irc_lower(data["mask"]), self.banList[data["mask"]])
             user.sendMessage("NOTICE", ":*** G:Line set on {}, to expire in {} seconds".format(data["mask"], data["duration"]))
+            newBan = MaskDictionary()
+            newBan[data["mask"]] = self.banList[data["mask"]]
             now_banned = {}
-            for nick, u in self.ircd.users.iteritems():
+            for u, mask in newBan.matchUsers(self.ircd.users.itervalues(), self.user_masks): # only the new line can ban anyone new
                 result = self.match_gline(u)
                 if result:
-                    now_banned[nick] = result
+                    now_banned[u.nickname] = result
             for uid, reason in now_banned.iteritems():
                 udata = self.ircd.users[uid]
                 udata.sendMessage("NOTICE", ":{}".format(self.ircd.servconfig["client_ban_msg"]))
                 udata.disconnect("G:Lined: {}".format(reason))
         else:
             del self.banList[data["mask"]]
+            self.ircd.data_removed("cmd_gline", irc_lower(data["mask"]))
             user.sendMessage("NOTICE", ":*** G:Line removed on {}".format(data["mask"]))
     
+    def lineExpired(self, mask):
+        self.ircd.data_removed("cmd_gline", irc_lower(mask))
+    
     def processParams(self, user, params):
         if user.registered > 0:
             user.sendMessage(irc.ERR_NOTREGISTERED, "GLINE", ":You have not registered")
@@ -46,7 +54,6 @@ class GlineCommand(Command):
             banmask = "{}@{}".format(user.username, user.hostname)
         elif "@" not in banmask:
             banmask = "*@{}".format(banmask)
-        self.expire_glines()
         if banmask[0] == "-":
             banmask = banmask[1:]
             if not banmask:
@@ -80,7 +87,6 @@ class GlineCommand(Command):
     def statsList(self, user, statsType):
         if statsType != "G":
             return
-        self.expire_glines()
         for mask, linedata in self.banList.iteritems():
             user.sendMessage(irc.RPL_STATSGLINE, ":{} {} {} {} :{}".format(mask, linedata["created"], linedata["duration"], linedata["setter"], linedata["reason"]))
     
@@ -101,42 +107,24 @@ class GlineCommand(Command):
             if "gline_match" in user.cache:
                 return user.cache["gline_match"]
             # Determine whether the user matches
-            self.expire_glines()
-            match_against = irc_lower("{}@{}".format(user.username, user.hostname))
-            for mask, linedata in self.banList.iteritems():
-                if fnmatch(match_against, mask):
-                    user.cache["gline_match"] = linedata["reason"]
-                    return ""
-            match_against = irc_lower("{}@{}".format(user.username, user.ip))
-            for mask in self.banList.iterkeys(): # we just removed expired lines
-                if fnmatch(match_against, mask):
-                    user.cache["gline_match"] = linedata["reason"]
-                    return ""
+            mask = self.banList.match(*self.user_masks(user))
+            if mask:
+                user.cache["gline_match"] = self.banList[mask]["reason"]
+                return ""
             return None
         else:
             if user.cache["except_line"]:
                 return None
             if "gline_match" in user.cache:
                 return user.cache["gline_match"]
-            self.expire_glines()
-            match_against = irc_lower("{}@{}".format(user.username, user.hostname))
-            for mask, linedata in self.banList.iteritems():
-                if fnmatch(match_against, mask):
-                    return linedata["reason"]
-            match_against = irc_lower("{}@{}".format(user.username, user.ip))
-            for mask in self.banList.iterkeys(): # we just removed expired lines
-                if fnmatch(match_against, mask):
-                    return linedata["reason"]
+            mask = self.banList.match(*self.user_masks(user))
+            if mask:
+                return self.banList[mask]["reason"]
             return None
     
-    def expire_glines(self):
-        current_time = epoch(now())
-        expired = []
-        for mask, linedata in self.banList.iteritems():
-            if linedata["duration"] and current_time > linedata["created"] + linedata["duration"]:
-                expired.append(mask)
-        for mask in expired:
-            del self.banList[mask]
+    def user_masks(self, user):
+        return ("{}@{}".format(user.username, user.hostname), "{}@{}".format(user.username, user.ip))
+    
 
 class Spawner(object):
     def __init__(self, ircd):
@@ -161,4 +149,8 @@ class Spawner(object):
     
     def data_unserialize(self, data):
         for mask, linedata in data.iteritems():
-            self.glineCmd.banList[mask] = linedata
\ No newline at end of file
+            self.glineCmd.banList[mask] = linedata
+            self.glineCmd.expiry.add(mask)
+    
+    def cleanup(self):
+        self.glineCmd.expiry.stop()
\ No newline at end of file
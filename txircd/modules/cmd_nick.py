@@ -10,6 +10,7 @@ class NickCommand(Command):
             if not user.nickname:
                 user.registered -= 1
             user.nickname = str(data["nick"])
+            user.prefixString = None
             if user.registered == 0:
                 user.register()
     
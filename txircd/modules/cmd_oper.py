@@ -1,6 +1,7 @@
 from twisted.words.protocols import irc
+from txircd.logger import logger
 from txircd.modbase import Command
-from txircd.utils import crypt
+from txircd.utils import deferred_crypt
 
 class OperCommand(Command):
     def onUse(self, user, data):
@@ -8,7 +9,16 @@ class OperCommand(Command):
             user.sendMessage(irc.ERR_PASSWDMISMATCH, ":Password incorrect")
             if "sendservernotice" in self.ircd.module_data_cache:
                 self.ircd.module_data_cache["sendservernotice"]("oper", "Failed OPER attempt from {} (bad username)".format(user.nickname))
-        elif self.ircd.servconfig["oper_logins"][data["username"]] != crypt(data["password"], self.ircd.servconfig["oper_logins"][data["username"]]):
+            return
+        operHash = self.ircd.servconfig["oper_logins"][data["username"]]
+        d = deferred_crypt(data["password"], operHash)
+        d.addCallback(self.checkPassword, user, operHash)
+        d.addErrback(self.hashFailed, user, data["username"])
+    
+    def checkPassword(self, hash, user, operHash):
+        if user.uuid not in self.ircd.userid:
+            return # The user disconnected while we were checking the password
+        if hash != operHash:
             user.sendMessage(irc.ERR_PASSWDMISMATCH, ":Password incorrect")
             if "sendservernotice" in self.ircd.module_data_cache:
                 self.ircd.module_data_cache["sendservernotice"]("oper", "Failed OPER attempt from {} (bad password)".format(user.nickname))
@@ -18,6 +28,11 @@ class OperCommand(Command):
             if "sendservernotice" in self.ircd.module_data_cache:
                 self.ircd.module_data_cache["sendservernotice"]("oper", "{} has opered.".format(user.nickname))
     
+    def hashFailed(self, failure, user, username):
+        logger.msg("security", "warning", "The password hash for oper {} could not be checked: {}", username, failure.getErrorMessage())
+        if user.uuid in self.ircd.userid:
+            user.sendMessage(irc.ERR_PASSWDMISMATCH, ":Password incorrect")
+    
     def processParams(self, user, params):
         if user.registered > 0:
             user.sendMessage(irc.ERR_NOTREGISTERED, "OPER", ":You have not registered")
@@ -16,9 +16,7 @@ class MessageCommand(object):
         for index, channel in enumerate(data["targetchan"]):
             if channelModifiers[index]:
                 prefixMode = self.ircd.prefix_symbols[channelModifiers[index]]
-                for u in channel.users.iterkeys():
-                    if u != user and u.hasAccess(channel, prefixMode):
-                        u.sendMessage(cmd, ":{}".format(message), to="{}{}".format(channelModifiers[index], channel.name), prefix=user.prefix())
+                self.ircd.broadcast([u for u in channel.users.iterkeys() if u != user and u.hasAccess(channel, prefixMode)], cmd, ":{}".format(message), to="{}{}".format(channelModifiers[index], channel.name), prefix=user.prefix())
             else:
                 channel.sendChannelMessage(cmd, ":{}".format(message), prefix=user.prefix(), skip=[user])
         for udata in data["targetuser"]:
@@ -0,0 +1,126 @@
+from twisted.internet import reactor
+from twisted.words.protocols import irc
+from txircd.modbase import Command
+from txircd.utils import now
+import cProfile, os, pstats
+
+class ProfileCommand(Command):
+    def __init__(self):
+        self.profiler = None
+        self.stopTimer = None
+        self.requester = None
+        self.summaryLines = 0
+    
+    def onUse(self, user, data):
+        if data["stop"]:
+            if self.profiler is None:
+                user.sendMessage("NOTICE", ":The profiler isn't running.")
+                return
+            self.stopTimer.cancel()
+            self.finish()
+            return
+        if self.profiler is not None:
+            user.sendMessage("NOTICE", ":The profiler is already running.")
+            return
+        self.requester = user.uuid
+        self.summaryLines = data["lines"]
+        self.profiler = cProfile.Profile()
+        self.stopTimer = reactor.callLater(data["duration"], self.finish)
+        self.profiler.enable()
+        user.sendMessage("NOTICE", ":Profiling for {} seconds.".format(data["duration"]))
+    
+    def processParams(self, user, params):
+        if user.registered > 0:
+            user.sendMessage(irc.ERR_NOTREGISTERED, "PROFILE", ":You have not registered")
+            return {}
+        if "o" not in user.mode:
+            user.sendMessage(irc.ERR_NOPRIVILEGES, ":Permission denied - You do not have the correct operator privileges")
+            return {}
+        if params and params[0].upper() == "STOP":
+            return {
+                "user": user,
+                "stop": True
+            }
+        try:
+            duration = int(params[0]) if params else self.ircd.servconfig["profile_default_duration"]
+            lines = int(params[1]) if len(params) > 1 else self.ircd.servconfig["profile_summary_lines"]
+        except ValueError:
+            user.sendMessage("NOTICE", ":Usage: PROFILE [seconds [lines]] or PROFILE STOP")
+            return {}
+        if duration < 1 or duration > self.ircd.servconfig["profile_max_duration"]:
+            user.sendMessage("NOTICE", ":The profile duration must be between 1 and {} seconds.".format(self.ircd.servconfig["profile_max_duration"]))
+            return {}
+        return {
+            "user": user,
+            "stop": False,
+            "duration": duration,
+            "lines": max(0, lines)
+        }
+    
+    def finish(self):
+        self.profiler.disable()
+        profiler = self.profiler
+        self.profiler = None
+        self.stopTimer = None
+        user = self.ircd.userid[self.requester] if self.requester in self.ircd.userid else None
+        self.requester = None
+        try:
+            fileName = self.writeProfile(profiler)
+        except (IOError, OSError) as e:
+            fileName = None
+            if user:
+                user.sendMessage("NOTICE", ":Could not write the profile: {}".format(e))
+        if not user:
+            return
+        stats = pstats.Stats(profiler)
+        # Sort by the time spent in each function itself, since cumulative time puts the reactor loop at the top every time
+        hotFunctions = sorted(stats.stats.iteritems(), key=lambda entry: entry[1][2], reverse=True)[:self.summaryLines]
+        user.sendMessage("NOTICE", ":Profile finished: {} calls in {:.3f}s".format(stats.total_calls, stats.total_tt))
+        for (sourceFile, line, function), (primitiveCalls, calls, selfTime, cumulativeTime, callers) in hotFunctions:
+            user.sendMessage("NOTICE", ":{:8.3f}s self {:8.3f}s total {:>8} calls  {} ({}:{})".format(selfTime, cumulativeTime, calls, function, os.path.basename(sourceFile), line))
+        if fileName:
+            user.sendMessage("NOTICE", ":Full profile written to {}".format(fileName))
+    
+    def writeProfile(self, profiler):
+        logDir = self.ircd.servconfig["app_log_dir"]
+        if not os.path.isdir(logDir):
+            os.makedirs(logDir)
+        timestamp = now().strftime("%Y%m%d-%H%M%S")
+        fileName = os.path.join(logDir, "profile-{}.prof".format(timestamp))
+        count = 1
+        while os.path.exists(fileName):
+            fileName = os.path.join(logDir, "profile-{}-{!s}.prof".format(timestamp, count))
+            count += 1
+        profiler.dump_stats(fileName)
+        return fileName
+    
+    def stop(self):
+        if self.profiler is None:
+            return
+        self.profiler.disable()
+        self.profiler = None
+        if self.stopTimer.active():
+            self.stopTimer.cancel()
+        self.stopTimer = None
+
+class Spawner(object):
+    def __init__(self, ircd):
+        self.ircd = ircd
+        self.profileCmd = None
+    
+    def spawn(self):
+        if "profile_default_duration" not in self.ircd.servconfig:
+            self.ircd.servconfig["profile_default_duration"] = 10
+        if "profile_max_duration" not in self.ircd.servconfig:
+            self.ircd.servconfig["profile_max_duration"] = 300
+        if "profile_summary_lines" not in self.ircd.servconfig:
+            self.ircd.servconfig["profile_summary_lines"] = 15
+        self.profileCmd = ProfileCommand()
+        return {
+            "commands": {
+                "PROFILE": self.profileCmd
+            }
+        }
+    
+    def cleanup(self):
+        self.profileCmd.stop()
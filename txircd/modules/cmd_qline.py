@@ -1,13 +1,13 @@
 from twisted.words.protocols import irc
 from txircd.modbase import Command
-from txircd.utils import epoch, now, irc_lower, parse_duration, CaseInsensitiveDictionary, VALID_NICKNAME
-from fnmatch import fnmatch
+from txircd.utils import epoch, irc_lower, now, parse_duration, MaskDictionary, ExpiryQueue, VALID_NICKNAME
 
 irc.RPL_STATSQLINE = "217"
 
 class QlineCommand(Command):
     def __init__(self):
-        self.banList = CaseInsensitiveDictionary()
+        self.banList = MaskDictionary()
+        self.expiry = ExpiryQueue(self.banList, self.lineExpired)
     
     def onUse(self, user, data):
         mask = data["mask"]
@@ -18,13 +18,17 @@ class QlineCommand(Command):
                 "duration": data["duration"],
                 "reason": data["reason"]
             }
+            self.expiry.add(mask)
+            self.ircd.data_changed("cmd_qline", irc_lower(mask), self.banList[mask])
             user.sendMessage("NOTICE", ":*** Q:Line set on {}, to expire in {} seconds".format(mask, data["duration"]))
             if "*" not in mask and "?" not in mask:
                 if mask in self.ircd.users:
                     self.ircd.users[mask].disconnect("Q:Lined: {}".format(data["reason"]))
             else:
+                newBan = MaskDictionary()
+                newBan[mask] = self.banList[mask]
                 now_banned = {}
-                for user in self.ircd.users.itervalues():
+                for user, userMask in newBan.matchUsers(self.ircd.users.itervalues(), lambda u: (u.nickname,)): # only the new line can ban anyone new
                     reason = self.match_qline(user)
                     if reason:
                         now_banned[user] = reason
@@ -32,8 +36,12 @@ class QlineCommand(Command):
                     user.disconnect("Q:Lined: {}".format(reason))
         else:
             del self.banList[mask]
+            self.ircd.data_removed("cmd_qline", irc_lower(mask))
             user.sendMessage("NOTICE", ":*** Q:Line removed on {}".format(mask))
     
+    def lineExpired(self, mask):
+        self.ircd.data_removed("cmd_qline", irc_lower(mask))
+    
     def processParams(self, user, params):
         if user.registered > 0:
             user.sendMessage(irc.ERR_NOTREGISTERED, "QLINE", ":You have not registered")
@@ -44,7 +52,6 @@ class QlineCommand(Command):
         if not params:
             user.sendMessage(irc.ERR_NEEDMOREPARAMS, "QLINE", ":Not enough parameters")
             return {}
-        self.expire_qlines()
         banmask = params[0]
         if banmask[0] == "-":
             banmask = banmask[1:]
@@ -86,12 +93,10 @@ class QlineCommand(Command):
     def statsList(self, user, statsType):
         if statsType != "Q":
             return
-        self.expire_qlines()
         for mask, linedata in self.banList.iteritems():
             user.sendMessage(irc.RPL_STATSQLINE, ":{} {} {} {} :{}".format(mask, linedata["created"], linedata["duration"], linedata["setter"], linedata["reason"]))
     
     def check_register(self, user):
-        self.expire_qlines()
         reason = self.match_qline(user)
         if not reason:
             return True
@@ -101,31 +106,19 @@ class QlineCommand(Command):
     def match_qline(self, user):
         if "o" in user.mode:
             return None
-        lowerNick = irc_lower(user.nickname)
-        for mask, linedata in self.banList.iteritems():
-            if fnmatch(lowerNick, mask):
-                return linedata["reason"]
+        mask = self.banList.match(user.nickname)
+        if mask:
+            return self.banList[mask]["reason"]
         return None
     
-    def expire_qlines(self):
-        current_time = epoch(now())
-        expired = []
-        for mask, linedata in self.banList.iteritems():
-            if linedata["duration"] and current_time > linedata["created"] + linedata["duration"]:
-                expired.append(mask)
-        for mask in expired:
-            del self.banList[mask]
-    
     def blockNick(self, user, command, data):
         if command != "NICK":
             return data
         newNick = data["nick"]
-        lowerNick = irc_lower(newNick)
-        self.expire_qlines()
-        for mask, linedata in self.banList.iteritems():
-            if fnmatch(lowerNick, mask):
-                user.sendMessage(irc.ERR_ERRONEUSNICKNAME, newNick, ":Invalid nickname: {}".format(linedata["reason"]))
-                return {}
+        mask = self.banList.match(newNick)
+        if mask:
+            user.sendMessage(irc.ERR_ERRONEUSNICKNAME, newNick, ":Invalid nickname: {}".format(self.banList[mask]["reason"]))
+            return {}
         return data
 
 class Spawner(object):
@@ -141,8 +134,10 @@ class Spawner(object):
             },
             "actions": {
                 "statsoutput": self.qlineCmd.statsList,
-                "register": self.qlineCmd.check_register,
-                "commandpermission": self.qlineCmd.blockNick
+                "register": self.qlineCmd.check_register
+            },
+            "permissions": {
+                "NICK": self.qlineCmd.blockNick
             }
         }
     
@@ -151,4 +146,8 @@ class Spawner(object):
     
     def data_unserialize(self, data):
         for mask, linedata in data.iteritems():
-            self.qlineCmd.banList[mask] = linedata
\ No newline at end of file
+            self.qlineCmd.banList[mask] = linedata
+            self.qlineCmd.expiry.add(mask)
+    
+    def cleanup(self):
+        self.qlineCmd.expiry.stop()
\ No newline at end of file
@@ -48,6 +48,12 @@ class StatsCommand(Command):
             for user in self.ircd.users.itervalues():
                 if "o" in user.mode:
                     user.sendMessage(irc.RPL_STATSOPERS, ":{} ({}@{}) Idle: {} secs".format(user.nickname, user.username, user.hostname, epoch(now()) - epoch(user.lastactivity)))
+        elif statschar == "l":
+            for server in self.ircd.linked_servers:
+                stats = server.batchStats
+                average = float(stats["commands"]) / stats["batches"] if stats["batches"] else 0
+                latency = "{}ms".format(int(server.latency * 1000)) if server.latency is not None else "unknown"
+                user.sendMessage(irc.RPL_STATSLINKINFO, server.name, ":Batches: {} Commands: {} (average {:.1f}, largest {}) Latency: {}".format(stats["batches"], stats["commands"], average, stats["largest"], latency))
         elif statschar == "p":
             for port in self.ircd.client_ports.iterkeys():
                 user.sendMessage(irc.RPL_STATSPORTS, ":{} (clients)".format(port))
@@ -56,6 +62,17 @@ class StatsCommand(Command):
         elif statschar == "u":
             uptime = now() - self.ircd.created
             user.sendMessage(irc.RPL_STATSUPTIME, ":Server up {}".format(uptime if uptime.days > 0 else "0 days, {}".format(uptime)))
+        elif statschar == "T":
+            timing = self.ircd.timing
+            if not timing.enabled and not timing.entries:
+                user.sendMessage(irc.RPL_STATS, "T", ":Timing stats are turned off")
+                return
+            entries = timing.summary()
+            for entry in entries[:self.ircd.servconfig["server_stats_timing_lines"]]:
+                histogram = " ".join(["{}:{}".format(label, entry["histogram"][label]) for label in timing.histogram_labels if entry["histogram"][label]])
+                user.sendMessage(irc.RPL_STATS, "T", ":{} {} calls {} total {:.1f}ms avg {:.3f}ms max {:.3f}ms [{}]".format(entry["category"], entry["name"], entry["count"], entry["total"] * 1000, entry["average"] * 1000, entry["max"] * 1000, histogram))
+            if len(entries) > self.ircd.servconfig["server_stats_timing_lines"]:
+                user.sendMessage(irc.RPL_STATS, "T", ":{} more entries not shown".format(len(entries) - self.ircd.servconfig["server_stats_timing_lines"]))
     
     def servResponse(self, command, args):
         if args[0] not in self.ircd.userid:
@@ -69,6 +86,8 @@ class Spawner(object):
         self.statsCmd = None
     
     def spawn(self):
+        if "server_stats_timing_lines" not in self.ircd.servconfig:
+            self.ircd.servconfig["server_stats_timing_lines"] = 30
         self.statsCmd = StatsCommand()
         return {
             "commands": {
@@ -9,12 +9,7 @@ class WhoCommand(Command):
             for u in self.ircd.users.itervalues():
                 if "i" in u.mode:
                     continue
-                common_channel = False
-                for chan in self.ircd.channels.itervalues():
-                    if user in chan.users and u in chan.users:
-                        common_channel = True
-                        break
-                if not common_channel:
+                if user.channels.isdisjoint(u.channels):
                     self.sendWhoLine(user, u, "*", None, data["filters"] if "filters" in data else "", data["fields"] if "fields" in data else "")
             user.sendMessage(irc.RPL_ENDOFWHO, "*", ":End of /WHO list.")
         else:
@@ -60,8 +55,8 @@ class WhoCommand(Command):
     def sendWhoLine(self, user, targetUser, destination, channel, filters, fields):
         displayChannel = destination
         if not channel:
-            for chan in self.ircd.channels.itervalues():
-                if user in chan.users and targetUser in chan.users:
+            for chan in user.channels:
+                if chan in targetUser.channels:
                     displayChannel = chan
                     break
             else:
@@ -16,12 +16,8 @@ class WhoisCommand(Command):
             user.sendMessage(irc.RPL_WHOISUSER, u.nickname, u.username, u.hostname, "*", ":{}".format(u.realname))
             if "o" in user.mode or user == u:
                 user.sendMessage(irc.RPL_WHOISHOST, u.nickname, ":is connecting from {}@{} {}".format(u.username, u.realhost, u.ip))
-            chanlist = []
-            for chan in self.ircd.channels.itervalues():
-                if u in chan.users:
-                    chanlist.append(chan)
             chandisplay = []
-            for cdata in chanlist:
+            for cdata in u.channels:
                 if user in cdata.users or ("s" not in cdata.mode and "p" not in cdata.mode):
                     statuses = cdata.users[u] if u in cdata.users else ""
                     status = self.ircd.prefixes[statuses[0]][0] if statuses else ""
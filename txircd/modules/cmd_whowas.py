@@ -1,6 +1,6 @@
 from twisted.words.protocols import irc
 from txircd.modbase import Command
-from txircd.utils import CaseInsensitiveDictionary, now, epoch, parse_duration
+from txircd.utils import CaseInsensitiveDictionary, irc_lower, now, epoch, parse_duration
 
 class WhowasCommand(Command):
     def __init__(self):
@@ -91,6 +91,7 @@ class WhowasCommand(Command):
                 self.history[user.nickname].pop(0)
         else:
             self.history[user.nickname] = [newEntry]
+        self.ircd.data_changed("cmd_whowas", irc_lower(user.nickname), self.history[user.nickname])
 
 class Spawner(object):
     def __init__(self, ircd):
@@ -1,13 +1,16 @@
 from twisted.words.protocols import irc
+from txircd.logger import logger
 from txircd.modbase import Command
-from txircd.utils import epoch, now, parse_duration, CaseInsensitiveDictionary
-from fnmatch import fnmatch
+from txircd.utils import epoch, irc_lower, now, parse_duration, MaskDictionary, ExpiryQueue
+import os
 
 irc.RPL_STATSZLINE = "223"
 
 class ZlineCommand(Command):
     def __init__(self):
-        self.banList = CaseInsensitiveDictionary()
+        self.banList = MaskDictionary()
+        self.expiry = ExpiryQueue(self.banList, self.lineExpired)
+        self.importList = MaskDictionary()
     
     def onUse(self, user, data):
         if "reason" in data:
@@ -17,20 +20,28 @@ class ZlineCommand(Command):
                 "duration": data["duration"],
                 "reason": data["reason"]
             }
+            self.expiry.add(data["mask"])
+            self.ircd.data_changed("cmd_zline", irc_lower(data["mask"]), self.banList[data["mask"]])
             user.sendMessage("NOTICE", ":*** Z:Line set on {}, to expire in {} seconds".format(data["mask"], data["duration"]))
+            newBan = MaskDictionary()
+            newBan[data["mask"]] = self.banList[data["mask"]]
             now_banned = {}
-            for uid, udata in self.ircd.users.iteritems():
+            for udata, mask in newBan.matchUsers(self.ircd.users.itervalues(), lambda u: (u.ip,)): # only the new line can ban anyone new
                 reason = self.match_zline(udata)
                 if reason:
-                    now_banned[uid] = reason
+                    now_banned[udata.nickname] = reason
             for uid, reason in now_banned.iteritems():
                 udata = self.ircd.users[uid]
                 udata.sendMessage("NOTICE", ":{}".format(self.ircd.servconfig["client_ban_msg"]))
                 udata.disconnect("Z:Lined: {}".format(reason))
         else:
             del self.banList[data["mask"]]
+            self.ircd.data_removed("cmd_zline", irc_lower(data["mask"]))
             user.sendMessage("NOTICE", ":*** Z:Line removed on {}".format(data["mask"]))
     
+    def lineExpired(self, mask):
+        self.ircd.data_removed("cmd_zline", irc_lower(mask))
+    
     def processParams(self, user, params):
         if user.registered > 0:
             user.sendMessage(irc.ERR_NOTREGISTERED, "ZLINE", ":You have not registered")
@@ -44,7 +55,6 @@ class ZlineCommand(Command):
         banmask = params[0]
         if banmask in self.ircd.users:
             banmask = self.ircd.users[banmask].ip
-        self.expire_zlines()
         if banmask[0] == "-":
             banmask = banmask[1:]
             if not banmask:
@@ -78,9 +88,10 @@ class ZlineCommand(Command):
     def stats_list(self, user, statsType):
         if statsType != "Z":
             return
-        self.expire_zlines()
         for mask, linedata in self.banList.iteritems():
             user.sendMessage(irc.RPL_STATSZLINE, ":{} {} {} {} :{}".format(mask, linedata["created"], linedata["duration"], linedata["setter"], linedata["reason"]))
+        for mask, linedata in self.importList.iteritems():
+            user.sendMessage(irc.RPL_STATSZLINE, ":{} {} {} {} :{}".format(mask, linedata["created"], linedata["duration"], linedata["setter"], linedata["reason"]))
     
     def check_connect(self, user):
         reason = self.match_zline(user)
@@ -93,20 +104,43 @@ class ZlineCommand(Command):
     def match_zline(self, user):
         if "o" in user.mode:
             return None
-        self.expire_zlines()
-        for mask, linedata in self.banList.iteritems():
-            if fnmatch(user.ip, mask):
-                return linedata["reason"]
+        mask = self.banList.match(user.ip)
+        if mask:
+            return self.banList[mask]["reason"]
+        mask = self.importList.match(user.ip)
+        if mask:
+            return self.importList[mask]["reason"]
         return None
     
-    def expire_zlines(self):
-        current_time = epoch(now())
-        expired = []
-        for mask, linedata in self.banList.iteritems():
-            if linedata["duration"] and current_time > linedata["created"] + linedata["duration"]:
-                expired.append(mask)
-        for mask in expired:
-            del self.banList[mask]
+    def import_zlines(self, filenames):
+        # Each line of an import file is a mask, optionally followed by a reason.  Imported z:lines don't expire and
+        # aren't saved with the rest; they're loaded from the files again whenever the module is loaded.
+        importList = MaskDictionary()
+        for filename in filenames:
+            try:
+                created = int(os.path.getmtime(filename))
+                with open(filename) as importFile:
+                    for line in importFile:
+                        line = line.strip()
+                        if not line or line[0] == "#":
+                            continue
+                        if " " in line:
+                            mask, reason = line.split(" ", 1)
+                            reason = reason.strip()
+                        else:
+                            mask = line
+                            reason = "Listed in {}".format(os.path.basename(filename))
+                        importList[mask] = {
+                            "setter": filename,
+                            "created": created,
+                            "duration": 0,
+                            "reason": reason
+                        }
+            except (IOError, OSError) as e:
+                logger.msg("security", "warning", "Could not import z:lines from {}: {}", filename, e)
+        logger.msg("security", "info", "Imported {} z:lines from {} file(s)", len(importList), len(filenames))
+        self.importList = importList
+    
 
 class Spawner(object):
     def __init__(self, ircd):
@@ -114,7 +148,11 @@ class Spawner(object):
         self.zlineCmd = None
     
     def spawn(self):
+        if "zline_import_files" not in self.ircd.servconfig:
+            self.ircd.servconfig["zline_import_files"] = []
         self.zlineCmd = ZlineCommand()
+        if self.ircd.servconfig["zline_import_files"]:
+            self.zlineCmd.import_zlines(self.ircd.servconfig["zline_import_files"])
         return {
             "commands": {
                 "ZLINE": self.zlineCmd
@@ -130,4 +168,8 @@ class Spawner(object):
     
     def data_unserialize(self, data):
         for mask, linedata in data.iteritems():
-            self.zlineCmd.banList[mask] = linedata
\ No newline at end of file
+            self.zlineCmd.banList[mask] = linedata
+            self.zlineCmd.expiry.add(mask)
+    
+    def cleanup(self):
+        self.zlineCmd.expiry.stop()
\ No newline at end of file
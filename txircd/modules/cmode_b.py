@@ -1,9 +1,10 @@
 from twisted.words.protocols import irc
 from txircd.modbase import Mode
-from txircd.utils import irc_lower, epoch, now, CaseInsensitiveDictionary
-from fnmatch import fnmatch
+from txircd.utils import irc_lower, epoch, now, MaskDictionary
 
 class BanMode(Mode):
+    affectedCommands = ["JOIN"]
+    
     def checkSet(self, user, target, param):
         if " " in param:
             param = param[:param.index(" ")]
@@ -44,24 +45,32 @@ class BanMode(Mode):
             user.cache["ban_evaluating"] = channels
             return "again"
         keys = data["keys"]
-        for hostmask in (irc_lower(user.prefix()), irc_lower("{}!{}@{}".format(user.nickname, user.username, user.realhost)), irc_lower("{}!{}@{}".format(user.nickname, user.username, user.ip))):
-            remove = []
-            for chan in user.cache["ban_evaluating"]:
-                if "b" in chan.mode:
-                    for mask in chan.mode["b"]:
-                        if fnmatch(hostmask, irc_lower(mask)):
-                            remove.append(chan)
-                            user.sendMessage(irc.ERR_BANNEDFROMCHAN, chan.name, ":Cannot join channel (You're banned)")
-                            break
-            for chan in remove:
-                index = channels.index(chan)
-                channels.pop(index)
-                keys.pop(index)
+        hostmasks = [irc_lower(user.prefix()), irc_lower("{}!{}@{}".format(user.nickname, user.username, user.realhost)), irc_lower("{}!{}@{}".format(user.nickname, user.username, user.ip))]
+        remove = []
+        for chan in user.cache["ban_evaluating"]:
+            if "b" in chan.mode and self.banMatcher(chan).matchLowered(hostmasks):
+                remove.append(chan)
+                user.sendMessage(irc.ERR_BANNEDFROMCHAN, chan.name, ":Cannot join channel (You're banned)")
+        for chan in remove:
+            index = channels.index(chan)
+            channels.pop(index)
+            keys.pop(index)
         data["targetchan"] = channels
         data["keys"] = keys
         del user.cache["ban_evaluating"]
         return data
     
+    def banMatcher(self, channel):
+        # The ban list is changed by the core mode handling, so check that the compiled list still matches it
+        banList = channel.mode["b"]
+        if "banmatcher" in channel.cache and channel.cache["banmatcher"][0] == banList:
+            return channel.cache["banmatcher"][1]
+        matcher = MaskDictionary()
+        for mask in banList:
+            matcher[mask] = True
+        channel.cache["banmatcher"] = (list(banList), matcher)
+        return matcher
+    
     def showParam(self, user, target):
         if "b" in target.mode:
             for entry in target.mode["b"]:
@@ -2,6 +2,8 @@ from twisted.words.protocols import irc
 from txircd.modbase import Mode
 
 class InviteOnlyMode(Mode):
+    affectedCommands = ["JOIN"]
+    
     def checkPermission(self, user, cmd, data):
         if cmd != "JOIN":
             return data
@@ -2,6 +2,8 @@ from twisted.words.protocols import irc
 from txircd.modbase import Mode
 
 class PasswordMode(Mode):
+    affectedCommands = ["JOIN"]
+    
     def checkSet(self, user, target, param):
         if " " in param:
             param = param[:param.index(" ")]
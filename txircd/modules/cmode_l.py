@@ -2,6 +2,8 @@ from twisted.words.protocols import irc
 from txircd.modbase import Mode
 
 class LimitMode(Mode):
+    affectedCommands = ["JOIN"]
+    
     def checkSet(self, user, target, param):
         try:
             intParam = int(param)
@@ -2,6 +2,8 @@ from twisted.words.protocols import irc
 from txircd.modbase import Mode
 
 class ModeratedMode(Mode):
+    affectedCommands = ["PRIVMSG", "NOTICE"]
+    
     def checkPermission(self, user, cmd, data):
         if cmd not in ["PRIVMSG", "NOTICE"]:
             return data
@@ -2,6 +2,8 @@ from twisted.words.protocols import irc
 from txircd.modbase import Mode
 
 class SecretMode(Mode):
+    affectedCommands = ["NAMES"]
+    
     def checkPermission(self, user, cmd, data):
         if cmd != "NAMES":
             return data
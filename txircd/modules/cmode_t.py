@@ -2,6 +2,8 @@ from twisted.words.protocols import irc
 from txircd.modbase import Mode
 
 class TopiclockMode(Mode):
+    affectedCommands = ["TOPIC"]
+    
     def checkPermission(self, user, cmd, data):
         if cmd != "TOPIC":
             return data
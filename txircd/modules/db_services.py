@@ -2,9 +2,10 @@ from twisted.enterprise import adbapi
 from twisted.internet import reactor
 from twisted.internet.defer import Deferred
 from twisted.words.protocols import irc
+from txircd.logger import logger
 from txircd.modbase import Command
 from txircd.server import RegisterUser, RemoveUser, ModuleMessage, SetIdent, SetHost, SetName
-from txircd.utils import chunk_message, crypt, irc_lower, now, CaseInsensitiveDictionary
+from txircd.utils import chunk_message, deferred_crypt, irc_lower, now, CaseInsensitiveDictionary
 from base64 import b64decode, b64encode
 from Crypto.Random.random import getrandbits
 from Crypto.Cipher import AES
@@ -34,6 +35,7 @@ class Service(object):
         self.username = ident
         self.hostname = host
         self.realhost = host
+        self.prefixString = "{}!{}@{}".format(nick, ident, host)
         self.realname = gecos
         self.ip = "127.0.0.1"
         self.server = self.ircd.name
@@ -42,6 +44,7 @@ class Service(object):
         self.lastpong = now()
         self.nicktime = datetime.utcfromtimestamp(1)
         self.mode = {}
+        self.channels = set()
         self.disconnected = Deferred()
         self.disconnected.callback(None)
         self.registered = 0
@@ -57,14 +60,12 @@ class Service(object):
         self.module = module
     
     def addToServers(self):
-        for server in self.ircd.servers.itervalues():
-            if server.nearHop == self.ircd.name:
-                server.callRemote(RegisterUser, uuid=self.uuid, nick=self.nickname, ident=self.username, host=self.hostname, realhost=self.realhost, gecos=self.realname, ip=self.ip, password="", server=self.server, secure=self.socket.secure, signon=1, nickts=1)
+        for server in self.ircd.linked_servers:
+            server.callRemote(RegisterUser, uuid=self.uuid, nick=self.nickname, ident=self.username, host=self.hostname, realhost=self.realhost, gecos=self.realname, ip=self.ip, password="", server=self.server, secure=self.socket.secure, signon=1, nickts=1)
     
     def removeFromServers(self):
-        for server in self.ircd.servers.itervalues():
-            if server.nearHop == self.ircd.name:
-                server.callRemote(RemoveUser, user=self.uuid, reason="Unloading module")
+        for server in self.ircd.linked_servers:
+            server.callRemote(RemoveUser, user=self.uuid, reason="Unloading module")
     
     def register(self):
         pass
@@ -128,7 +129,7 @@ class Service(object):
             modfunc(self, namespace, key, oldValue, "")
     
     def prefix(self):
-        return "{}!{}@{}".format(self.nickname, self.username, self.hostname)
+        return self.prefixString
     
     def hasAccess(self, channel, level):
         return True # access to change anything in all channels
@@ -392,6 +393,7 @@ class NSCertCommand(Command):
             certfp = data["certfp"]
             if certfp in self.nickserv.cache["certfp"][accountid]:
                 self.nickserv.cache["certfp"][accountid].remove(certfp)
+                self.module.certfpChanged(accountid)
                 user.sendMessage("NOTICE", ":Certificate fingerprint {} has been removed from your account.".format(certfp), prefix=self.nickserv.prefix())
             else:
                 user.sendMessage("NOTICE", ":Certificate fingerprint {} was not associated with your account.".format(certfp), prefix=self.nickserv.prefix())
@@ -433,6 +435,7 @@ class CSRegisterCommand(Command):
     def onUse(self, user, data):
         channel = data["targetchan"]
         self.chanserv.cache["registered"][channel.name] = {"founder": user.cache["accountid"], "access": {}, "registertime": now()}
+        self.module.channelChanged(channel.name)
         user.sendMessage("NOTICE", ":The channel {} has been registered under your account.".format(channel.name), prefix=self.chanserv.prefix())
     
     def processParams(self, user, params):
@@ -589,6 +592,7 @@ class CSAccessCommand(Command):
                 del self.chanserv.cache["registered"][channel]["access"][accessID]
             except KeyError:
                 pass # If it was already not specified somehow, go ahead and remove it
+        self.module.channelChanged(channel)
         user.sendMessage("NOTICE", ":The flags for {} have been changed to +{}".format(display, "".join(flagSet)), prefix=self.chanserv.prefix())
 
 class CSCdropCommand(Command):
@@ -598,6 +602,7 @@ class CSCdropCommand(Command):
     
     def onUse(self, user, data):
         del self.chanserv.cache["registered"][data["channel"]]
+        self.module.channelChanged(data["channel"])
         user.sendMessage("NOTICE", ":The channel \x02{}\x02 has been dropped.".format(data["channel"]), prefix=self.chanserv.prefix())
     
     def processParams(self, user, params):
@@ -672,6 +677,7 @@ class BSStartCommand(Command):
             "bids": [],
             "called": 0
         }
+        self.module.auctionChanged()
         lines = [] # The lines array here serves as a cache for the lines so that the format isn't applied repeatedly on every iteration
         lines.append(":\x02\x034Starting Auction for Lot #{}: \"{}\"\x02 - Called by {}".format(results[0][0], results[0][1], user.nickname))
         lines.append(":\x02\x034Item info at http://desertbus.org/live-auction/{}".format(results[0][0]))
@@ -702,6 +708,7 @@ class BSStopCommand(Command):
         for channel in self.ircd.channels.itervalues():
             channel.sendChannelMessage("PRIVMSG", cancelMsg, prefix=self.bidserv.prefix())
         del self.bidserv.cache["auction"]
+        self.module.auctionChanged()
         user.sendMessage("NOTICE", ":The auction has been canceled.", prefix=self.bidserv.prefix())
     
     def processParams(self, user, params):
@@ -756,6 +763,7 @@ class BSBidCommand(Command):
         self.bidserv.cache["auction"]["highbid"] = bid
         self.bidserv.cache["auction"]["highbidder"] = user.nickname
         self.bidserv.cache["auction"]["highbidderid"] = user.cache["accountid"]
+        self.module.auctionChanged()
         for channel in self.ircd.channels.itervalues():
             channel.sendChannelMessage("PRIVMSG", bidMsg, prefix=self.bidserv.prefix())
     
@@ -816,6 +824,7 @@ class BSRevertCommand(Command):
         self.bidserv.cache["auction"]["highbidder"] = newHighBidder
         self.bidserv.cache["auction"]["highbidderid"] = newHighBidderID
         self.bidserv.cache["auction"]["called"] = 0
+        self.module.auctionChanged()
         for channel in self.ircd.channels.itervalues():
             channel.sendChannelMessage("PRIVMSG", revertMsg, prefix=self.bidserv.prefix())
     
@@ -843,6 +852,7 @@ class BSOnceCommand(Command):
     
     def onUse(self, user, data):
         self.bidserv.cache["auction"]["called"] = 1
+        self.module.auctionChanged()
         onceMsg = ":\x02\x034Going Once! To {} for ${:,.2f}!\x02 - Called by {}".format(self.bidserv.cache["auction"]["highbidder"], self.bidserv.cache["auction"]["highbid"], user.nickname)
         for channel in self.ircd.channels.itervalues():
             channel.sendChannelMessage("PRIVMSG", onceMsg, prefix=self.bidserv.prefix())
@@ -871,6 +881,7 @@ class BSTwiceCommand(Command):
     
     def onUse(self, user, data):
         self.bidserv.cache["auction"]["called"] = 2
+        self.module.auctionChanged()
         twiceMsg = ":\x02\x034Going Twice! To {} for ${:,.2f}!\x02 - Called by {}".format(self.bidserv.cache["auction"]["highbidder"], self.bidserv.cache["auction"]["highbid"], user.nickname)
         for channel in self.ircd.channels.itervalues():
             channel.sendChannelMessage("PRIVMSG", twiceMsg, prefix=self.bidserv.prefix())
@@ -913,6 +924,7 @@ class BSSoldCommand(Command):
         d = self.module.query("UPDATE prizes SET donor_id = {0}, sold_amount = {0}, sold = 1 WHERE id = {0}", self.bidserv.cache["auction"]["highbidderid"], self.bidserv.cache["auction"]["highbid"], self.bidserv.cache["auction"]["item"])
         d.addErrback(self.reportError, user, self.bidserv.cache["auction"])
         del self.bidserv.cache["auction"]
+        self.module.auctionChanged()
     
     def processParams(self, user, params):
         if user.registered > 0:
@@ -1082,6 +1094,7 @@ class OSServAdminCommand(Command):
                 return
             adminList.remove(targetID)
             user.sendMessage("NOTICE", ":Account {} was removed from the admin list.".format(targetID), prefix=self.operserv.prefix())
+        self.module.adminsChanged()
         for server in self.ircd.servers.itervalues():
             server.callRemote(ModuleMessage, destserver=server.name, type="ServiceAdmins", args=[data["service"]] + adminList)
     
@@ -1336,22 +1349,35 @@ class Spawner(object):
         del self.ircd.userid[self.operserv.uuid]
     
     def data_serialize(self):
+        # Each registered channel and each account's certificate list is kept under its own key so that changing one doesn't rewrite them all
         outputDict = {}
-        outputDict["registeredchannels"] = self.chanserv.cache["registered"]._data
+        for channel, channelData in self.chanserv.cache["registered"]._data.iteritems():
+            outputDict[("registeredchannels", channel)] = channelData
         if "auction" in self.bidserv.cache:
             outputDict["currentauction"] = self.bidserv.cache["auction"]
-        outputDict["certfp"] = self.nickserv.cache["certfp"]
+        for accountid, certList in self.nickserv.cache["certfp"].iteritems():
+            if certList:
+                outputDict[("certfp", accountid)] = certList
         outputDict["admins"] = self.admins
         return [outputDict, {"auth_timers": self.auth_timer, "saslusers": self.saslUsers}]
     
     def data_unserialize(self, data):
         if "currentauction" in data:
             self.bidserv.cache["auction"] = data["currentauction"]
+        # UPGRADE BEGIN
+        # Registered channels and certificate lists used to be saved as one dictionary each
         if "certfp" in data:
             self.nickserv.cache["certfp"] = data["certfp"]
         if "registeredchannels" in data:
             for key, value in data["registeredchannels"].iteritems():
                 self.chanserv.cache["registered"][key] = value
+        # UPGRADE END
+        for key, value in data.iteritems():
+            if isinstance(key, tuple):
+                if key[0] == "registeredchannels":
+                    self.chanserv.cache["registered"][key[1]] = value
+                elif key[0] == "certfp":
+                    self.nickserv.cache["certfp"][key[1]] = value
         if "admins" in data:
             self.admins = data["admins"]
         if "auth_timers" in data:
@@ -1359,6 +1385,30 @@ class Spawner(object):
         if "saslusers" in data:
             self.saslUsers = data["saslusers"]
     
+    def channelChanged(self, channel):
+        # Saves a registered channel's entry, or its removal, at the next autosave
+        key = ("registeredchannels", irc_lower(channel))
+        if channel in self.chanserv.cache["registered"]:
+            self.ircd.data_changed("db_services", key, self.chanserv.cache["registered"][channel])
+        else:
+            self.ircd.data_removed("db_services", key)
+    
+    def certfpChanged(self, accountid):
+        key = ("certfp", accountid)
+        if self.nickserv.cache["certfp"].get(accountid):
+            self.ircd.data_changed("db_services", key, self.nickserv.cache["certfp"][accountid])
+        else:
+            self.ircd.data_removed("db_services", key)
+    
+    def auctionChanged(self):
+        if "auction" in self.bidserv.cache:
+            self.ircd.data_changed("db_services", "currentauction", self.bidserv.cache["auction"])
+        else:
+            self.ircd.data_removed("db_services", "currentauction")
+    
+    def adminsChanged(self):
+        self.ircd.data_changed("db_services", "admins", self.admins)
+    
     # Services Functions
     def query(self, query, *args):
         query = query.format(self.ircd.servconfig["servdb_marker"])
@@ -1413,7 +1463,15 @@ class Spawner(object):
                 user.sendMessage("NOTICE", ":The login credentials you provided were incorrect.", prefix=self.nickserv.prefix())
             return
         hash = result[0][2]
-        check = crypt(password, hash)
+        d = deferred_crypt(password, hash)
+        d.addCallback(self.checkPasswordHash, result, user, hash)
+        d.addErrback(self.passwordHashFailed, user)
+        return d
+    
+    def checkPasswordHash(self, check, result, user, hash):
+        if user.uuid not in self.ircd.userid:
+            self.saslUsers.pop(user, None)
+            return # The user disconnected while we were checking the password
         if check == hash:
             self.loginUser(result, user)
         else:
@@ -1424,6 +1482,18 @@ class Spawner(object):
                 self.checkNick(user)
                 user.sendMessage("NOTICE", ":The login credentials you provided were incorrect.", prefix=self.nickserv.prefix())
     
+    def passwordHashFailed(self, failure, user):
+        logger.msg("security", "warning", "The password hash for {} could not be checked: {}", user.nickname, failure.getErrorMessage())
+        if user.uuid not in self.ircd.userid:
+            self.saslUsers.pop(user, None)
+            return
+        if user in self.saslUsers:
+            self.saslUsers[user]["failure"](user)
+            del self.saslUsers[user]
+        else:
+            self.checkNick(user)
+            user.sendMessage("NOTICE", ":The login credentials you provided were incorrect.", prefix=self.nickserv.prefix())
+    
     def verifyCert(self, result, user, cert):
         def failValidation():
             if user in self.saslUsers:
@@ -1526,7 +1596,7 @@ class Spawner(object):
             del self.auth_timer[user]
             if user.server != self.ircd.name and user.server in self.ircd.servers: # Make sure the target server is still on the network
                 d = self.ircd.servers[user.server].callRemote(ModuleMessage, destserver=user.server, type="ServiceUnblockUser", args=[user.uuid])
-                d.addErrback(lambda err: log.msg("Couldn't unblock remote user {}: server no longer connected to network".format(user.nickname)))
+                d.addErrback(lambda err: logger.msg("link", "warning", "Couldn't unblock remote user {}: server no longer connected to network", user.nickname))
         if "accountid" in user.cache and user.cache["accountid"] == id:
             return # Somehow we auth'd and didn't clear the timer?
         if irc_lower(user.nickname) != irc_lower(nickname):
@@ -1712,18 +1782,16 @@ class Spawner(object):
         return id in self.admins[convertServices[service]]
     
     def registered(self, user):
-        for c in self.ircd.channels.itervalues():
-            if user in c.users:
-                self.promote(user, c, True)
+        for c in user.channels:
+            self.promote(user, c, True)
         if "certfp" in user.metadata["server"]:
             self.addCert(user, user.metadata["server"]["certfp"])
     
     def unregistered(self, user):
-        for channel in self.ircd.channels.itervalues():
-            if user in channel.users:
-                status = channel.users[user]
-                if status:
-                    channel.setMode(None, "-{}".format(status), [user.nickname for i in range(len(status))], self.chanserv.prefix())
+        for channel in user.channels:
+            status = channel.users[user]
+            if status:
+                channel.setMode(None, "-{}".format(status), [user.nickname for i in range(len(status))], self.chanserv.prefix())
     
     def promote(self, user, channel, keepOldStatus=False):
         if user in self.auth_timer:
@@ -1761,6 +1829,7 @@ class Spawner(object):
             self.nickserv.cache["certfp"][accountid] = []
         if certfp not in self.nickserv.cache["certfp"][accountid]:
             self.nickserv.cache["certfp"][accountid].append(certfp)
+            self.certfpChanged(accountid)
             return True
         return False
     
@@ -1788,6 +1857,7 @@ class Spawner(object):
     def onTopicChange(self, channel, newTopic, newSetter):
         if channel.name in self.chanserv.cache["registered"]:
             self.chanserv.cache["registered"][channel.name]["topic"] = [newTopic, newSetter, now()]
+            self.channelChanged(channel.name)
     
     def onChanCreate(self, channel):
         if channel.name in self.chanserv.cache["registered"] and "topic" in self.chanserv.cache["registered"][channel.name]:
@@ -20,7 +20,7 @@ class Spawner(object):
     def spawn(self):
         self.dcc_block = DCCBlock()
         return {
-            "actions": {
-                "commandpermission": self.dcc_block.blockDCC
+            "permissions": {
+                "PRIVMSG": self.dcc_block.blockDCC
             }
         }
\ No newline at end of file
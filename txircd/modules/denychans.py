@@ -45,7 +45,7 @@ class Spawner(object):
             self.ircd.servconfig["channel_denychans"] = []
         self.denychans = DenychansModule().hook(self.ircd)
         return {
-            "actions": {
-                "commandpermission": self.denychans.denyChannels
+            "permissions": {
+                "JOIN": self.denychans.denyChannels
             }
         }
\ No newline at end of file
@@ -24,10 +24,9 @@ class AwayNotify(Module):
             if "away" not in user.metadata["ext"]:
                 message = None
             notify = set()
-            for channel in self.ircd.channels.itervalues():
-                if user in channel.users:
-                    for u in channel.users.iterkeys():
-                        notify.add(u)
+            for channel in user.channels:
+                for u in channel.users.iterkeys():
+                    notify.add(u)
             notify.remove(user)
             for u in notify:
                 if "cap" in u.cache and "away-notify" in u.cache["cap"]:
@@ -61,6 +61,8 @@ class KnockCommand(Command):
             targetUser.cache["knocks"].remove(targetChan.name)
 
 class NoknockMode(Mode):
+    affectedCommands = ["KNOCK"]
+    
     def checkPermission(self, user, cmd, data):
         if "targetchan" not in data:
             return data
@@ -0,0 +1,150 @@
+from twisted.internet import reactor
+from twisted.internet.endpoints import serverFromString
+from twisted.internet.task import LoopingCall
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+from txircd.logger import logger
+from txircd.utils import resolveEndpointDescription
+from time import time
+
+def format_labels(labels):
+    return ",".join(["{}=\"{}\"".format(key, str(value).replace("\\", "\\\\").replace("\n", "\\n").replace("\"", "\\\"")) for key, value in labels])
+
+class MetricsPage(Resource):
+    isLeaf = True
+    
+    def __init__(self, module):
+        Resource.__init__(self)
+        self.module = module
+    
+    def render_GET(self, request):
+        request.setHeader("Content-Type", "text/plain; version=0.0.4")
+        return self.module.render()
+
+class MetricsModule(object):
+    """
+    Serves the IRCd's counters over HTTP in the Prometheus text format.
+    Everything reported here is either kept up to date by the IRCd as it
+    goes or is the size of a table, so a scrape doesn't walk the user or
+    channel lists.
+    """
+    lag_check_interval = 1.0
+    
+    def __init__(self, ircd):
+        self.ircd = ircd
+        self.listener = None
+        self.lagChecker = LoopingCall(self.checkLag)
+        self.lastLagCheck = None
+        self.lag = 0.0
+        self.maxLag = 0.0
+    
+    def startListening(self):
+        try:
+            endpoint = serverFromString(reactor, resolveEndpointDescription(self.ircd.servconfig["metrics_port"]))
+        except ValueError as e:
+            logger.msg("module", "warning", "Could not bind metrics port {}: not a valid description ({})", self.ircd.servconfig["metrics_port"], e)
+            return
+        listenDeferred = endpoint.listen(Site(MetricsPage(self)))
+        listenDeferred.addCallback(self.listening)
+        listenDeferred.addErrback(lambda err: logger.msg("module", "warning", "Could not bind metrics port {}: {}", self.ircd.servconfig["metrics_port"], err.getErrorMessage()))
+        self.lastLagCheck = time()
+        self.lagChecker.start(self.lag_check_interval, now=False)
+    
+    def listening(self, port):
+        self.listener = port
+    
+    def stopListening(self):
+        if self.listener is not None:
+            self.listener.stopListening()
+            self.listener = None
+        if self.lagChecker.running:
+            self.lagChecker.stop()
+    
+    def checkLag(self):
+        # The check is scheduled every lag_check_interval seconds, so anything past that is time the reactor was busy
+        currentTime = time()
+        self.lag = max(0.0, currentTime - self.lastLagCheck - self.lag_check_interval)
+        if self.lag > self.maxLag:
+            self.maxLag = self.lag
+        self.lastLagCheck = currentTime
+    
+    def render(self):
+        lines = []
+        def metric(name, metricType, helpText, values):
+            lines.append("# HELP txircd_{} {}".format(name, helpText))
+            lines.append("# TYPE txircd_{} {}".format(name, metricType))
+            for labels, value in values:
+                if labels:
+                    lines.append("txircd_{}{{{}}} {}".format(name, format_labels(labels), value))
+                else:
+                    lines.append("txircd_{} {}".format(name, value))
+        ircd = self.ircd
+        metric("users", "gauge", "Users on the network, including services.", [((), len(ircd.users))])
+        metric("local_users", "gauge", "Users on this server, including services.", [((), ircd.users.localCount)])
+        metric("invisible_users", "gauge", "Users on the network with user mode +i.", [((), ircd.users.invisibleCount)])
+        metric("opers", "gauge", "Opers on the network.", [((), ircd.users.operCount)])
+        metric("channels", "gauge", "Channels on the network.", [((), len(ircd.channels))])
+        metric("servers", "gauge", "Servers on the network, including this one.", [((), len(ircd.servers) + 1)])
+        metric("linked_servers", "gauge", "Servers directly linked to this one.", [((), len(ircd.linked_servers))])
+        metric("client_connections", "gauge", "Client connections to this server, including unregistered ones.", [((), ircd.client_connections)])
+        metric("received_bytes_total", "counter", "Bytes received from clients.", [((), ircd.traffic_stats["bytes_in"])])
+        metric("sent_bytes_total", "counter", "Bytes sent to clients.", [((), ircd.traffic_stats["bytes_out"])])
+        metric("received_lines_total", "counter", "Lines received from clients.", [((), ircd.traffic_stats["lines_in"])])
+        metric("sent_lines_total", "counter", "Lines sent to clients.", [((), ircd.traffic_stats["lines_out"])])
+        metric("commands_total", "counter", "Commands received from clients, by command.", [((("command", command),), count) for command, count in sorted(ircd.command_counts.iteritems())])
+        pending = []
+        outstanding = []
+        buffered = []
+        for server in ircd.linked_servers:
+            labels = (("server", server.name),)
+            pending.append((labels, len(server.outgoingBatch)))
+            outstanding.append((labels, len(getattr(server, "_outstandingRequests", {}))))
+            transport = server.transport
+            bufferSize = len(getattr(transport, "dataBuffer", "")) + getattr(transport, "_tempDataLen", 0)
+            buffered.append((labels, bufferSize))
+        metric("link_pending_commands", "gauge", "Commands waiting to be sent in the next batch to each linked server.", pending)
+        metric("link_outstanding_requests", "gauge", "Commands sent to each linked server that haven't been answered yet.", outstanding)
+        metric("link_send_buffer_bytes", "gauge", "Bytes written for each linked server that haven't been sent yet.", buffered)
+        metric("reactor_lag_seconds", "gauge", "How late the reactor was for the most recent lag check.", [((), "{:.6f}".format(self.lag))])
+        metric("reactor_lag_max_seconds", "gauge", "The longest the reactor was late since the last scrape.", [((), "{:.6f}".format(self.maxLag))])
+        self.maxLag = self.lag
+        timing = ircd.timing
+        buckets = []
+        sums = []
+        counts = []
+        for (category, name), (count, total, longest, histogram) in sorted(timing.entries.iteritems()):
+            labels = (("category", category), ("name", name))
+            cumulative = 0
+            for limit, bucketCount in zip(timing.histogram_limits, histogram):
+                cumulative += bucketCount
+                buckets.append((labels + (("le", repr(limit)),), cumulative))
+            buckets.append((labels + (("le", "+Inf"),), count))
+            sums.append((labels, "{:.6f}".format(total)))
+            counts.append((labels, count))
+        lines.append("# HELP txircd_call_duration_seconds Time taken by commands, module hooks, and server link commands.")
+        lines.append("# TYPE txircd_call_duration_seconds histogram")
+        for suffix, values in (("bucket", buckets), ("sum", sums), ("count", counts)):
+            for labels, value in values:
+                lines.append("txircd_call_duration_seconds_{}{{{}}} {}".format(suffix, format_labels(labels), value))
+        lines.append("")
+        return "\n".join(lines)
+
+class Spawner(object):
+    def __init__(self, ircd):
+        self.ircd = ircd
+        self.metrics = None
+        self.startTimer = None
+    
+    def spawn(self):
+        if "metrics_port" not in self.ircd.servconfig:
+            self.ircd.servconfig["metrics_port"] = "tcp:9110:interface=127.0.0.1"
+        self.metrics = MetricsModule(self.ircd)
+        # Wait 100ms in event of a rehash so that the old module
+        # has time to stop listening on the port.
+        self.startTimer = reactor.callLater(0.1, self.metrics.startListening)
+        return {}
+    
+    def cleanup(self):
+        if self.startTimer.active():
+            self.startTimer.cancel()
+        self.metrics.stopListening()
@@ -1,13 +1,13 @@
 from twisted.words.protocols import irc
 from txircd.modbase import Command
-from txircd.utils import epoch, now, irc_lower, parse_duration, CaseInsensitiveDictionary
-from fnmatch import fnmatch
+from txircd.utils import epoch, irc_lower, now, parse_duration, MaskDictionary, ExpiryQueue
 
 irc.RPL_STATSSHUN = "223" # This use of this numeric doesn't normally have a name.
 
 class ShunCommand(Command):
     def __init__(self):
-        self.shunList = CaseInsensitiveDictionary()
+        self.shunList = MaskDictionary()
+        self.expiry = ExpiryQueue(self.shunList, self.lineExpired)
     
     def onUse(self, user, data):
         if "reason" in data:
@@ -17,9 +17,12 @@ class ShunCommand(Command):
                 "duration": data["duration"],
                 "reason": data["reason"]
             }
+            self.expiry.add(data["mask"])
+            self.ircd.data_changed("shun", irc_lower(data["mask"]), self.shunList[data["mask"]])
             user.sendMessage("NOTICE", ":*** Shun set on {}, to expire in {} seconds".format(data["mask"], data["duration"]))
         else:
             del self.shunList[data["mask"]]
+            self.ircd.data_removed("shun", irc_lower(data["mask"]))
             user.sendMessage("NOTICE", ":*** Shun removed on {}".format(data["mask"]))
         for udata in self.ircd.users.itervalues():
             if self.match_shun(udata):
@@ -27,6 +30,9 @@ class ShunCommand(Command):
             else:
                 udata.cache["shunned"] = False
     
+    def lineExpired(self, mask):
+        self.ircd.data_removed("shun", irc_lower(mask))
+    
     def processParams(self, user, params):
         if user.registered > 0:
             user.sendMessage(irc.ERR_NOTREGISTERED, "SHUN", ":You have not registered")
@@ -43,7 +49,6 @@ class ShunCommand(Command):
             banmask = "{}@{}".format(udata.username, udata.hostname)
         elif "@" not in banmask:
             banmask = "*@{}".format(banmask)
-        self.expire_shuns()
         if banmask[0] == "-":
             banmask = banmask[1:]
             if not banmask:
@@ -77,7 +82,6 @@ class ShunCommand(Command):
     def statsList(self, user, statsType):
         if statsType != "S":
             return
-        self.expire_shuns()
         for mask, linedata in self.shunList.iteritems():
             user.sendMessage(irc.RPL_STATSSHUN, "{} {} {} {} :{}".format(mask, linedata["created"], linedata["duration"], linedata["setter"], linedata["reason"]))
     
@@ -100,45 +104,26 @@ class ShunCommand(Command):
         return None # the xline_rematch hook shouldn't automatically operate on these, so let's make it not.
     
     def match_shun(self, user):
-        self.expire_shuns()
         if "except_line" in user.cache:
             if user.cache["except_line"]:
                 return None
-            matchMask = "{}@{}".format(user.username, user.hostname)
-            for mask, linedata in self.shunList.iteritems():
-                if fnmatch(matchMask, mask):
-                    return linedata["reason"]
-            matchMask = "{}@{}".format(user.username, user.ip)
-            for mask, linedata in self.shunList.iteritems():
-                if fnmatch(matchMask, mask):
-                    return linedata["reason"]
+            mask = self.shunList.match(*self.user_masks(user))
+            if mask:
+                return self.shunList[mask]["reason"]
             return None
         elif "shunned" in user.cache:
             if user.cache["shunned"]:
                 return "Shunned"
             return None
         else:
-            matchMask = "{}@{}".format(user.username, user.hostname)
-            for mask in self.shunList.iterkeys():
-                if fnmatch(matchMask, mask):
-                    user.cache["shunned"] = True
-                    return ""
-            matchMask = "{}@{}".format(user.username, user.ip)
-            for mask in self.shunList.iterkeys():
-                if fnmatch(matchMask, mask):
-                    user.cache["shunned"] = True
-                    return ""
+            if self.shunList.match(*self.user_masks(user)):
+                user.cache["shunned"] = True
+                return ""
             user.cache["shunned"] = False
             return None
     
-    def expire_shuns(self):
-        current_time = epoch(now())
-        expired = []
-        for mask, linedata in self.shunList.iteritems():
-            if linedata["duration"] and current_time > linedata["created"] + linedata["duration"]:
-                expired.append(mask)
-        for mask in expired:
-            del self.shunList[mask]
+    def user_masks(self, user):
+        return ("{}@{}".format(user.username, user.hostname), "{}@{}".format(user.username, user.ip))
     
     def check_command(self, user, command, data):
         if "shunned" not in user.cache or not user.cache["shunned"]:
@@ -173,4 +158,8 @@ class Spawner(object):
     
     def data_unserialize(self, data):
         for mask, meta in data.iteritems():
-            self.shunCmd.shunList[mask] = meta
\ No newline at end of file
+            self.shunCmd.shunList[mask] = meta
+            self.shunCmd.expiry.add(mask)
+    
+    def cleanup(self):
+        self.shunCmd.expiry.stop()
\ No newline at end of file
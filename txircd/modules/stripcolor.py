@@ -1,6 +1,8 @@
 from txircd.modbase import Mode
 
 class StripColor(Mode):
+    affectedCommands = ["PRIVMSG", "NOTICE"]
+    
     def strip_colors(self, msg):
         while chr(3) in msg:
             color_pos = msg.index(chr(3))
@@ -11,12 +11,7 @@ class InvisibleMode(Mode):
             if user not in channel.users and "i" in targetUser.mode:
                 return {}
         if "i" in targetUser.mode:
-            share_channel = False
-            for chan in self.ircd.channels.itervalues():
-                if user in chan.users and targetUser in chan.users:
-                    share_channel = True
-                    break
-            if not share_channel:
+            if user.channels.isdisjoint(targetUser.channels):
                 return {}
         return udata
 
@@ -1,20 +1,33 @@
+from twisted.internet import reactor
 from twisted.internet.defer import Deferred
 from twisted.internet.protocol import Factory, ClientFactory
-from twisted.internet.task import LoopingCall
-from twisted.protocols.amp import AMP, Command, Integer, String, Boolean, AmpList, ListOf, IncompatibleVersions
-from twisted.python import log
+from twisted.internet.interfaces import IPushProducer
+from twisted.internet.task import LoopingCall, TaskStopped, cooperate
+from twisted.protocols.amp import AMP, Command, Integer, String, Boolean, AmpList, ListOf, IncompatibleVersions, COMMAND, MAX_VALUE_LENGTH, parseString
 from twisted.words.protocols import irc
 from txircd.channel import IRCChannel
+from txircd.logger import logger
 from txircd.utils import CaseInsensitiveDictionary, epoch, irc_lower, now, IPV4_MAPPED_ADDR
 from datetime import datetime
+from time import time
+from zope.interface import implementer
 
-protocol_version = 200 # Protocol version 0.2.0
+protocol_version = 202 # Protocol version 0.2.2
 # The protocol version should be incremented with changes of the protocol
 # Breaking changes should be avoided except for major version upgrades or when it's otherwise unavoidable
 
 # Keep a list of versions the current protocol is compatible with
 # This list must include the current protocol version
-compatible_versions = [ 200 ]
+compatible_versions = [ 200, 201, 202 ]
+
+# Servers using at least this protocol version accept CommandBatch
+batch_protocol_version = 201
+# Servers using at least this protocol version accept BurstUsers and BurstChannels
+compact_burst_protocol_version = 202
+
+# The size, in bytes, to which BurstUsers and BurstChannels records are grouped
+# This must stay well under the AMP limit of 65535 bytes for a single value
+burst_chunk_size = 60000
 
 class RemoteUser(object):
     class RemoteSocket(object):
@@ -35,6 +48,7 @@ class RemoteUser(object):
         self.username = ident
         self.realname = gecos
         self.hostname = host
+        self.prefixString = None
         self.realhost = realhost
         self.ip = ip
         self.server = server
@@ -43,6 +57,7 @@ class RemoteUser(object):
         self.lastactivity = now()
         self.disconnected = Deferred()
         self.mode = {}
+        self.channels = set()
         self.registered = 0
         self.metadata = { # split into metadata key namespaces, see http://ircv3.atheme.org/specification/metadata-3.2
             "server": {},
@@ -83,10 +98,8 @@ class RemoteUser(object):
         del self.ircd.userid[self.uuid]
         if self.nickname:
             quitdest = set()
-            exitChannels = []
-            for channel in self.ircd.channels.itervalues():
-                if self in channel.users:
-                    exitChannels.append(channel)
+            exitChannels = self.channels
+            self.channels = set()
             for channel in exitChannels:
                 del channel.users[self] # remove channel user entry
                 if not channel.users:
@@ -98,13 +111,12 @@ class RemoteUser(object):
             udata = self.ircd.users[self.nickname]
             if udata == self:
                 del self.ircd.users[self.nickname]
-            for user in quitdest:
-                user.sendMessage("QUIT", ":{}".format(reason), to=None, prefix=self.prefix())
+            self.ircd.broadcast(quitdest, "QUIT", ":{}".format(reason), to=None, prefix=self.prefix())
         for modfunc in self.ircd.actions["quit"]:
             modfunc(self, reason)
         self.disconnected.callback(None)
-        for server in self.ircd.servers.itervalues():
-            if server.nearHop == self.ircd.name and server.name != sourceServer:
+        for server in self.ircd.linked_servers:
+            if server.name != sourceServer:
                 server.callRemote(RemoveUser, user=self.uuid, reason=reason)
     
     def sendMessage(self, command, *parameter_list, **kw):
@@ -128,9 +140,18 @@ class RemoteUser(object):
             to = self.nickname if self.nickname else "*"
         d = self.ircd.servers[self.server].callRemote(SendAnnouncement, user=self.uuid, type=command, args=parameter_list, prefix=prefix, to=to)
         if d: # Apparently sometimes the deferred is actually None
-            d.addErrback(lambda err: log.msg("Could not send message to user {}: {} {}".format(self.nickname, command, " ".join(parameter_list))))
+            d.addErrback(lambda err: logger.msg("link", "warning", "Could not send message to user {}: {} {}", self.nickname, command, " ".join(parameter_list)))
     
     def handleCommand(self, command, prefix, params):
+        timing = self.ircd.timing
+        if not timing.enabled:
+            self.runCommand(command, prefix, params)
+            return
+        start = time()
+        self.runCommand(command, prefix, params)
+        timing.record("command", command, time() - start)
+    
+    def runCommand(self, command, prefix, params):
         cmd = self.ircd.commands[command]
         cmd.updateActivity(self)
         data = cmd.processParams(self, params)
@@ -144,7 +165,8 @@ class RemoteUser(object):
     
     def commandPermission(self, command, data):
         tryagain = set()
-        for modfunc in self.ircd.actions["commandpermission"]:
+        dispatch = self.ircd.permission_dispatch
+        for modfunc in dispatch[command] if command in dispatch else dispatch[None]:
             permData = modfunc(self, command, data)
             if permData == "again":
                 tryagain.add(modfunc)
@@ -154,28 +176,6 @@ class RemoteUser(object):
                     return data
                 if not data:
                     return {}
-        for modeset in self.ircd.channel_modes:
-            for implementation in modeset.itervalues():
-                permData = implementation.checkPermission(self, command, data)
-                if permData == "again":
-                    tryagain.add(implementation.checkPermission)
-                else:
-                    data = permData
-                    if "force" in data and data["force"]:
-                        return data
-                    if not data:
-                        return {}
-        for modeset in self.ircd.user_modes:
-            for implementation in modeset.itervalues():
-                permData = implementation.checkPermission(self, command, data)
-                if permData == "again":
-                    tryagain.add(implementation.checkPermission)
-                else:
-                    data = permData
-                    if "force" in data and data["force"]:
-                        return data
-                    if not data:
-                        return {}
         for modfunc in tryagain:
             data = modfunc(self, command, data)
             if "force" in data and data["force"]:
@@ -189,8 +189,8 @@ class RemoteUser(object):
         self.metadata[namespace][key] = value
         for action in self.ircd.actions["metadataupdate"]:
             action(self, namespace, key, oldValue, value)
-        for server in self.ircd.servers.itervalues():
-            if server.nearHop == self.ircd.name and server.name != sourceServer:
+        for server in self.ircd.linked_servers:
+            if server.name != sourceServer:
                 server.callRemote(SetMetadata, target=self.uuid, targetts=epoch(self.signon), namespace=namespace, key=key, value=value)
     
     def delMetadata(self, namespace, key, sourceServer = None):
@@ -198,12 +198,15 @@ class RemoteUser(object):
         del self.metadata[namespace][key]
         for modfunc in self.ircd.actions["metadataupdate"]:
             modfunc(self, namespace, key, oldValue, "")
-        for server in self.ircd.servers.itervalues():
-            if server.nearHop == self.ircd.name and server.name != sourceServer:
+        for server in self.ircd.linked_servers:
+            if server.name != sourceServer:
                 server.callRemote(SetMetadata, target=self.uuid, targetts=epoch(self.signon), namespace=namespace, key=key, value="")
     
     def prefix(self):
-        return "{}!{}@{}".format(self.nickname, self.username, self.hostname)
+        # The prefix goes out with nearly everything the user does, so it's built once and kept until the nick, ident, or host changes
+        if self.prefixString is None:
+            self.prefixString = "{}!{}@{}".format(self.nickname, self.username, self.hostname)
+        return self.prefixString
     
     def hasAccess(self, channel, level):
         if self not in channel.users or level not in self.ircd.prefixes:
@@ -215,23 +218,25 @@ class RemoteUser(object):
     
     def setUsername(self, newUsername, sourceServer = None):
         self.username = newUsername
+        self.prefixString = None
         if self.registered == 0:
-            for server in self.ircd.servers.itervalues():
-                if server.nearHop == self.ircd.name and server.name != sourceServer:
+            for server in self.ircd.linked_servers:
+                if server.name != sourceServer:
                     server.callRemote(SetIdent, user=self.uuid, ident=newUsername)
     
     def setHostname(self, newHostname, sourceServer = None):
         self.hostname = newHostname
+        self.prefixString = None
         if self.registered == 0:
-            for server in self.ircd.servers.itervalues():
-                if server.nearHop == self.ircd.name and server.name != sourceServer:
+            for server in self.ircd.linked_servers:
+                if server.name != sourceServer:
                     server.callRemote(SetHost, user=self.uuid, host=newHostname)
     
     def setRealname(self, newRealname, sourceServer = None):
         self.realname = newRealname
         if self.registered == 0:
-            for server in self.ircd.servers.itervalues():
-                if server.nearHop == self.ircd.name and server.name != sourceServer:
+            for server in self.ircd.linked_servers:
+                if server.name != sourceServer:
                     server.callRemote(SetName, user=self.uuid, gecos=newRealname)
     
     def setMode(self, user, modes, params, displayPrefix = None):
@@ -261,12 +266,13 @@ class RemoteUser(object):
     
     def leave(self, channel, sourceServer = None):
         del channel.users[self] # remove channel user entry
+        self.channels.discard(channel)
         if not channel.users:
             for modfunc in self.ircd.actions["chandestroy"]:
                 modfunc(channel)
             del self.ircd.channels[channel.name] # destroy the empty channel
-        for server in self.ircd.servers.itervalues():
-            if server.nearHop == self.ircd.name and server.name != sourceServer:
+        for server in self.ircd.linked_servers:
+            if server.name != sourceServer:
                 server.callRemote(LeaveChannel, channel=channel.name, user=self.uuid)
     
     def nick(self, newNick):
@@ -285,11 +291,8 @@ class RemoteServer(object):
         self.hopCount = hopCount
     
     def callRemote(self, command, *args, **kw):
-        server = self
-        while server.nearHop != self.ircd.name and server.nearHop in self.ircd.servers:
-            server = self.ircd.servers[server.nearHop]
-        if server.name in self.ircd.servers:
-            server.callRemote(command, *args, **kw) # If the parameters are such that they indicate the target properly, this will be forwarded to the proper server.
+        if self.name in self.ircd.server_routes:
+            self.ircd.server_routes[self.name].callRemote(command, *args, **kw) # If the parameters are such that they indicate the target properly, this will be forwarded to the proper server.
 
 
 # ERRORS
@@ -613,6 +616,62 @@ class ModuleMessage(Command):
         HandshakeNotYetComplete: "HANDSHAKE_NOT_COMPLETE"
     }
 
+class BurstUsers(Command):
+    arguments = [
+        ("users", AmpList([
+            ("uuid", String()),
+            ("nick", String()),
+            ("ident", String()),
+            ("host", String()),
+            ("realhost", String()),
+            ("gecos", String()),
+            ("ip", String()),
+            ("password", String()),
+            ("server", String()),
+            ("secure", Boolean()),
+            ("signon", Integer()),
+            ("nickts", Integer()),
+            ("modestring", String()),
+            ("modeparams", ListOf(String())),
+            ("metadata", ListOf(String())) # namespace, key, value, namespace, key, value...
+        ]))
+    ]
+    errors = {
+        HandshakeNotYetComplete: "HANDSHAKE_NOT_COMPLETE",
+        NoSuchServer: "NO_SUCH_SERVER",
+        UserAlreadyConnected: "UUID_ALREADY_CONNECTED"
+    }
+    requiresAnswer = False
+
+class BurstChannels(Command):
+    # Channels with many users are split over several records; only the first of these has the channel's modes, topic, and metadata
+    arguments = [
+        ("channels", AmpList([
+            ("channel", String()),
+            ("chants", Integer()),
+            ("members", ListOf(String())),
+            ("statuses", ListOf(String())),
+            ("modestring", String()),
+            ("modeparams", ListOf(String())),
+            ("topic", String()),
+            ("topicsetter", String()),
+            ("topicts", Integer()),
+            ("metadata", ListOf(String()))
+        ]))
+    ]
+    errors = {
+        HandshakeNotYetComplete: "HANDSHAKE_NOT_COMPLETE",
+        NoSuchUser: "NO_SUCH_USER",
+        NoSuchTarget: "NO_SUCH_TARGET"
+    }
+    requiresAnswer = False
+
+class CommandBatch(Command):
+    arguments = [
+        ("boxes", String()) # serialized AMP boxes, in the order they were sent
+    ]
+    requiresAnswer = False
+
 class PingServer(Command):
     arguments = [
         ("data", String())
@@ -622,6 +681,58 @@ class PingServer(Command):
     ]
 
 
+def burst_record_size(record):
+    # The size of the record once it's serialized as an AMP box
+    size = 2
+    for key, value in record.iteritems():
+        if isinstance(value, list):
+            valueLen = sum([len(item) + 2 for item in value])
+        else:
+            valueLen = len(str(value))
+        size += len(key) + valueLen + 4
+    return size
+
+def chunk_burst_records(records):
+    chunks = []
+    chunk = []
+    chunkSize = 0
+    for record in records:
+        recordSize = burst_record_size(record)
+        if chunk and chunkSize + recordSize > burst_chunk_size:
+            chunks.append(chunk)
+            chunk = []
+            chunkSize = 0
+        chunk.append(record)
+        chunkSize += recordSize
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+@implementer(IPushProducer)
+class BurstProducer(object):
+    # Pauses sending a burst while the link's transport buffer is full
+    def __init__(self, task):
+        self.task = task
+        self.paused = False
+    
+    def pauseProducing(self):
+        # The transport asks again for every write made while its buffer is full, but only resumes once
+        if not self.paused:
+            self.paused = True
+            self.task.pause()
+    
+    def resumeProducing(self):
+        if self.paused:
+            self.paused = False
+            self.task.resume()
+    
+    def stopProducing(self):
+        self.task.stop()
+
+# The answers to these commands are only used to report errors, so they're
+# batched without asking for an answer when the other server accepts batches
+batched_answer_commands = [ SendAnnouncement ]
+
 class ServerProtocol(AMP):
     def __init__(self, ircd):
         self.ircd = ircd
@@ -638,10 +749,35 @@ class ServerProtocol(AMP):
         self.lastping = now()
         self.lastpong = now()
         self.pinger = LoopingCall(self.ping)
+        self.pingSent = None
+        self.latency = None
+        self.protocolVersion = 0 # Not known until the handshake
+        self.outgoingBatch = []
+        self.batchFlusher = None
+        self.batchStats = {
+            "batches": 0,
+            "commands": 0,
+            "largest": 0
+        }
+        self.burstTask = None
     
     def connectionMade(self):
         self.pinger.start(60, now=False)
     
+    def locateResponder(self, name):
+        responder = AMP.locateResponder(self, name)
+        # Each command in a batch goes through here on its own, so timing the batch as well would count them twice
+        if responder is None or not self.ircd.timing.enabled or name == CommandBatch.commandName:
+            return responder
+        timing = self.ircd.timing
+        def timedResponder(box):
+            start = time()
+            try:
+                return responder(box)
+            finally:
+                timing.record("responder", name, time() - start)
+        return timedResponder
+
     def serverHandshake(self, name, password, description, version, commonmodules):
         if self.name is not None:
             raise HandshakeAlreadyComplete ("The server handshake has already been completed between these servers.")
@@ -664,16 +800,18 @@ class ServerProtocol(AMP):
         if "incoming_password" not in linkData or password != linkData["incoming_password"]:
             raise ServerPasswordIncorrect ("The password provided by the server does not match the one in the configuration.")
         if self.sentDataBurst is None:
-            self.callRemote(IntroduceServer, name=self.ircd.name, password=linkData["outgoing_password"], description=self.ircd.servconfig["server_description"], version=version, commonmodules=self.ircd.common_modules)
+            self.callRemote(IntroduceServer, name=self.ircd.name, password=linkData["outgoing_password"], description=self.ircd.servconfig["server_description"], version=min(version, protocol_version), commonmodules=self.ircd.common_modules)
             self.sentDataBurst = False
+        self.protocolVersion = min(version, protocol_version) # Only use what both servers understand
         self.name = name
         self.description = description
         self.ircd.servers[self.name] = self
+        self.ircd.rebuild_server_routes()
         self.sendBurstData()
         for action in self.ircd.actions["netmerge"]:
             action(self.name)
-        for server in self.ircd.servers.itervalues():
-            if server.nearHop == self.ircd.name and server != self:
+        for server in self.ircd.linked_servers:
+            if server != self:
                 server.callRemote(AddNewServer, name=name, description=description, hopcount=1, nearhop=self.ircd.name)
         return {}
     IntroduceServer.responder(serverHandshake)
@@ -683,11 +821,13 @@ class ServerProtocol(AMP):
             self.transport.loseConnection()
             return
         self.lastping = now()
+        self.pingSent = time()
         d = self.callRemote(PingServer, data="{} {}".format(self.name, epoch(self.lastping)))
         d.addCallback(self.handlePong)
     
     def handlePong(self, data):
         self.lastpong = now()
+        self.latency = time() - self.pingSent
     
     def handlePing(self, data):
         return {
@@ -695,6 +835,72 @@ class ServerProtocol(AMP):
         }
     PingServer.responder(handlePing)
     
+    def callRemote(self, command, *args, **kw):
+        # Commands sent in the same reactor tick are collected and sent together as a single CommandBatch.
+        # Anything needing an answer flushes the batch first so that everything still arrives in order.
+        if self.protocolVersion < batch_protocol_version:
+            self.flushBatch()
+            return AMP.callRemote(self, command, *args, **kw)
+        if command.requiresAnswer and command not in batched_answer_commands:
+            if self.burstTask is None:
+                self.flushBatch()
+                return AMP.callRemote(self, command, *args, **kw)
+            # During a burst, it waits behind the burst with everything else and is answered once it's sent
+            answer = Deferred()
+            self.outgoingBatch.append((command, kw, answer))
+            return answer
+        box = command.makeArguments(kw, self)
+        box[COMMAND] = command.commandName
+        self.outgoingBatch.append(box.serialize())
+        if self.batchFlusher is None:
+            self.batchFlusher = reactor.callLater(0, self.flushBatch)
+        return None
+    
+    def flushBatch(self):
+        if self.batchFlusher is not None:
+            if self.batchFlusher.active():
+                self.batchFlusher.cancel()
+            self.batchFlusher = None
+        if not self.outgoingBatch or self.burstTask is not None:
+            return # While bursting, hold everything else until the burst is done
+        boxes = self.outgoingBatch
+        self.outgoingBatch = []
+        self.batchStats["batches"] += 1
+        self.batchStats["commands"] += len(boxes)
+        if len(boxes) > self.batchStats["largest"]:
+            self.batchStats["largest"] = len(boxes)
+        if self.disconnected.called:
+            return
+        chunk = []
+        chunkLen = 0
+        for box in boxes:
+            if isinstance(box, tuple):
+                # A command held during a burst that needs an answer; it can't go in a batch
+                if chunk:
+                    AMP.callRemote(self, CommandBatch, boxes="".join(chunk))
+                    chunk = []
+                    chunkLen = 0
+                command, kw, answer = box
+                AMP.callRemote(self, command, **kw).chainDeferred(answer)
+                continue
+            if chunk and chunkLen + len(box) > MAX_VALUE_LENGTH:
+                AMP.callRemote(self, CommandBatch, boxes="".join(chunk))
+                chunk = []
+                chunkLen = 0
+            if len(box) > MAX_VALUE_LENGTH:
+                self.transport.write(box) # Too big to fit in a batch, but it's still a valid box to send on its own
+            else:
+                chunk.append(box)
+                chunkLen += len(box)
+        if chunk:
+            AMP.callRemote(self, CommandBatch, boxes="".join(chunk))
+    
+    def runBatch(self, boxes):
+        for box in parseString(boxes):
+            self.ampBoxReceived(box)
+        return {}
+    CommandBatch.responder(runBatch)
+    
     def sendBurstData(self):
         if self.sentDataBurst is not False:
             return
@@ -707,22 +913,14 @@ class ServerProtocol(AMP):
                 if server.nearHop == self.ircd.name or server.nearHop in serverOrder:
                     serverOrder.append(server)
         serverOrder.remove(self)
+        if self.protocolVersion >= compact_burst_protocol_version:
+            self.sendCompactBurst(serverOrder)
+            return
         for server in serverOrder:
             self.callRemote(AddNewServer, name=server.name, description=server.description, hopcount=server.hopCount, nearhop=server.nearHop)
         for u in self.ircd.users.itervalues():
             self.callRemote(RegisterUser, uuid=u.uuid, nick=u.nickname, ident=u.username, host=u.hostname, realhost=u.realhost, gecos=u.realname, ip=u.ip, password=u.password if u.password else "", server=u.server, secure=u.socket.secure, signon=epoch(u.signon), nickts=epoch(u.nicktime))
-            modes = []
-            params = []
-            for mode, param in u.mode.iteritems():
-                if self.ircd.user_mode_type[mode] == 0:
-                    for item in param:
-                        modes.append(mode)
-                        params.append(item)
-                elif param is None:
-                    modes.append(mode)
-                else:
-                    modes.append(mode)
-                    params.append(param)
+            modes, params = self.burstModes(u.mode, self.ircd.user_mode_type)
             self.callRemote(SetMode, target=u.uuid, targetts=epoch(u.signon), source=u.prefix(), modestring="+{}".format("".join(modes)), params=params)
             for namespace, data in u.metadata.iteritems():
                 for key, value in data.iteritems():
@@ -735,23 +933,203 @@ class ServerProtocol(AMP):
                 for mode in status:
                     modes.append(mode)
                     params.append(u.nickname)
-            for mode, param in chan.mode.iteritems():
-                if self.ircd.channel_mode_type[mode] == 0:
-                    for item in param:
-                        modes.append(mode)
-                        params.append(item)
-                elif param is None:
-                    modes.append(mode)
-                else:
-                    modes.append(mode)
-                    params.append(param)
-            self.callRemote(SetMode, target=chan.name, targetts=epoch(chan.created), source=self.ircd.name, modestring="+{}".format("".join(modes)), params=params)
+            chanModes, chanParams = self.burstModes(chan.mode, self.ircd.channel_mode_type)
+            self.callRemote(SetMode, target=chan.name, targetts=epoch(chan.created), source=self.ircd.name, modestring="+{}".format("".join(modes + chanModes)), params=params + chanParams)
             if chan.topic:
                 self.callRemote(SetTopic, channel=chan.name, chants=epoch(chan.created), topic=chan.topic, topicsetter=chan.topicSetter, topicts=epoch(chan.topicTime))
             for namespace, data in chan.metadata.iteritems():
                 for key, value in data.iteritems():
                     self.callRemote(SetMetadata, target=chan.name, targetts=epoch(chan.created), namespace=namespace, key=key, value=value)
     
+    def burstModes(self, modeDict, modeTypes):
+        modes = []
+        params = []
+        for mode, param in modeDict.iteritems():
+            if modeTypes[mode] == 0:
+                for item in param:
+                    modes.append(mode)
+                    params.append(item)
+            elif param is None:
+                modes.append(mode)
+            else:
+                modes.append(mode)
+                params.append(param)
+        return modes, params
+    
+    def burstMetadata(self, metadata):
+        flatMetadata = []
+        for namespace, data in metadata.iteritems():
+            for key, value in data.iteritems():
+                flatMetadata.extend((namespace, key, value))
+        return flatMetadata
+    
+    def burstMetadataCommands(self, target, targetts, metadata):
+        commands = []
+        for namespace, data in metadata.iteritems():
+            for key, value in data.iteritems():
+                commands.append((SetMetadata, { "target": target, "targetts": targetts, "namespace": namespace, "key": key, "value": value }))
+        return commands
+    
+    def sendCompactBurst(self, serverOrder):
+        # The whole burst is put together now so that it's a consistent snapshot of the network.  It's then sent a chunk
+        # at a time as the transport can take it, and anything that happens in the meantime is held until it's done.
+        burst = []
+        for server in serverOrder:
+            burst.append((AddNewServer, { "name": server.name, "description": server.description, "hopcount": server.hopCount, "nearhop": server.nearHop }))
+        userRecords = []
+        userMetadata = []
+        for u in self.ircd.users.itervalues():
+            modes, params = self.burstModes(u.mode, self.ircd.user_mode_type)
+            userRecords.append({
+                "uuid": u.uuid,
+                "nick": u.nickname,
+                "ident": u.username,
+                "host": u.hostname,
+                "realhost": u.realhost,
+                "gecos": u.realname,
+                "ip": u.ip,
+                "password": u.password if u.password else "",
+                "server": u.server,
+                "secure": u.socket.secure,
+                "signon": epoch(u.signon),
+                "nickts": epoch(u.nicktime),
+                "modestring": "".join(modes),
+                "modeparams": params,
+                "metadata": self.burstMetadata(u.metadata)
+            })
+            if burst_record_size(userRecords[-1]) > burst_chunk_size:
+                # Too much metadata to fit in a message with the user, so it's sent separately after the users
+                userRecords[-1]["metadata"] = []
+                userMetadata.extend(self.burstMetadataCommands(u.uuid, epoch(u.signon), u.metadata))
+        for chunk in chunk_burst_records(userRecords):
+            burst.append((BurstUsers, { "users": chunk }))
+        burst.extend(userMetadata)
+        channelRecords = []
+        channelMetadata = []
+        for chan in self.ircd.channels.itervalues():
+            modes, params = self.burstModes(chan.mode, self.ircd.channel_mode_type)
+            record = {
+                "channel": chan.name,
+                "chants": epoch(chan.created),
+                "members": [],
+                "statuses": [],
+                "modestring": "".join(modes),
+                "modeparams": params,
+                "topic": chan.topic,
+                "topicsetter": chan.topicSetter,
+                "topicts": epoch(chan.topicTime),
+                "metadata": self.burstMetadata(chan.metadata)
+            }
+            recordSize = burst_record_size(record)
+            if recordSize > burst_chunk_size / 2:
+                record["metadata"] = []
+                recordSize = burst_record_size(record)
+                channelMetadata.extend(self.burstMetadataCommands(chan.name, epoch(chan.created), chan.metadata))
+            for u, status in chan.users.iteritems():
+                memberSize = len(u.uuid) + len(status) + 4
+                if record["members"] and recordSize + memberSize > burst_chunk_size / 2:
+                    channelRecords.append(record)
+                    record = {
+                        "channel": chan.name,
+                        "chants": epoch(chan.created),
+                        "members": [],
+                        "statuses": [],
+                        "modestring": "",
+                        "modeparams": [],
+                        "topic": "",
+                        "topicsetter": "",
+                        "topicts": 0,
+                        "metadata": []
+                    }
+                    recordSize = burst_record_size(record)
+                record["members"].append(u.uuid)
+                record["statuses"].append(status)
+                recordSize += memberSize
+            channelRecords.append(record)
+        for chunk in chunk_burst_records(channelRecords):
+            burst.append((BurstChannels, { "channels": chunk }))
+        burst.extend(channelMetadata)
+        
+        self.flushBatch()
+        self.burstStarted = time()
+        self.sendLinkNotice("Bursting to {}: {} users and {} channels in {} messages".format(self.name, len(userRecords), len(self.ircd.channels), len(burst)))
+        self.burstTask = cooperate(self.burstSender(burst))
+        self.transport.registerProducer(BurstProducer(self.burstTask), True)
+        d = self.burstTask.whenDone()
+        d.addCallbacks(self.burstFinished, self.burstFailed, callbackArgs=(len(burst),))
+    
+    def burstSender(self, burst):
+        total = len(burst)
+        nextReport = 1
+        for index, (command, kw) in enumerate(burst):
+            AMP.callRemote(self, command, **kw)
+            if total >= 20 and (index + 1) * 4 >= total * nextReport and nextReport < 4:
+                self.sendLinkNotice("Burst to {} is {}% complete".format(self.name, nextReport * 25))
+                nextReport += 1
+            yield None
+    
+    def burstFinished(self, result, messageCount):
+        self.burstTask = None
+        self.transport.unregisterProducer()
+        self.sendLinkNotice("Burst to {} complete: sent {} messages in {:.2f} seconds".format(self.name, messageCount, time() - self.burstStarted))
+        self.flushBatch()
+    
+    def burstFailed(self, failure):
+        if failure.check(TaskStopped):
+            return # The link was lost during the burst
+        self.burstTask = None
+        self.transport.unregisterProducer()
+        logger.msg("link", "error", "Burst to {} failed: {!r}", self.name, failure.value)
+        self.sendLinkNotice("Burst to {} failed; dropping the link".format(self.name))
+        self.transport.loseConnection()
+    
+    def sendLinkNotice(self, message):
+        logger.msg("link", "info", message)
+        if "sendservernotice" in self.ircd.module_data_cache:
+            self.ircd.module_data_cache["sendservernotice"]("link", message)
+    
+    def burstUsers(self, users):
+        if not self.name:
+            raise HandshakeNotYetComplete ("The initial handshake has not occurred over this link.")
+        for u in users:
+            self.addUser(u["uuid"], u["nick"], u["ident"], u["host"], u["realhost"], u["gecos"], u["ip"], u["password"], u["server"], u["secure"], u["signon"], u["nickts"])
+            if u["uuid"] not in self.ircd.userid:
+                continue # The user lost a nick collision
+            udata = self.ircd.userid[u["uuid"]]
+            if u["modestring"]:
+                self.setMode(u["uuid"], u["signon"], udata.prefix(), "+{}".format(u["modestring"]), u["modeparams"])
+            metadata = u["metadata"]
+            for i in range(0, len(metadata) - 2, 3):
+                self.setMetadata(u["uuid"], u["signon"], metadata[i], metadata[i+1], metadata[i+2])
+        return {}
+    BurstUsers.responder(burstUsers)
+    
+    def burstChannels(self, channels):
+        if not self.name:
+            raise HandshakeNotYetComplete ("The initial handshake has not occurred over this link.")
+        for chan in channels:
+            modes = []
+            params = []
+            for uuid, status in zip(chan["members"], chan["statuses"]):
+                self.joinChannel(chan["channel"], uuid, chan["chants"])
+                if status and uuid in self.ircd.userid:
+                    nick = self.ircd.userid[uuid].nickname
+                    for mode in status:
+                        modes.append(mode)
+                        params.append(nick)
+            modes.append(chan["modestring"])
+            params.extend(chan["modeparams"])
+            modestring = "".join(modes)
+            if modestring and chan["channel"] in self.ircd.channels:
+                self.setMode(chan["channel"], chan["chants"], self.name, "+{}".format(modestring), params)
+            if chan["topic"]:
+                self.setTopic(chan["channel"], chan["chants"], chan["topic"], chan["topicsetter"], chan["topicts"])
+            metadata = chan["metadata"]
+            for i in range(0, len(metadata) - 2, 3):
+                self.setMetadata(chan["channel"], chan["chants"], metadata[i], metadata[i+1], metadata[i+2])
+        return {}
+    BurstChannels.responder(burstChannels)
+    
     def newServer(self, name, description, hopcount, nearhop):
         if not self.name:
             raise HandshakeNotYetComplete ("The initial handshake has not occurred over this link.")
@@ -768,8 +1146,9 @@ class ServerProtocol(AMP):
             if nearhop in server.remoteServers:
                 server.remoteServers.add(name)
         self.ircd.servers[name] = newServer
-        for server in self.ircd.servers.itervalues():
-            if server.nearHop == self.ircd.name and server != self:
+        self.ircd.rebuild_server_routes()
+        for server in self.ircd.linked_servers:
+            if server != self:
                 # The server is connected to this server but is NOT this server link
                 # so that it goes to each server once and does not get sent back where it came from
                 server.callRemote(AddNewServer, name=name, description=description, hopcount=hopcount+1, nearhop=nearhop)
@@ -788,6 +1167,7 @@ class ServerProtocol(AMP):
         leavingServers.add(name)
         for servname in leavingServers:
             del self.ircd.servers[servname]
+        self.ircd.rebuild_server_routes()
         for server in self.ircd.servers.itervalues():
             for servname in leavingServers: # Remove splitting servers from all remoteServers sets
                 server.remoteServers.discard(servname)
@@ -808,17 +1188,27 @@ class ServerProtocol(AMP):
             for servname in self.remoteServers:
                 del self.ircd.servers[servname]
             del self.ircd.servers[self.name]
+            self.ircd.rebuild_server_routes()
             for server in self.ircd.servers.itervalues():
                 server.remoteServers.discard(self.name)
                 for servname in self.remoteServers:
                     server.remoteServers.discard(servname)
-            for server in self.ircd.servers.itervalues():
-                if self.ircd.name == server.nearHop:
-                    server.callRemote(DisconnectServer, name=self.name)
+            for server in self.ircd.linked_servers:
+                server.callRemote(DisconnectServer, name=self.name)
             for action in self.ircd.actions["netsplit"]:
                 action(self.name)
                 for server in self.remoteServers:
                     action(server)
+        if self.batchFlusher is not None:
+            self.batchFlusher.cancel()
+            self.batchFlusher = None
+        heldCommands = [box for box in self.outgoingBatch if isinstance(box, tuple)]
+        self.outgoingBatch = []
+        for command, kw, answer in heldCommands:
+            answer.errback(reason)
+        if self.burstTask is not None:
+            self.burstTask.stop()
+            self.burstTask = None
         self.pinger.stop()
         self.disconnected.callback(None)
         AMP.connectionLost(self, reason)
@@ -833,8 +1223,8 @@ class ServerProtocol(AMP):
         newUser = RemoteUser(self.ircd, uuid, None, None, None, None, None, ip, None, server, secure, datetime.utcfromtimestamp(signon), now())
         newUser.registered = 1
         self.ircd.userid[uuid] = newUser
-        for remoteserver in self.ircd.servers.itervalues():
-            if remoteserver.nearHop == self.ircd.name and remoteserver != self:
+        for remoteserver in self.ircd.linked_servers:
+            if remoteserver != self:
                 remoteserver.callRemote(ConnectUser, uuid=uuid, ip=ip, server=server, secure=secure, signon=signon)
         return {}
     ConnectUser.responder(basicConnectUser)
@@ -880,6 +1270,7 @@ class ServerProtocol(AMP):
             newUser.nickname = nick
             newUser.username = ident
             newUser.hostname = host
+            newUser.prefixString = None
             newUser.realhost = realhost
             newUser.realname = gecos
             newUser.password = password if password else None
@@ -892,8 +1283,8 @@ class ServerProtocol(AMP):
         self.ircd.users[nick] = newUser
         self.ircd.userid[uuid] = newUser
         newUser.callConnectHooks()
-        for linkedServer in self.ircd.servers.itervalues():
-            if linkedServer.nearHop == self.ircd.name and linkedServer != self:
+        for linkedServer in self.ircd.linked_servers:
+            if linkedServer != self:
                 linkedServer.callRemote(RegisterUser, uuid=uuid, nick=nick, ident=ident, host=host, realhost=realhost, gecos=gecos, ip=ip, password=password, server=server, secure=secure, signon=signon, nickts=nickts)
         return {}
     RegisterUser.responder(addUser)
@@ -957,8 +1348,8 @@ class ServerProtocol(AMP):
         udata = self.ircd.userid[user]
         if channel in self.ircd.channels:
             cdata = self.ircd.channels[channel]
-            for server in self.ircd.servers.itervalues(): # Propagate first so the chancreate hook can't screw things up (if being created)
-                if server.nearHop == self.ircd.name and server != self:
+            for server in self.ircd.linked_servers: # Propagate first so the chancreate hook can't screw things up (if being created)
+                if server != self:
                     server.callRemote(JoinChannel, channel=cdata.name, chants=epoch(cdata.created), user=udata.uuid)
             chantime = datetime.utcfromtimestamp(chants)
             if chantime < cdata.created:
@@ -992,8 +1383,8 @@ class ServerProtocol(AMP):
             cdata = IRCChannel(self.ircd, channel)
             cdata.created = datetime.utcfromtimestamp(chants)
             cdata.topicTime = cdata.created
-            for server in self.ircd.servers.itervalues(): # Propagate first so the chancreate hook can't screw things up (if being created)
-                if server.nearHop == self.ircd.name and server != self:
+            for server in self.ircd.linked_servers: # Propagate first so the chancreate hook can't screw things up (if being created)
+                if server != self:
                     server.callRemote(JoinChannel, channel=cdata.name, chants=epoch(cdata.created), user=udata.uuid)
             self.ircd.channels[channel] = cdata
             for action in self.ircd.actions["chancreate"]:
@@ -1001,6 +1392,7 @@ class ServerProtocol(AMP):
         if udata in cdata.users:
             return {}
         cdata.users[udata] = ""
+        udata.channels.add(cdata)
         joinShowUsers = cdata.users.keys()
         tryagain = []
         for action in self.ircd.actions["joinmessage"]:
@@ -1011,9 +1403,7 @@ class ServerProtocol(AMP):
                 joinShowUsers = result
         for action in tryagain:
             joinShowUsers = action(cdata, udata, joinShowUsers)
-        for u in joinShowUsers:
-            if u.server == self.ircd.name:
-                u.sendMessage("JOIN", to=cdata.name, prefix=udata.prefix())
+        self.ircd.broadcast([u for u in joinShowUsers if u.server == self.ircd.name], "JOIN", to=cdata.name, prefix=udata.prefix())
         if cdata.topic and udata.server == self.ircd.name:
             udata.sendMessage(irc.RPL_TOPIC, cdata.name, ":{}".format(cdata.topic))
             udata.sendMessage(irc.RPL_TOPICWHOTIME, cdata.name, cdata.topicSetter, str(epoch(cdata.topicTime)))
@@ -1110,9 +1500,13 @@ class ServerProtocol(AMP):
                         del data.mode[mode]
             else:
                 if adding:
+                    if targettype == "user" and mode not in data.mode:
+                        self.ircd.users.modeChanged(data, mode, True)
                     data.mode[mode] = param
                 else:
                     del data.mode[mode]
+                    if targettype == "user":
+                        self.ircd.users.modeChanged(data, mode, False)
                 modeDisplay.append([adding, mode, param])
         if modeDisplay:
             adding = None
@@ -1132,10 +1526,9 @@ class ServerProtocol(AMP):
             if targettype == "user":
                 data.sendMessage("MODE", modeLine, prefix=source)
             else:
-                for u in data.users:
-                    u.sendMessage("MODE", modeLine, to=data.name, prefix=source)
-            for server in self.ircd.servers.itervalues():
-                if server.nearHop == self.ircd.name and server != self:
+                self.ircd.broadcast(data.users.iterkeys(), "MODE", modeLine, to=data.name, prefix=source)
+            for server in self.ircd.linked_servers:
+                if server != self:
                     server.callRemote(SetMode, target=target, targetts=targetts, source=source, modestring="".join(modestr), params=showParams)
         return {}
     SetMode.responder(setMode)
@@ -1156,11 +1549,9 @@ class ServerProtocol(AMP):
             cdata.topic = topic
             cdata.topicSetter = topicsetter
             cdata.topicTime = topictime
-            for u in cdata.users.iterkeys():
-                if u.server == self.ircd.name:
-                    u.sendMessage("TOPIC", ":{}".format(topic), to=cdata.name, prefix=topicsetter)
-            for server in self.ircd.servers.itervalues():
-                if server.nearHop == self.ircd.name and server != self:
+            self.ircd.broadcast([u for u in cdata.users.iterkeys() if u.server == self.ircd.name], "TOPIC", ":{}".format(topic), to=cdata.name, prefix=topicsetter)
+            for server in self.ircd.linked_servers:
+                if server != self:
                     server.callRemote(SetTopic, channel=channel, chants=chants, topic=topic, topicsetter=topicsetter, topicts=topicts)
         return {}
     SetTopic.responder(setTopic)
@@ -1183,19 +1574,16 @@ class ServerProtocol(AMP):
         del self.ircd.users[udata.nickname]
         self.ircd.users[newnick] = udata
         notify = set()
-        for cdata in self.ircd.channels.itervalues():
-            if udata in cdata.users:
-                for cuser in cdata.users.iterkeys():
-                    notify.add(cuser)
-        prefix = udata.prefix()
-        for u in notify:
-            if u.server == self.ircd.name:
-                u.sendMessage("NICK", to=newnick, prefix=prefix)
+        for cdata in udata.channels:
+            for cuser in cdata.users.iterkeys():
+                notify.add(cuser)
+        self.ircd.broadcast([u for u in notify if u.server == self.ircd.name], "NICK", to=newnick, prefix=udata.prefix())
         oldNick = udata.nickname
         udata.nickname = newnick
+        udata.prefixString = None
         udata.nicktime = now()
-        for server in self.ircd.servers.itervalues():
-            if server.nearHop == self.ircd.name and server != self:
+        for server in self.ircd.linked_servers:
+            if server != self:
                 server.callRemote(ChangeNick, user=user, newnick=newnick)
         for action in self.ircd.actions["nick"]:
             action(udata, oldNick)
@@ -1226,7 +1614,7 @@ class ServerProtocol(AMP):
         if not self.name:
             raise HandshakeNotYetComplete ("The initial handshake has not occurred over this link.")
         if user not in self.ircd.userid:
-            raise NoSuchUser ("The user {} is not connected to the network.".format(user))
+            return {} # The user may have quit while the message was on its way here
         udata = self.ircd.userid[user]
         if not prefix:
             prefix = None
@@ -0,0 +1,68 @@
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+from txircd import utils
+from txircd.utils import ExpiryQueue
+import time
+
+class ExpiryQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.clock.advance(time.time())
+        self.patch(utils, "reactor", self.clock)
+        self.lines = {}
+        self.queue = ExpiryQueue(self.lines)
+    
+    def addLine(self, key, age, duration):
+        self.lines[key] = {
+            "created": int(time.time()) - age,
+            "duration": duration
+        }
+        self.queue.add(key)
+    
+    def test_expiredLineRemoved(self):
+        self.addLine("old", 100, 10)
+        self.addLine("new", 0, 3600)
+        self.clock.advance(0)
+        self.assertEqual(self.lines.keys(), ["new"])
+        self.assertTrue(self.queue._timer.active()) # Waiting on the next line now
+    
+    def test_permanentLineNotQueued(self):
+        self.addLine("forever", 100, 0)
+        self.assertEqual(self.queue._heap, [])
+        self.assertEqual(self.queue._timer, None)
+    
+    def test_waitsForSoonestLine(self):
+        self.addLine("later", 0, 3600)
+        self.addLine("sooner", 0, 60)
+        self.assertTrue(self.queue._timer.getTime() - self.clock.seconds() <= 61)
+    
+    def test_lineRemovedEarly(self):
+        self.addLine("gone", 100, 10)
+        del self.lines["gone"]
+        self.clock.advance(0)
+        self.assertEqual(self.queue._heap, [])
+    
+    def test_lineSetAgain(self):
+        # The line's old heap entry is still queued, but it shouldn't remove the new line
+        self.addLine("reset", 100, 10)
+        self.addLine("reset", 0, 3600)
+        self.assertEqual(len(self.queue._heap), 2)
+        self.clock.advance(0)
+        self.assertIn("reset", self.lines)
+        self.assertEqual(len(self.queue._heap), 1)
+    
+    def test_stop(self):
+        self.addLine("line", 0, 60)
+        self.queue.stop()
+        self.assertEqual(self.queue._timer, None)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+    
+    def test_onExpireCalled(self):
+        expired = []
+        self.queue = ExpiryQueue(self.lines, expired.append)
+        self.addLine("old", 100, 10)
+        self.addLine("reset", 100, 10)
+        self.addLine("reset", 0, 3600) # Lines set again don't count as expiring when their old entry comes up
+        self.clock.advance(0)
+        self.assertEqual(expired, ["old"])
+        self.queue.stop()
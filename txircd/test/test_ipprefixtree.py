@@ -0,0 +1,72 @@
+from twisted.trial import unittest
+from txircd import utils
+from txircd.utils import parse_cidr, IPPrefixTree
+import socket
+
+class IPPrefixTreeTest(unittest.TestCase):
+    def setUp(self):
+        self.tree = IPPrefixTree()
+    
+    def search(self, address):
+        return list(self.tree.search(*utils.ip_to_number(address)))
+    
+    def test_parseCidr(self):
+        self.assertEqual(parse_cidr("10.0.0.0/8"), (socket.AF_INET, 10, 8))
+        self.assertEqual(parse_cidr("10.0.0.0|8"), (socket.AF_INET, 10, 8))
+        self.assertEqual(parse_cidr("2001:db8::/32"), (socket.AF_INET6, 0x20010db8, 32))
+        self.assertEqual(parse_cidr("10.0.0.0"), None)
+        self.assertEqual(parse_cidr("10.0.0.0/33"), None)
+        self.assertEqual(parse_cidr("10.0.0.0/x"), None)
+        self.assertEqual(parse_cidr("host.name/8"), None)
+    
+    def test_searchLeastSpecificFirst(self):
+        self.tree.add(parse_cidr("10.1.0.0/16"), "narrow")
+        self.tree.add(parse_cidr("10.0.0.0/8"), "wide")
+        self.tree.add(parse_cidr("10.1.2.3/32"), "host")
+        self.assertEqual(self.search("10.1.2.3"), ["wide", "narrow", "host"])
+        self.assertEqual(self.search("10.1.2.4"), ["wide", "narrow"])
+        self.assertEqual(self.search("10.2.0.1"), ["wide"])
+        self.assertEqual(self.search("11.0.0.1"), [])
+    
+    def test_wholeAddressSpace(self):
+        self.tree.add(parse_cidr("0.0.0.0/0"), "everything")
+        self.assertEqual(self.search("203.0.113.9"), ["everything"])
+        self.assertEqual(self.search("2001:db8::1"), [])
+    
+    def test_ipv6(self):
+        self.tree.add(parse_cidr("2001:db8::/32"), "net")
+        self.tree.add(parse_cidr("2001:db8:1::/48"), "subnet")
+        self.assertEqual(self.search("2001:db8:1::5"), ["net", "subnet"])
+        self.assertEqual(self.search("2001:db8:2::5"), ["net"])
+        self.assertEqual(self.search("2001:db9::5"), [])
+        self.assertEqual(self.search("32.1.13.184"), []) # The same leading bits as 2001:db8::, but IPv4
+    
+    def test_sameNetworkHoldsSeveralValues(self):
+        network = parse_cidr("10.0.0.0/8")
+        self.tree.add(network, "one")
+        self.tree.add(network, "two")
+        self.assertEqual(len(self.tree), 2)
+        self.tree.remove(network, "one")
+        self.assertEqual(self.search("10.0.0.1"), ["two"])
+        self.assertEqual(len(self.tree), 1)
+    
+    def test_remove(self):
+        network = parse_cidr("10.0.0.0/8")
+        self.tree.add(network, "value")
+        self.tree.remove(network, "value")
+        self.assertEqual(self.search("10.0.0.1"), [])
+        self.assertEqual(len(self.tree), 0)
+        self.assertRaises(KeyError, self.tree.remove, network, "value")
+        self.assertRaises(KeyError, self.tree.remove, parse_cidr("10.0.0.0/9"), "value")
+        self.assertRaises(KeyError, self.tree.remove, parse_cidr("2001:db8::/32"), "value")
+    
+    def test_removePrunesTree(self):
+        self.tree.add(parse_cidr("10.1.0.0/16"), "narrow")
+        self.tree.add(parse_cidr("10.1.2.0/24"), "host")
+        self.tree.add(parse_cidr("2001:db8::/32"), "net")
+        self.tree.remove(parse_cidr("10.1.2.0/24"), "host")
+        self.assertEqual(self.tree._node(parse_cidr("10.1.2.0/24"), False), None)
+        self.assertEqual(self.search("10.1.2.3"), ["narrow"]) # The node still holding a value is kept
+        self.tree.remove(parse_cidr("10.1.0.0/16"), "narrow")
+        self.tree.remove(parse_cidr("2001:db8::/32"), "net")
+        self.assertEqual(self.tree._roots, {})
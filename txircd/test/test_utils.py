@@ -0,0 +1,135 @@
+from twisted.trial import unittest
+from txircd.utils import irc_lower, MaskDictionary
+
+class MaskDictionaryTest(unittest.TestCase):
+    def setUp(self):
+        self.masks = MaskDictionary()
+    
+    def test_exactMatch(self):
+        self.masks["Someone@Host.Example.com"] = "exact"
+        self.assertEqual(self.masks.match("someone@host.example.com"), "someone@host.example.com")
+        self.assertEqual(self.masks.match("SOMEONE@HOST.EXAMPLE.COM"), "someone@host.example.com")
+        self.assertEqual(self.masks.match("someone@host.example.org"), None)
+        self.assertEqual(self.masks["someone@HOST.example.com"], "exact")
+    
+    def test_wildcardMatch(self):
+        self.masks["*@*.example.com"] = "wildcard"
+        self.masks["bad?@*"] = "wildcard"
+        self.assertEqual(self.masks.match("user@irc.example.com"), "*@*.example.com")
+        self.assertEqual(self.masks.match("bad1@example.org"), "bad?@*")
+        self.assertEqual(self.masks.match("bad12@example.org"), None)
+        self.assertEqual(self.masks.match("user@example.com"), None)
+    
+    def test_wildcardMatchesSpecialCharacters(self):
+        self.masks["[a]*@host.name"] = "wildcard"
+        self.assertEqual(self.masks.match("{a}b@host.name"), irc_lower("[a]*@host.name"))
+        self.assertEqual(self.masks.match("ab@host.name"), None)
+        self.assertEqual(self.masks.match("{a}b@host+name"), None)
+    
+    def test_firstMatchingSubject(self):
+        self.masks["user@10.0.0.1"] = "exact"
+        self.assertEqual(self.masks.match("user@host.example.com", "user@10.0.0.1"), "user@10.0.0.1")
+    
+    def test_cidrMatch(self):
+        self.masks["*@10.0.0.0/8"] = "cidr"
+        # irc_lower turns the / into a |, which is how the mask is stored and returned
+        self.assertEqual(self.masks.match("user@10.1.2.3"), "*@10.0.0.0|8")
+        self.assertIn("*@10.0.0.0/8", self.masks)
+        self.assertEqual(self.masks.match("user@11.1.2.3"), None)
+        self.assertEqual(self.masks.match("user@host.example.com"), None)
+    
+    def test_cidrWithPipe(self):
+        self.masks["*@192.168.0.0|16"] = "cidr"
+        self.assertEqual(self.masks.match("user@192.168.40.2"), "*@192.168.0.0|16")
+        self.assertEqual(self.masks.match("user@192.169.40.2"), None)
+    
+    def test_cidrWithUserPattern(self):
+        self.masks["bob@192.168.0.0/16"] = "cidr"
+        self.masks["j*@172.16.0.0/12"] = "cidr"
+        self.assertEqual(self.masks.match("bob@192.168.5.5"), "bob@192.168.0.0|16")
+        self.assertEqual(self.masks.match("alice@192.168.5.5"), None)
+        self.assertEqual(self.masks.match("joe@172.20.1.1"), "j*@172.16.0.0|12")
+        self.assertEqual(self.masks.match("moe@172.20.1.1"), None)
+    
+    def test_cidrWithoutUser(self):
+        self.masks["192.168.0.0/16"] = "cidr"
+        self.assertEqual(self.masks.match("192.168.1.1"), "192.168.0.0|16")
+        self.assertEqual(self.masks.match("user@192.168.1.1"), None)
+    
+    def test_cidrMostGeneralFirst(self):
+        self.masks["*@10.1.0.0/16"] = "narrow"
+        self.masks["*@10.0.0.0/8"] = "wide"
+        self.assertEqual(self.masks.match("user@10.1.2.3"), "*@10.0.0.0|8")
+    
+    def test_ipv6Cidr(self):
+        self.masks["*@2001:db8::/32"] = "cidr"
+        self.assertEqual(self.masks.match("user@2001:db8::1"), "*@2001:db8::|32")
+        self.assertEqual(self.masks.match("user@2001:DB8:ffff::1"), "*@2001:db8::|32")
+        self.assertEqual(self.masks.match("user@2001:db9::1"), None)
+        self.assertEqual(self.masks.match("user@10.0.0.1"), None)
+    
+    def test_ipv6Exact(self):
+        self.masks["user@2001:db8::1"] = "exact"
+        self.assertEqual(self.masks.match("USER@2001:DB8::1"), "user@2001:db8::1")
+        self.assertEqual(self.masks.match("user@2001:db8::2"), None)
+    
+    def test_invalidCidrIsWildcardOrExact(self):
+        self.masks["*@10.0.0.0/33"] = "not cidr"
+        self.masks["*@300.0.0.0/8"] = "not cidr"
+        self.assertEqual(len(self.masks._networks), 0)
+        self.assertEqual(self.masks.match("user@10.0.0.1"), None)
+        self.assertEqual(self.masks.match("user@10.0.0.0|33"), "*@10.0.0.0|33")
+    
+    def test_manyWildcards(self):
+        count = MaskDictionary.regex_group_limit * 2 + 52
+        for i in xrange(count):
+            self.masks["*@host{}.*".format(i)] = i
+        self.masks.compile()
+        self.assertEqual(len(self.masks._wildcard), 3)
+        for expression, masks in self.masks._wildcard:
+            self.assertTrue(len(masks) <= MaskDictionary.regex_group_limit)
+        for i in xrange(count):
+            self.assertEqual(self.masks.match("user@host{}.example.com".format(i)), "*@host{}.*".format(i))
+        self.assertEqual(self.masks.match("user@host{}.example.com".format(count)), None)
+    
+    def test_deleteExact(self):
+        self.masks["user@host"] = "exact"
+        del self.masks["USER@HOST"]
+        self.assertEqual(self.masks.match("user@host"), None)
+        self.assertNotIn("user@host", self.masks)
+    
+    def test_deleteWildcard(self):
+        self.masks["*@*.example.com"] = "wildcard"
+        self.masks["*@*.example.org"] = "wildcard"
+        self.assertEqual(self.masks.match("user@irc.example.com"), "*@*.example.com")
+        del self.masks["*@*.example.com"]
+        self.assertEqual(self.masks.match("user@irc.example.com"), None)
+        self.assertEqual(self.masks.match("user@irc.example.org"), "*@*.example.org")
+    
+    def test_deleteCidr(self):
+        self.masks["*@10.0.0.0/8"] = "cidr"
+        self.masks["*@2001:db8::/32"] = "cidr"
+        del self.masks["*@10.0.0.0/8"]
+        self.assertEqual(self.masks.match("user@10.1.2.3"), None)
+        self.assertEqual(self.masks.match("user@2001:db8::1"), "*@2001:db8::|32")
+        del self.masks["*@2001:db8::|32"]
+        self.assertEqual(self.masks.match("user@2001:db8::1"), None)
+        self.assertEqual(len(self.masks._networks), 0)
+    
+    def test_deleteMissing(self):
+        self.assertRaises(KeyError, self.masks.__delitem__, "user@host")
+        self.masks["*@10.0.0.0/8"] = "cidr"
+        self.assertRaises(KeyError, self.masks.__delitem__, "*@10.0.0.0/9")
+    
+    def test_replaceKeepsOneEntry(self):
+        self.masks["*@10.0.0.0/8"] = "first"
+        self.masks["*@10.0.0.0/8"] = "second"
+        self.assertEqual(len(self.masks._networks), 1)
+        del self.masks["*@10.0.0.0/8"]
+        self.assertEqual(self.masks.match("user@10.1.2.3"), None)
+    
+    def test_matchUsers(self):
+        self.masks["*@*.example.com"] = "wildcard"
+        users = ["a@irc.example.com", "b@irc.example.org", "c@www.example.com"]
+        self.assertEqual(self.masks.matchUsers(users, lambda user: (user,)), [("a@irc.example.com", "*@*.example.com"), ("c@www.example.com", "*@*.example.com")])
+        self.assertEqual(MaskDictionary().matchUsers(users, lambda user: (user,)), [])
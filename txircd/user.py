@@ -2,10 +2,13 @@ from twisted.internet import reactor
 from twisted.python import log
 from twisted.words.protocols import irc
 from twisted.internet.defer import Deferred
+from twisted.internet.threads import deferToThread
 from txircd.channel import IRCChannel
+from txircd.logger import logger
 from txircd.server import ChangeNick, JoinChannel, LeaveChannel, RegisterUser, RemoveUser, SetHost, SetIdent, SetMetadata, SetMode, SetName
-from txircd.utils import irc_lower, now, epoch, CaseInsensitiveDictionary, chunk_message, IPV4_MAPPED_ADDR
-import socket, uuid
+from txircd.utils import irc_lower, now, epoch, CaseInsensitiveDictionary, chunk_message, resolve_hostname, IPV4_MAPPED_ADDR
+from time import time
+import uuid
 
 class IRCUser(object):
     def __init__(self, parent):
@@ -14,10 +17,7 @@ class IRCUser(object):
         mapped = IPV4_MAPPED_ADDR.match(ip)
         if mapped:
             ip = mapped.group(1)
-        try:
-            hostname = socket.gethostbyaddr(ip)[0]
-        except:
-            hostname = ip
+        hostname = ip # The hostname is filled in once resolveHostname finishes looking it up
         
         # Set attributes
         self.ircd = parent.factory
@@ -25,14 +25,14 @@ class IRCUser(object):
         self.uuid = str(uuid.uuid1())
         while self.uuid in self.ircd.userid:
             self.uuid = str(uuid.uuid1())
-        for server in self.ircd.servers.itervalues():
-            if server.nearHop == self.ircd.name: # only operate on servers with the attribute
-                server.ignoreUsers.discard(self.uuid)
+        for server in self.ircd.linked_servers:
+            server.ignoreUsers.discard(self.uuid)
         self.password = None
         self.nickname = None
         self.username = None
         self.realname = None
         self.hostname = hostname
+        self.prefixString = None
         self.ip = ip
         self.realhost = hostname
         self.server = parent.factory.name
@@ -41,8 +41,10 @@ class IRCUser(object):
         self.lastactivity = now()
         self.lastpong = now()
         self.mode = {}
+        self.channels = set()
         self.disconnected = Deferred()
         self.registered = 2
+        self.dnsTimeout = None
         self.metadata = { # split into metadata key namespaces, see http://ircv3.atheme.org/specification/metadata-3.2
             "server": {},
             "user": {},
@@ -53,6 +55,36 @@ class IRCUser(object):
         self.cache = {}
         self.ircd.userid[self.uuid] = self
     
+    def resolveHostname(self):
+        cached = self.ircd.dns_cache.get(self.ip)
+        if cached and (now() - cached[1]).total_seconds() < self.ircd.servconfig["client_dns_cache_expire"]:
+            self.hostname = cached[0]
+            self.prefixString = None
+            self.realhost = cached[0]
+            return
+        def cacheHostname(hostname):
+            self.ircd.dns_cache[self.ip] = (hostname, now())
+            self.hostnameResolved(hostname)
+        self.registered += 1 # Hold off registration until the lookup completes or times out
+        self.dnsTimeout = reactor.callLater(self.ircd.servconfig["client_dns_timeout"], self.hostnameResolved, self.ip)
+        lookup = deferToThread(resolve_hostname, self.ip)
+        lookup.addCallback(cacheHostname)
+        lookup.addErrback(log.err)
+    
+    def hostnameResolved(self, hostname):
+        if self.dnsTimeout is None:
+            return # The lookup already timed out, or the user disconnected while we were waiting
+        if self.dnsTimeout.active():
+            self.dnsTimeout.cancel()
+        self.dnsTimeout = None
+        if self.hostname == self.realhost:
+            self.hostname = hostname
+            self.prefixString = None
+        self.realhost = hostname
+        self.registered -= 1
+        if self.registered == 0:
+            self.register()
+    
     def register(self):
         if self.nickname in self.ircd.users:
             return
@@ -62,28 +94,24 @@ class IRCUser(object):
             if outCode == "again":
                 tryagain.append(action)
             elif not outCode:
-                log.msg("The new user {} was prevented from connecting by a module.".format(self.nickname))
+                logger.msg("security", "info", "The new user {} was prevented from connecting by a module.", self.nickname)
                 return self.disconnect(None)
         for action in tryagain:
             if not action(self):
-                log.msg("The new user {} was prevented from connecting by a module.".format(self.nickname))
+                logger.msg("security", "info", "The new user {} was prevented from connecting by a module.", self.nickname)
                 return self.disconnect(None)
         
         # Add self to user list
         self.ircd.users[self.nickname] = self
         
         # Send notification of connection to other servers
-        for server in self.ircd.servers.itervalues():
-            if server.nearHop == self.ircd.name:
-                server.callRemote(RegisterUser, uuid=self.uuid, nick=self.nickname, ident=self.username, host=self.hostname, realhost=self.realhost, gecos=self.realname, ip=self.ip, password=self.password if self.password else "", server=self.server, secure=self.socket.secure, signon=epoch(self.signon), nickts=epoch(self.nicktime))
+        for server in self.ircd.linked_servers:
+            server.callRemote(RegisterUser, uuid=self.uuid, nick=self.nickname, ident=self.username, host=self.hostname, realhost=self.realhost, gecos=self.realname, ip=self.ip, password=self.password if self.password else "", server=self.server, secure=self.socket.secure, signon=epoch(self.signon), nickts=epoch(self.nicktime))
         
         # Send all those lovely join messages
-        chanmodelist = "".join("".join(["".join(modedict.keys()) for modedict in self.ircd.channel_modes]) + "".join(self.ircd.prefixes.keys()))
-        usermodelist = "".join(["".join(modedict.keys()) for modedict in self.ircd.user_modes])
         self.sendMessage(irc.RPL_WELCOME, ":Welcome to the Internet Relay Network {}".format(self.prefix()))
-        self.sendMessage(irc.RPL_YOURHOST, ":Your host is {}, running version {}".format(self.ircd.servconfig["server_network_name"], self.ircd.version))
-        self.sendMessage(irc.RPL_CREATED, ":This server was created {}".format(self.ircd.created))
-        self.sendMessage(irc.RPL_MYINFO, self.ircd.servconfig["server_network_name"], self.ircd.version, usermodelist, chanmodelist) # usermodes & channel modes
+        for message in self.ircd.get_welcome_burst()["info"]:
+            self.sendMessage(*message)
         self.send_isupport()
         self.send_lusers()
         self.send_motd()
@@ -91,23 +119,13 @@ class IRCUser(object):
             action(self)
     
     def send_isupport(self):
-        isupport = []
-        for key, value in self.ircd.isupport.iteritems():
-            if value is None:
-                isupport.append(key)
-            else:
-                isupport.append("{}={}".format(key, value))
-        prevar_len = len(" ".join([self.ircd.name, irc.RPL_ISUPPORT, self.nickname])) + 31 # including ":are supported by this server"
-        thisline = []
-        while isupport:
-            if len(" ".join(thisline)) + len(isupport[0]) + prevar_len > 509:
-                self.sendMessage(irc.RPL_ISUPPORT, " ".join(thisline), ":are supported by this server")
-                thisline = []
-            thisline.append(isupport.pop(0))
-        if thisline:
-            self.sendMessage(irc.RPL_ISUPPORT, " ".join(thisline), ":are supported by this server")
+        for message in self.ircd.get_welcome_burst()["isupport"]:
+            self.sendMessage(*message)
     
     def disconnect(self, reason, sourceServer = None):
+        if self.dnsTimeout:
+            self.dnsTimeout.cancel()
+            self.dnsTimeout = None
         if self.uuid in self.ircd.userid:
             del self.ircd.userid[self.uuid]
             if self.registered == 0:
@@ -115,10 +133,8 @@ class IRCUser(object):
                     modfunc(self, reason)
                 if self.nickname:
                     quitdest = set()
-                    exitChannels = []
-                    for channel in self.ircd.channels.itervalues():
-                        if self in channel.users:
-                            exitChannels.append(channel)
+                    exitChannels = self.channels
+                    self.channels = set()
                     for channel in exitChannels:
                         del channel.users[self] # remove channel user entry
                         if not channel.users:
@@ -130,17 +146,16 @@ class IRCUser(object):
                     udata = self.ircd.users[self.nickname]
                     if udata == self:
                         del self.ircd.users[self.nickname]
-                    for user in quitdest:
-                        user.sendMessage("QUIT", ":{}".format(reason), to=None, prefix=self.prefix())
-            for server in self.ircd.servers.itervalues():
-                if server.nearHop == self.ircd.name and server.name != sourceServer:
+                    self.ircd.broadcast(quitdest, "QUIT", ":{}".format(reason), to=None, prefix=self.prefix())
+            for server in self.ircd.linked_servers:
+                if server.name != sourceServer:
                     server.callRemote(RemoveUser, user=self.uuid, reason=reason)
         self.sendMessage("ERROR", ":Closing Link: {}@{} [{}]".format(self.username if self.username else "unknown", self.hostname, reason), to=None, prefix=None)
         self.socket.transport.loseConnection()
     
     def checkData(self, data):
         if data > self.ircd.servconfig["client_max_data"] and "o" not in self.mode:
-            log.msg("Killing user '{}' for flooding".format(self.nickname))
+            logger.msg("security", "warning", "Killing user '{}' for flooding", self.nickname)
             self.disconnect("Killed for flooding")
     
     def connectionLost(self, reason):
@@ -148,6 +163,16 @@ class IRCUser(object):
         self.disconnected.callback(None)
     
     def handleCommand(self, command, prefix, params):
+        timing = self.ircd.timing
+        if not timing.enabled:
+            self.runCommand(command, prefix, params)
+            return
+        start = time()
+        self.runCommand(command, prefix, params)
+        # Don't let clients make an entry for every made-up command they send
+        timing.record("command", command if command in self.ircd.commands else "(unknown)", time() - start)
+    
+    def runCommand(self, command, prefix, params):
         if command in self.ircd.commands:
             cmd = self.ircd.commands[command]
             cmd.updateActivity(self)
@@ -169,7 +194,8 @@ class IRCUser(object):
     
     def commandPermission(self, command, data):
         tryagain = set()
-        for modfunc in self.ircd.actions["commandpermission"]:
+        dispatch = self.ircd.permission_dispatch
+        for modfunc in dispatch[command] if command in dispatch else dispatch[None]:
             permData = modfunc(self, command, data)
             if permData == "again":
                 tryagain.add(modfunc)
@@ -179,28 +205,6 @@ class IRCUser(object):
                     return data
                 if not data:
                     return {}
-        for modeset in self.ircd.channel_modes:
-            for implementation in modeset.itervalues():
-                permData = implementation.checkPermission(self, command, data)
-                if permData == "again":
-                    tryagain.add(implementation.checkPermission)
-                else:
-                    data = permData
-                    if "force" in data and data["force"]:
-                        return data
-                    if not data:
-                        return {}
-        for modeset in self.ircd.user_modes:
-            for implementation in modeset.itervalues():
-                permData = implementation.checkPermission(self, command, data)
-                if permData == "again":
-                    tryagain.add(implementation.checkPermission)
-                else:
-                    data = permData
-                    if "force" in data and data["force"]:
-                        return data
-                    if not data:
-                        return {}
         for modfunc in tryagain:
             data = modfunc(self, command, data)
             if "force" in data and data["force"]:
@@ -233,8 +237,8 @@ class IRCUser(object):
         for modfunc in self.ircd.actions["metadataupdate"]:
             modfunc(self, namespace, key, oldValue, value)
         if self.registered == 0:
-            for server in self.ircd.servers.itervalues():
-                if server.nearHop == self.ircd.name and server.name != sourceServer:
+            for server in self.ircd.linked_servers:
+                if server.name != sourceServer:
                     server.callRemote(SetMetadata, target=self.uuid, targetts=epoch(self.signon), namespace=namespace, key=key, value=value)
     
     def delMetadata(self, namespace, key, sourceServer = None):
@@ -244,15 +248,18 @@ class IRCUser(object):
         for modfunc in self.ircd.actions["metadataupdate"]:
             modfunc(self, namespace, key, oldValue, "")
         if self.registered == 0:
-            for server in self.ircd.servers.itervalues():
-                if server.nearHop == self.ircd.name and server.name != sourceServer:
+            for server in self.ircd.linked_servers:
+                if server.name != sourceServer:
                     server.callRemote(SetMetadata, target=self.uuid, targetts=epoch(self.signon), namespace=namespace, key=key, value="")
     
     #=====================
     #== Utility Methods ==
     #=====================
     def prefix(self):
-        return "{}!{}@{}".format(self.nickname, self.username, self.hostname)
+        # The prefix goes out with nearly everything the user does, so it's built once and kept until the nick, ident, or host changes
+        if self.prefixString is None:
+            self.prefixString = "{}!{}@{}".format(self.nickname, self.username, self.hostname)
+        return self.prefixString
     
     def hasAccess(self, channel, level):
         if self not in channel.users or level not in self.ircd.prefixes:
@@ -264,23 +271,25 @@ class IRCUser(object):
     
     def setUsername(self, newUsername, sourceServer = None):
         self.username = str(newUsername)
+        self.prefixString = None
         if self.registered == 0:
-            for server in self.ircd.servers.itervalues():
-                if server.nearHop == self.ircd.name and server.name != sourceServer:
+            for server in self.ircd.linked_servers:
+                if server.name != sourceServer:
                     server.callRemote(SetIdent, user=self.uuid, ident=newUsername)
     
     def setHostname(self, newHostname, sourceServer = None):
         self.hostname = str(newHostname)
+        self.prefixString = None
         if self.registered == 0:
-            for server in self.ircd.servers.itervalues():
-                if server.nearHop == self.ircd.name and server.name != sourceServer:
+            for server in self.ircd.linked_servers:
+                if server.name != sourceServer:
                     server.callRemote(SetHost, user=self.uuid, host=newHostname)
     
     def setRealname(self, newRealname, sourceServer = None):
         self.realname = str(newRealname)
         if self.registered == 0:
-            for server in self.ircd.servers.itervalues():
-                if server.nearHop == self.ircd.name and server.name != sourceServer:
+            for server in self.ircd.linked_servers:
+                if server.name != sourceServer:
                     server.callRemote(SetName, user=self.uuid, gecos=newRealname)
     
     def setMode(self, user, modes, params, displayPrefix = None):
@@ -340,6 +349,8 @@ class IRCUser(object):
                     if adding:
                         if mode in self.mode and param == self.mode[mode]:
                             continue
+                        if mode not in self.mode:
+                            self.ircd.users.modeChanged(self, mode, True)
                         self.mode[mode] = param
                         modeDisplay.append([adding, mode, param])
                     else:
@@ -348,6 +359,7 @@ class IRCUser(object):
                         if modetype == 1 and param != self.mode[mode]:
                             continue
                         del self.mode[mode]
+                        self.ircd.users.modeChanged(self, mode, False)
                         modeDisplay.append([adding, mode, param])
         if modeDisplay:
             adding = None
@@ -374,9 +386,8 @@ class IRCUser(object):
                 self.sendMessage("MODE", modeLine)
                 lineSource = self.ircd.name
             
-            for server in self.ircd.servers.itervalues():
-                if server.nearHop == self.ircd.name:
-                    server.callRemote(SetMode, target=self.uuid, targetts=epoch(self.signon), source=lineSource, modestring="".join(modestring), params=showParams)
+            for server in self.ircd.linked_servers:
+                server.callRemote(SetMode, target=self.uuid, targetts=epoch(self.signon), source=lineSource, modestring="".join(modestring), params=showParams)
             for action in self.ircd.actions["mode"]:
                 action(self, lineSource, modeLine, modeDisplay)
             return modeLine
@@ -397,37 +408,18 @@ class IRCUser(object):
         return ("+{} {}".format("".join(modes), " ".join(params)) if params else "+{}".format("".join(modes)))
     
     def send_motd(self):
-        if "server_motd" in self.ircd.servconfig and self.ircd.servconfig["server_motd"]:
-            chunks = chunk_message(self.ircd.servconfig["server_motd"], self.ircd.servconfig["server_motd_line_length"])
-            self.sendMessage(irc.RPL_MOTDSTART, ":- {} Message of the day - ".format(self.ircd.servconfig["server_network_name"]))
-            for chunk in chunks:
-                line = ":- {{:{!s}}} -".format(self.ircd.servconfig["server_motd_line_length"]).format(chunk) # Dynamically inject the line length as a width argument for the line
-                self.sendMessage(irc.RPL_MOTD, line)
-            self.sendMessage(irc.RPL_ENDOFMOTD, ":End of MOTD command")
-        else:
-            self.sendMessage(irc.ERR_NOMOTD, ":MOTD File is missing")
+        for message in self.ircd.get_welcome_burst()["motd"]:
+            self.sendMessage(*message)
     
     def send_lusers(self):
-        userCount = 0
-        invisibleCount = 0
-        serverCount = 0
+        users = self.ircd.users
         networkServerCount = len(self.ircd.servers) + 1 # this server is also a server
-        operCount = 0
-        localCount = 0
-        globalCount = 0
-        for user in self.ircd.users.itervalues():
-            globalCount += 1
-            if user.server == self.ircd.name:
-                localCount += 1
-            if "i" in user.mode:
-                invisibleCount += 1
-            else:
-                userCount += 1
-            if "o" in user.mode:
-                operCount += 1
-        for server in self.ircd.servers.itervalues():
-            if self.ircd.name == server.nearHop:
-                serverCount += 1
+        serverCount = len(self.ircd.linked_servers)
+        globalCount = len(users)
+        localCount = users.localCount
+        invisibleCount = users.invisibleCount
+        userCount = globalCount - invisibleCount
+        operCount = users.operCount
         if localCount > self.ircd.usercount["localmax"]:
             self.ircd.usercount["localmax"] = localCount
         if globalCount > self.ircd.usercount["globalmax"]:
@@ -465,15 +457,15 @@ class IRCUser(object):
         if self in channel.users:
             return
         status = ""
-        for server in self.ircd.servers.itervalues(): # Send this first before the chancreate hook screws up everything
-            if server.nearHop == self.ircd.name:
-                server.callRemote(JoinChannel, channel=channel.name, chants=epoch(channel.created), user=self.uuid)
+        for server in self.ircd.linked_servers: # Send this first before the chancreate hook screws up everything
+            server.callRemote(JoinChannel, channel=channel.name, chants=epoch(channel.created), user=self.uuid)
         if channel.name not in self.ircd.channels:
             self.ircd.channels[channel.name] = channel
             for modfunc in self.ircd.actions["chancreate"]:
                 modfunc(channel)
             status = self.ircd.servconfig["channel_default_status"]
         channel.users[self] = status
+        self.channels.add(channel)
         joinShowUsers = channel.users.keys()
         tryagain = []
         for modfunc in self.ircd.actions["joinmessage"]:
@@ -484,8 +476,7 @@ class IRCUser(object):
                 joinShowUsers = result
         for modfunc in tryagain:
             joinShowUsers = modfunc(channel, self, joinShowUsers)
-        for u in joinShowUsers:
-            u.sendMessage("JOIN", to=channel.name, prefix=self.prefix())
+        self.ircd.broadcast(joinShowUsers, "JOIN", to=channel.name, prefix=self.prefix())
         if channel.topic:
             self.sendMessage(irc.RPL_TOPIC, channel.name, ":{}".format(channel.topic))
             self.sendMessage(irc.RPL_TOPICWHOTIME, channel.name, channel.topicSetter, str(epoch(channel.topicTime)))
@@ -493,20 +484,20 @@ class IRCUser(object):
             self.sendMessage(irc.RPL_NOTOPIC, channel.name, ":No topic is set")
         self.report_names(channel)
         if status:
-            for server in self.ircd.servers.itervalues():
-                if server.nearHop == self.ircd.name:
-                    server.callRemote(SetMode, target=channel.name, targetts=epoch(channel.created), source=self.ircd.name, modestring="+{}".format(status), params=[self.nickname for i in range(len(status))])
+            for server in self.ircd.linked_servers:
+                server.callRemote(SetMode, target=channel.name, targetts=epoch(channel.created), source=self.ircd.name, modestring="+{}".format(status), params=[self.nickname for i in range(len(status))])
         for modfunc in self.ircd.actions["join"]:
             modfunc(self, channel)
     
     def leave(self, channel, sourceServer = None):
         del channel.users[self] # remove channel user entry
+        self.channels.discard(channel)
         if not channel.users:
             for modfunc in self.ircd.actions["chandestroy"]:
                 modfunc(channel)
             del self.ircd.channels[channel.name] # destroy the empty channel
-        for server in self.ircd.servers.itervalues():
-            if server.nearHop == self.ircd.name and server.name != sourceServer:
+        for server in self.ircd.linked_servers:
+            if server.name != sourceServer:
                 server.callRemote(LeaveChannel, channel=channel.name, user=self.uuid)
     
     def nick(self, newNick):
@@ -517,18 +508,15 @@ class IRCUser(object):
         self.ircd.users[newNick] = self
         notify = set()
         notify.add(self)
-        for cdata in self.ircd.channels.itervalues():
-            if self in cdata.users:
-                for cuser in cdata.users.iterkeys():
-                    notify.add(cuser)
-        prefix = self.prefix()
-        for u in notify:
-            u.sendMessage("NICK", to=newNick, prefix=prefix)
+        for cdata in self.channels:
+            for cuser in cdata.users.iterkeys():
+                notify.add(cuser)
+        self.ircd.broadcast(notify, "NICK", to=newNick, prefix=self.prefix())
         oldNick = self.nickname
         self.nickname = newNick
+        self.prefixString = None
         self.nicktime = now()
-        for server in self.ircd.servers.itervalues():
-            if server.nearHop == self.ircd.name:
-                server.callRemote(ChangeNick, user=self.uuid, newnick=self.nickname)
+        for server in self.ircd.linked_servers:
+            server.callRemote(ChangeNick, user=self.uuid, newnick=self.nickname)
         for modfunc in self.ircd.actions["nick"]:
             modfunc(self, oldNick)
\ No newline at end of file
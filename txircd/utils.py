@@ -1,5 +1,10 @@
+from twisted.internet import reactor
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
 from base64 import b64encode, b64decode
-from collections import MutableMapping
+from bisect import bisect
+from collections import MutableMapping, OrderedDict
+from heapq import heappop, heappush
 try:
     from Crypto.Hash import MD5 as md5, SHA as sha1, SHA224 as sha224, SHA256 as sha256, SHA384 as sha384, SHA512 as sha512
 except ImportError:
@@ -7,14 +12,20 @@ except ImportError:
 from pbkdf2 import PBKDF2
 from struct import pack
 from random import randint
-import re, datetime, sys
+import re, binascii, datetime, socket, string, sys, time
 
 VALID_NICKNAME = re.compile(r"[a-zA-Z\[\]\\`_^{}\|][a-zA-Z0-9-\[\]\\`_^{}\|]{0,31}$") # up to 32 char nicks
 DURATION_REGEX = re.compile(r"((?P<years>\d+?)y)?((?P<weeks>\d+?)w)?((?P<days>\d+?)d)?((?P<hours>\d+?)h)?((?P<minutes>\d+?)m)?((?P<seconds>\d+?)s)?")
 IPV4_MAPPED_ADDR = re.compile(r"^::ffff:((\d{1,3}\.){3}\d{1,3})$")
 
+IRC_LOWER_TABLE = string.maketrans(string.ascii_uppercase + "[]/~", string.ascii_lowercase + "{}|^")
+IRC_LOWER_UNICODE_TABLE = dict((ord(upper), ord(lower)) for upper, lower in zip(string.ascii_uppercase + "[]/~", string.ascii_lowercase + "{}|^"))
+
 def irc_lower(str):
-    return str.lower().replace("[","{").replace("]","}").replace("/","|").replace("~","^")
+    # A translate table does all of the case mapping in one pass over the string
+    if type(str) is unicode:
+        return str.lower().translate(IRC_LOWER_UNICODE_TABLE)
+    return str.translate(IRC_LOWER_TABLE)
 
 def now():
     return datetime.datetime.utcnow().replace(microsecond=0)
@@ -105,6 +116,12 @@ def resolveEndpointDescription(desc):
     return "".join(result)
 
 class CaseInsensitiveDictionary(MutableMapping):
+    """
+    A dictionary keyed on IRC-lowered strings.  Keys are stored (and iterated
+    over) in their lowered form.  The lookups and iteration helpers go
+    straight to the underlying dictionary rather than through the generic
+    MutableMapping versions, which would case map every key again.
+    """
     def __init__(self):
         self._data = {}
 
@@ -123,6 +140,9 @@ class CaseInsensitiveDictionary(MutableMapping):
         except KeyError:
             raise KeyError(key)
 
+    def __contains__(self, key):
+        return irc_lower(key) in self._data
+
     def __iter__(self):
         return iter(self._data)
 
@@ -132,6 +152,559 @@ class CaseInsensitiveDictionary(MutableMapping):
     def __setitem__(self, key, value):
         self._data[irc_lower(key)] = value
 
+    def get(self, key, default=None):
+        return self._data.get(irc_lower(key), default)
+
+    def keys(self):
+        return self._data.keys()
+
+    def values(self):
+        return self._data.values()
+
+    def items(self):
+        return self._data.items()
+
+    def iterkeys(self):
+        return self._data.iterkeys()
+
+    def itervalues(self):
+        return self._data.itervalues()
+
+    def iteritems(self):
+        return self._data.iteritems()
+
+class UserDictionary(CaseInsensitiveDictionary):
+    """
+    The nickname table for users.  It keeps count of local, invisible, and
+    oper users as users are added and removed, so that LUSERS doesn't need to
+    go through every user.  Changes to the counted user modes have to be
+    passed in through modeChanged.
+    """
+    def __init__(self, localServer = None):
+        CaseInsensitiveDictionary.__init__(self)
+        self.localServer = localServer
+        self.localCount = 0
+        self.invisibleCount = 0
+        self.operCount = 0
+
+    def __delitem__(self, key):
+        lowerKey = irc_lower(key)
+        if lowerKey not in self._data:
+            raise KeyError(key)
+        self._count(self._data.pop(lowerKey), -1)
+
+    def __setitem__(self, key, value):
+        lowerKey = irc_lower(key)
+        if lowerKey in self._data:
+            self._count(self._data[lowerKey], -1)
+        self._data[lowerKey] = value
+        self._count(value, 1)
+
+    def _count(self, user, change):
+        if user.server == self.localServer:
+            self.localCount += change
+        if "i" in user.mode:
+            self.invisibleCount += change
+        if "o" in user.mode:
+            self.operCount += change
+
+    def modeChanged(self, user, mode, adding):
+        # Users not in the table yet are counted with their modes when they're added
+        if user.nickname is None or self._data.get(irc_lower(user.nickname)) is not user:
+            return
+        change = 1 if adding else -1
+        if mode == "i":
+            self.invisibleCount += change
+        elif mode == "o":
+            self.operCount += change
+
+class LRUCache(object):
+    """
+    A bounded mapping which discards the least recently used entries once it
+    holds more than maxsize of them, calling onEvict with the key and value of
+    each discarded entry if it's given
+    """
+    def __init__(self, maxsize, onEvict=None):
+        self.maxsize = maxsize
+        self.onEvict = onEvict
+        self._data = OrderedDict()
+    
+    def __contains__(self, key):
+        return key in self._data
+    
+    def __len__(self):
+        return len(self._data)
+    
+    def __getitem__(self, key):
+        value = self._data.pop(key)
+        self._data[key] = value
+        return value
+    
+    def __setitem__(self, key, value):
+        if key in self._data:
+            del self._data[key]
+        self._data[key] = value
+        self.trim()
+    
+    def __delitem__(self, key):
+        del self._data[key]
+    
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+    
+    def itervalues(self):
+        return self._data.itervalues()
+    
+    def resize(self, maxsize):
+        self.maxsize = maxsize
+        self.trim()
+    
+    def trim(self):
+        while len(self._data) > self.maxsize:
+            key, value = self._data.popitem(last=False)
+            if self.onEvict is not None:
+                self.onEvict(key, value)
+    
+    def clear(self):
+        self._data.clear()
+
+def parse_cidr(mask):
+    """
+    Parses a CIDR mask (e.g. 10.0.0.0/8) into a tuple of the address family,
+    the network's leading bits as a number, and the prefix length, returning
+    None if the mask isn't a valid CIDR mask.  The separator may also be a
+    "|", since that's what irc_lower turns "/" into.
+    """
+    mask = mask.replace("|", "/")
+    if "/" not in mask:
+        return None
+    address, length = mask.rsplit("/", 1)
+    number = ip_to_number(address)
+    if number is None:
+        return None
+    family, number, bits = number
+    try:
+        length = int(length)
+    except ValueError:
+        return None
+    if length < 0 or length > bits:
+        return None
+    return (family, number >> (bits - length), length)
+
+def ip_to_number(ip):
+    """
+    Converts an IP address into a tuple of its address family, its value as
+    a number, and the number of bits in it, returning None if it isn't an IP
+    address
+    """
+    family = socket.AF_INET6 if ":" in ip else socket.AF_INET
+    try:
+        packed = socket.inet_pton(family, ip)
+    except (socket.error, ValueError):
+        return None
+    return (family, int(binascii.hexlify(packed), 16), len(packed) * 8)
+
+class IPPrefixTree(object):
+    """
+    Stores values under CIDR networks (as returned by parse_cidr) so that
+    finding every network containing an address takes at most one step for
+    each bit of the address
+    """
+    def __init__(self):
+        self._roots = {}
+        self._size = 0
+    
+    def __len__(self):
+        return self._size
+    
+    def _node(self, network, create):
+        family, number, length = network
+        if family not in self._roots:
+            if not create:
+                return None
+            self._roots[family] = [None, None, None]
+        node = self._roots[family]
+        for shift in xrange(length - 1, -1, -1):
+            bit = (number >> shift) & 1
+            if node[bit] is None:
+                if not create:
+                    return None
+                node[bit] = [None, None, None]
+            node = node[bit]
+        return node
+    
+    def add(self, network, value):
+        node = self._node(network, True)
+        if node[2] is None:
+            node[2] = []
+        node[2].append(value)
+        self._size += 1
+    
+    def remove(self, network, value):
+        family, number, length = network
+        node = self._roots.get(family)
+        path = []
+        for shift in xrange(length - 1, -1, -1):
+            if node is None:
+                break
+            bit = (number >> shift) & 1
+            path.append((node, bit))
+            node = node[bit]
+        if node is None or not node[2] or value not in node[2]:
+            raise KeyError(value)
+        node[2].remove(value)
+        self._size -= 1
+        if node[2]:
+            return
+        node[2] = None
+        # Prune the nodes that no longer lead to any values on the way back up, so that masks that come and go don't leave the tree growing
+        while path and node[0] is None and node[1] is None and node[2] is None:
+            node, bit = path.pop()
+            node[bit] = None
+        if not path and node[0] is None and node[1] is None and node[2] is None:
+            del self._roots[family]
+    
+    def search(self, family, number, bits):
+        """
+        Yields the values stored for each network containing the given
+        address, from the least specific network to the most specific
+        """
+        node = self._roots.get(family)
+        shift = bits
+        while node is not None:
+            if node[2]:
+                for value in node[2]:
+                    yield value
+            if shift == 0:
+                break
+            shift -= 1
+            node = node[(number >> shift) & 1]
+
+class MaskDictionary(CaseInsensitiveDictionary):
+    """
+    A case-insensitive dictionary of ban masks which can match strings
+    against all of its masks at once.  Masks without wildcards are looked up
+    directly, CIDR masks are kept in a prefix tree, and wildcard masks are
+    compiled into combined regular expressions the first time they're needed
+    after the masks change.
+    """
+    regex_group_limit = 99 # Python's re module can't handle more than 100 groups in an expression
+    
+    def __init__(self):
+        CaseInsensitiveDictionary.__init__(self)
+        self._exact = set()
+        self._networks = IPPrefixTree()
+        self._wildcardMasks = set()
+        self._wildcard = []
+        self._compiled = True
+    
+    def __setitem__(self, key, value):
+        mask = irc_lower(key)
+        if mask not in self._data:
+            self._index(mask)
+        self._data[mask] = value
+    
+    def __delitem__(self, key):
+        mask = irc_lower(key)
+        if mask not in self._data:
+            raise KeyError(key)
+        del self._data[mask]
+        network = self._splitNetwork(mask)
+        if network:
+            self._networks.remove(network[2], (mask, network[0], network[1]))
+        elif mask in self._wildcardMasks:
+            self._wildcardMasks.discard(mask)
+            self._compiled = False
+        else:
+            self._exact.discard(mask)
+    
+    def _splitNetwork(self, mask):
+        if "@" in mask:
+            prefix, host = mask.rsplit("@", 1)
+            prefix += "@"
+        else:
+            prefix = ""
+            host = mask
+        network = parse_cidr(host)
+        if network is None:
+            return None
+        prefixPattern = None if prefix == "*@" or not prefix else prefix # Those are cheaper to check without a pattern
+        return prefix, prefixPattern, network
+    
+    def _index(self, mask):
+        network = self._splitNetwork(mask)
+        if network:
+            self._networks.add(network[2], (mask, network[0], network[1]))
+        elif "*" in mask or "?" in mask:
+            self._wildcardMasks.add(mask)
+            self._compiled = False
+        else:
+            self._exact.add(mask)
+    
+    def compile(self):
+        self._wildcard = []
+        wildcardMasks = list(self._wildcardMasks)
+        for i in range(0, len(wildcardMasks), self.regex_group_limit):
+            masks = wildcardMasks[i:i + self.regex_group_limit]
+            pattern = "(?s)(?:{})\\Z".format("|".join("({})".format(wildcard_regex(mask)) for mask in masks))
+            self._wildcard.append((re.compile(pattern), masks))
+        self._compiled = True
+    
+    def match(self, *subjects):
+        """
+        Returns the first mask matching any of the given strings, or None if
+        none of them match
+        """
+        return self.matchLowered([irc_lower(subject) for subject in subjects])
+    
+    def matchLowered(self, subjects):
+        """
+        Like match(), but for strings which have already been through
+        irc_lower
+        """
+        if not self._data:
+            return None
+        if not self._compiled:
+            self.compile()
+        for subject in subjects:
+            if subject in self._exact:
+                return subject
+            for expression, masks in self._wildcard:
+                result = expression.match(subject)
+                if result:
+                    return masks[result.lastindex - 1]
+            if self._networks:
+                mask = self.matchNetwork(subject)
+                if mask:
+                    return mask
+        return None
+    
+    def matchNetwork(self, subject):
+        if "@" in subject:
+            prefix, host = subject.rsplit("@", 1)
+            prefix += "@"
+        else:
+            prefix = ""
+            host = subject
+        address = ip_to_number(host)
+        if address is None:
+            return None
+        for mask, maskPrefix, prefixPattern in self._networks.search(*address):
+            if prefixPattern is None:
+                if bool(maskPrefix) != bool(prefix):
+                    continue
+            elif not wildcard_match(prefix, prefixPattern):
+                continue
+            return mask
+        return None
+    
+    def matchUsers(self, users, subjects):
+        """
+        Checks many users at once, returning a list of (user, mask) pairs for
+        each user that matches.  subjects is a function taking a user and
+        returning the strings to match for that user.
+        """
+        matches = []
+        if not self._data:
+            return matches
+        for user in users:
+            mask = self.match(*subjects(user))
+            if mask:
+                matches.append((user, mask))
+        return matches
+
+class ExpiryQueue(object):
+    """
+    Removes X-lines from a line list once they expire.  Lines are kept in a
+    heap ordered by expiry time, and a single reactor.callLater waits for the
+    soonest one, so nothing needs to scan the list to find expired lines.
+    Lines are the usual dictionaries with "created" and "duration" keys; a
+    duration of 0 means the line never expires.  If onExpire is given, it's
+    called with the key of each line that's removed.
+    """
+    def __init__(self, lines, onExpire=None):
+        self.lines = lines
+        self.onExpire = onExpire
+        self._heap = []
+        self._timer = None
+    
+    def add(self, key):
+        linedata = self.lines[key]
+        if not linedata["duration"]:
+            return
+        expireTime = linedata["created"] + linedata["duration"]
+        heappush(self._heap, (expireTime, key))
+        if self._heap[0][0] == expireTime: # The new line is the next to expire
+            self._schedule()
+    
+    def stop(self):
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+    
+    def _schedule(self):
+        self.stop()
+        if self._heap:
+            # Lines last through the whole second they expire in
+            self._timer = reactor.callLater(max(0, self._heap[0][0] + 1 - time.time()), self._expire)
+    
+    def _expire(self):
+        self._timer = None
+        currentTime = epoch(now())
+        while self._heap and self._heap[0][0] < currentTime:
+            expireTime, key = heappop(self._heap)
+            # The line may have been removed early, or removed and set again, since this entry was queued
+            if key in self.lines:
+                linedata = self.lines[key]
+                if linedata["duration"] and linedata["created"] + linedata["duration"] == expireTime:
+                    del self.lines[key]
+                    if self.onExpire is not None:
+                        self.onExpire(key)
+        self._schedule()
+
+class TimingStats(object):
+    """
+    Keeps call counts and timings for commands, module hooks, and server
+    responders, so that slow modules can be found without a profiler.  Each
+    entry is keyed on a category and a name and holds the number of calls,
+    the total and longest time taken, and a histogram of call times.
+    """
+    histogram_limits = [0.00001, 0.0001, 0.001, 0.01, 0.1] # Upper bounds of the histogram buckets in seconds; the last bucket holds anything slower
+    histogram_labels = ["<10us", "<100us", "<1ms", "<10ms", "<100ms", ">=100ms"]
+    
+    def __init__(self):
+        self.enabled = True
+        self.reset()
+    
+    def reset(self):
+        self.started = time.time()
+        self.entries = {}
+    
+    def record(self, category, name, elapsed):
+        key = (category, name)
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.entries[key] = [0, 0.0, 0.0, [0] * (len(self.histogram_limits) + 1)]
+        entry[0] += 1
+        entry[1] += elapsed
+        if elapsed > entry[2]:
+            entry[2] = elapsed
+        entry[3][bisect(self.histogram_limits, elapsed)] += 1
+    
+    def wrap(self, category, name, function):
+        return TimedFunction(self, category, name, function)
+    
+    def summary(self, category = None):
+        """
+        Returns the entries (optionally only those in one category) as
+        dictionaries, with the ones that took the most time in total first.
+        """
+        results = []
+        for (entryCategory, name), (count, total, longest, histogram) in self.entries.iteritems():
+            if category is not None and entryCategory != category:
+                continue
+            results.append({
+                "category": entryCategory,
+                "name": name,
+                "count": count,
+                "total": total,
+                "average": total / count,
+                "max": longest,
+                "histogram": dict(zip(self.histogram_labels, histogram))
+            })
+        results.sort(key=lambda entry: entry["total"], reverse=True)
+        return results
+    
+    def dump(self):
+        return {
+            "started": self.started,
+            "dumped": time.time(),
+            "entries": self.summary()
+        }
+
+class TimedFunction(object):
+    """
+    Wraps a hook function so that its calls are recorded in a TimingStats.
+    It compares equal to the function it wraps, so it can still be found and
+    removed from hook lists by the original function.
+    """
+    def __init__(self, stats, category, name, function):
+        self.stats = stats
+        self.category = category
+        self.name = name
+        self.function = function
+    
+    def __call__(self, *args, **kw):
+        start = time.time()
+        try:
+            return self.function(*args, **kw)
+        finally:
+            self.stats.record(self.category, self.name, time.time() - start)
+    
+    def __eq__(self, other):
+        if isinstance(other, TimedFunction):
+            other = other.function
+        return self.function == other
+    
+    def __ne__(self, other):
+        return not self.__eq__(other)
+    
+    def __hash__(self):
+        return hash(self.function)
+    
+    def __getattr__(self, attr):
+        return getattr(self.function, attr)
+
+def function_name(function):
+    # Hook functions are nearly always bound methods of module objects, so name them by module, class, and method
+    module = getattr(function, "__module__", None) or "?"
+    instance = getattr(function, "im_self", None)
+    name = getattr(function, "__name__", None) or function.__class__.__name__
+    if instance is not None:
+        return "{}.{}.{}".format(module, instance.__class__.__name__, name)
+    return "{}.{}".format(module, name)
+
+def wildcard_regex(mask):
+    """
+    Turns an IRC wildcard mask (using * and ?) into the equivalent regular
+    expression
+    """
+    return "".join(".*" if char == "*" else "." if char == "?" else re.escape(char) for char in mask)
+
+_wildcard_cache = LRUCache(1024)
+def wildcard_match(subject, mask):
+    """
+    Checks a string against a single IRC wildcard mask, compiling and caching
+    the mask's regular expression as needed
+    """
+    if mask not in _wildcard_cache:
+        _wildcard_cache[mask] = re.compile("(?s){}\\Z".format(wildcard_regex(mask)))
+    return _wildcard_cache[mask].match(subject) is not None
+
+def resolve_hostname(ip):
+    """
+    Looks up the hostname of an IP address and checks that the hostname
+    resolves back to the same address, returning the IP address if either step
+    fails.  This blocks while waiting on the system resolver, so it should be
+    run in a thread.
+    """
+    try:
+        hostname = socket.gethostbyaddr(ip)[0]
+        addresses = socket.getaddrinfo(hostname, None)
+    except (socket.error, UnicodeError):
+        return ip
+    for addrinfo in addresses:
+        address = addrinfo[4][0].split("%", 1)[0]
+        mapped = IPV4_MAPPED_ADDR.match(address)
+        if mapped:
+            address = mapped.group(1)
+        if address == ip:
+            return hostname
+    return ip
+
 # Duplicate PBKDF2
 
 # Python 2.1 thru 3.2 compatibility
@@ -206,6 +779,19 @@ def crypt(word, salt=None, iterations=1000, algorithm="sha256", bytes=24):
     hash = b64encode(PBKDF2(word, salt, iterations, algos[algorithm]).read(bytes))
     return "{}:{!s}:{}:{}".format(algorithm, iterations, salt, hash)
 
+crypt_pool = ThreadPool(0, 2, "crypt")
+
+def deferred_crypt(word, salt=None, iterations=1000, algorithm="sha256", bytes=24):
+    """
+    Runs crypt() in the bounded crypt worker pool, returning a Deferred which
+    fires with the hash.  Use this from the reactor thread so that hashing
+    doesn't hold up everything else the server is doing.
+    """
+    if not crypt_pool.started:
+        crypt_pool.start()
+        reactor.addSystemEventTrigger("during", "shutdown", crypt_pool.stop)
+    return deferToThreadPool(reactor, crypt_pool, crypt, word, salt, iterations, algorithm, bytes)
+
 def _makesalt():
     """Return a 48-bit pseudorandom salt for crypt().
 